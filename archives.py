@@ -0,0 +1,167 @@
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from pathlib import Path
+
+from journals import _to_native
+
+
+class SharedArchive:
+    """
+    Archive that several Querents, in any number of processes, can write to
+    at once: a single log of journal records in an SQLite database in WAL
+    mode, each record tagged with the worker (normally the API key) that
+    wrote it.
+
+    To a Querent it is a drop-in for its journals.Journal (see the
+    shared_archive argument): records are buffered and committed in groups
+    of flush_every records or every flush_ms milliseconds, optionally from a
+    background thread. On top of that, read() returns the records other
+    workers have committed since the last call, which the Querent folds in
+    as extra comps. Writers never block readers, and SQLite serializes the
+    group commits, so records come back in the order they were committed.
+    """
+
+    def __init__(self, path, worker, flush_every = 32, flush_ms = 200, fsync = True, timeout = 30.0):
+        self.path = Path(path).as_posix()
+        self.worker = str(worker)
+        self.flush_every = flush_every
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._last_seq = 0
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+        self._conn = sqlite3.connect(self.path, timeout = timeout, isolation_level = None, check_same_thread = False)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = {}'.format('FULL' if fsync else 'NORMAL'))
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, body TEXT NOT NULL)'
+        )
+        atexit.register(self.close)
+    #END
+
+    def append(self, record):
+        """
+        Add a record to the archive, committing the pending group if it is
+        full or old enough.
+        """
+        body = json.dumps(record, default = _to_native)
+        with self._lock:
+            self._buffer.append(body)
+            full = len(self._buffer) >= self.flush_every
+
+        if self._thread is not None:
+            if full:
+                self._wake.set()
+            return
+
+        elapsed_ms = (time.monotonic() - self._last_flush) * 1000
+        if full or elapsed_ms >= self.flush_ms:
+            self.flush()
+    #END
+
+    def flush(self):
+        """
+        Commit all buffered records in a single transaction.
+        """
+        with self._io_lock:
+            with self._lock:
+                bodies = self._buffer
+                self._buffer = []
+            if self._conn is None:
+                return
+            if bodies:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._conn.executemany(
+                        'INSERT INTO records (worker, body) VALUES (?, ?)',
+                        [(self.worker, body) for body in bodies]
+                    )
+                except BaseException:
+                    self._conn.execute('ROLLBACK')
+                    raise
+                self._conn.execute('COMMIT')
+            self._last_flush = time.monotonic()
+    #END
+
+    def read(self, everything = False):
+        """
+        Records committed by other workers since the last read(), as a list
+        of (worker, record) pairs in commit order. With everything = True,
+        every record in the archive (this worker's included) is returned,
+        e.g. to rebuild a Querent on startup.
+        """
+        with self._io_lock:
+            if everything:
+                rows = self._conn.execute('SELECT seq, worker, body FROM records ORDER BY seq').fetchall()
+            else:
+                rows = self._conn.execute(
+                    'SELECT seq, worker, body FROM records WHERE seq > ? AND worker != ? ORDER BY seq',
+                    (self._last_seq, self.worker)
+                ).fetchall()
+        if rows:
+            self._last_seq = max(self._last_seq, rows[-1][0])
+        return [(worker, json.loads(body)) for seq, worker, body in rows]
+    #END
+
+    def start_background(self):
+        """
+        Hand group commits over to a background thread (see
+        journals.Journal.start_background).
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, name = 'archive-flush', daemon = True)
+        self._thread.start()
+    #END
+
+    def stop_background(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+    #END
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_ms / 1000)
+            self._wake.clear()
+            self.flush()
+    #END
+
+    def truncate(self):
+        """
+        Does nothing: the other workers still need the records, so a shared
+        archive is never folded into a snapshot.
+        """
+        pass
+
+    def close(self):
+        """
+        Commit any buffered records and close the database.
+        """
+        if self._conn is None:
+            return
+        self.stop_background()
+        self.flush()
+        with self._io_lock:
+            self._conn.close()
+            self._conn = None
+        atexit.unregister(self.close)
+    #END
+
+#END class
@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+
+import environments
+from indexes import CompsIndex
+from querents import LocalQuerent
+
+
+class ReplayEnvironment(environments.BiddingEnvironment):
+    """
+    BiddingEnvironment that serves users in a fixed order (e.g. the rows of
+    past_bids.csv) instead of at random, and records every bid so a run can
+    be scored afterwards. The adversary's bids for the stream are given up
+    front (see Backtester).
+    """
+
+    def __init__(self, sampler, rows, adversary_bids):
+        super().__init__(sampler, adversary = None)
+        self.rows = np.asarray(rows)
+        self.adversary_bids = np.asarray(adversary_bids)
+        self.bids = np.full(self.rows.shape[0], np.nan)
+        self._next = 0
+        self._pending = None
+    #END
+
+    @property
+    def exhausted(self):
+        return self._next >= self.rows.shape[0]
+
+    def get_next_user(self, payload):
+        if self._pending is not None:
+            return {'result': 'failure', 'message': 'A bid must be placed on the current user before requesting another.',
+                    'user_id': str(self._pending)}
+        if self.exhausted:
+            return {'result': 'failure', 'message': 'No more users in the stream.'}
+
+        i = self._next
+        self._next += 1
+        self._pending = i
+        user = self.sampler.record(self.rows[i])
+        user['user_index'] = i + 1
+        user['user_id'] = str(i)
+        user['result'] = 'success'
+        return user
+    #END
+
+    def submit_bid(self, payload):
+        i = self._pending
+        if i is None or payload.get('user_id') != str(i):
+            return {'result': 'failure', 'message': 'No user with that user_id is up for bid.'}
+        bid = float(payload['bid_amount'])
+        self.bids[i] = bid
+        self._pending = None
+
+        row = self.rows[i]
+        win = bool(bid > self.adversary_bids[i])
+        purchase = bool(win and self.sampler.purchase[row])
+        return {'result': 'success', 'win': win, 'purchase': purchase,
+                'profit': float(self.sampler.revenue[row]) if purchase else 0.0}
+    #END
+
+    def how_am_i_doing(self, payload):
+        return dict(result = 'success', **outcomes(self, self.bids[:self._next]).summary())
+
+#END class
+
+
+class BacktestResult:
+    """
+    Outcome of replaying a stream of users: per-user bids, wins, purchases and
+    net profit, plus cumulative curves. Users that were never bid on count
+    as a bid of zero (a loss).
+    """
+
+    def __init__(self, bids, adversary_bids, purchase, revenue):
+        self.bids = np.nan_to_num(np.asarray(bids, dtype = np.float64), nan = 0.0)
+        self.adversary_bids = np.asarray(adversary_bids)
+        self.wins = self.bids > self.adversary_bids
+        self.purchases = self.wins & np.asarray(purchase, dtype = bool)
+        self.revenue = np.where(self.purchases, revenue, 0.0)
+        self.spend = np.where(self.wins, self.bids, 0.0)
+        self.net = self.revenue - self.spend
+    #END
+
+    def __len__(self):
+        return self.bids.shape[0]
+
+    @property
+    def profit_curve(self):
+        """
+        Cumulative net profit after each user.
+        """
+        return np.cumsum(self.net)
+
+    @property
+    def win_rate_curve(self):
+        """
+        Fraction of bids won so far, after each user.
+        """
+        return np.cumsum(self.wins) / np.arange(1, len(self) + 1)
+
+    def summary(self):
+        n = len(self)
+        return {
+            'bids': n,
+            'wins': int(self.wins.sum()),
+            'purchases': int(self.purchases.sum()),
+            'spend': float(self.spend.sum()),
+            'revenue': float(self.revenue.sum()),
+            'profit': float(self.net.sum()),
+            'win_rate': float(self.wins.mean()) if n else 0.0,
+        }
+    #END
+
+    def frame(self):
+        """
+        The per-user results and curves as a data frame.
+        """
+        return pd.DataFrame({
+            'bid': self.bids,
+            'adversary_bid': self.adversary_bids,
+            'win': self.wins,
+            'purchase': self.purchases,
+            'net': self.net,
+            'profit_curve': self.profit_curve,
+            'win_rate_curve': self.win_rate_curve,
+        })
+    #END
+
+#END class
+
+
+def outcomes(env, bids):
+    """
+    Score a vector of bids on the first len(bids) users of a ReplayEnvironment.
+    """
+    n = len(bids)
+    rows = env.rows[:n]
+    return BacktestResult(bids, env.adversary_bids[:n], env.sampler.purchase[rows], env.sampler.revenue[rows])
+
+
+class Backtester:
+    """
+    Replays a stream of users through bidders offline, with a pluggable
+    adversary (see environments) deciding who wins.
+
+    users is an environments.UserSampler, e.g. UserSampler('past_bids.csv').
+    By default the users are replayed in file order; shuffle = True replays
+    a seeded permutation instead. Streams longer than the file wrap around.
+
+    Three entry points:
+    - run(make_bidder) plays any Bidder subclass against the stream through
+      an in-memory LocalQuerent, exactly as it would run live (one user at a
+      time, so throughput is bounded by the bidder itself).
+    - replay_bids(bids) scores a whole vector of bids at once with no
+      per-user work at all, for policies that can compute bids in bulk;
+      this handles millions of users a second.
+    - replay_policy(policy, store) computes every bid with a
+      policies.AnnealingPolicy in one call, with comps taken from a fixed
+      archive, and scores them with replay_bids().
+    """
+
+    def __init__(self, users, adversary = None, n_users = None, shuffle = False, seed = None):
+        self.users = users
+        self.adversary = adversary if adversary is not None else environments.LinearAdversary()
+        self.seed = seed
+
+        n_users = n_users or len(users)
+        rng = np.random.default_rng(seed)
+        base = rng.permutation(len(users)) if shuffle else np.arange(len(users))
+        self.rows = base[np.arange(n_users) % len(users)]
+
+        ## The adversary's bid on every user is drawn once, in one call, so
+        ## all runs on this Backtester face exactly the same opposition.
+        self.adversary_bids = self.adversary.bids(users.features[self.rows], rng)
+    #END
+
+    def environment(self):
+        """
+        A fresh replay of the stream.
+        """
+        return ReplayEnvironment(self.users, self.rows, self.adversary_bids)
+
+    @property
+    def features(self):
+        """
+        Feature matrix of the stream, one row per user in replay order.
+        """
+        return self.users.features[self.rows]
+
+    def run(self, make_bidder, n_users = None):
+        """
+        Replay the stream through the bidder returned by make_bidder(querent),
+        e.g. lambda qr: AnnealingBidder(model, qr). Returns a BacktestResult
+        for the users bid on, with the querent and bidder attached.
+        """
+        env = self.environment()
+        qr = LocalQuerent(None, 'backtest', env)
+        bidder = make_bidder(qr)
+
+        n_users = min(n_users or len(self.rows), len(self.rows))
+        while env._next < n_users:
+            bidder.execute_bid()
+
+        result = outcomes(env, env.bids[:env._next])
+        result.querent = qr
+        result.bidder = bidder
+        return result
+    #END
+
+    def replay_bids(self, bids):
+        """
+        Score a vector with one bid per user in the stream, all at once.
+        """
+        bids = np.asarray(bids, dtype = np.float64)[:len(self.rows)]
+        rows = self.rows[:len(bids)]
+        return BacktestResult(bids, self.adversary_bids[:len(bids)], self.users.purchase[rows], self.users.revenue[rows])
+    #END
+
+    def replay_policy(self, policy, store, n_comps = 6, first_timestep = 0, seed = None):
+        """
+        Bid on the whole stream at once with a policies.AnnealingPolicy, and
+        score the bids. Each user's comps are their nearest neighbours among
+        the resolved customers of store (e.g. querent.store), which stays
+        fixed for the whole stream rather than growing as bids are made; bid
+        i is made at time step first_timestep + i.
+        """
+        resolved = store.resolved_positions()
+        index = CompsIndex(store.features().shape[1]).fit(store.features(resolved), resolved)
+        comps = index.query_batch(self.features, n = n_comps).astype(int)
+
+        temperatures = policy.temperatures(first_timestep + np.arange(len(self.rows)))
+        bids = policy.bids(self.features, store.column('bid')[comps], store.column('win')[comps],
+                           temperatures, np.random.default_rng(seed))
+        return self.replay_bids(bids)
+    #END
+
+#END class
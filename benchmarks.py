@@ -0,0 +1,231 @@
+"""
+Scaling benchmarks for the per-bid hot path.
+
+Seeds synthetic archives of increasing size, then runs AnnealingBidder
+against an in-process environment (no HTTP) and times each stage of every
+bid. Results are written as JSON so runs from different commits can be
+compared:
+
+    python benchmarks.py --sizes 1000 10000 100000 1000000 --out bench_results
+    python benchmarks.py --compare bench_results/old.json bench_results/new.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+
+import utils
+import bidders
+import environments
+from querents import LocalQuerent
+
+
+STAGES = ['fetch', 'encode', 'score', 'comps', 'decide', 'submit', 'persist']
+
+
+def synthetic_archive(sampler, adversary, n, rng):
+    """
+    A customers table of n users that have already been bid on, with bids
+    spread around the adversary's so comps hold a mix of wins and losses.
+    """
+    rows = sampler.sample(n)
+    adversary_bids = adversary.bids(sampler.features[rows], rng)
+    bids = np.round(adversary_bids * rng.uniform(0.6, 1.4, n), 4)
+    win = bids > adversary_bids
+    profit = np.where(win & sampler.purchase[rows], sampler.revenue[rows], 0.0)
+
+    index = np.arange(1, n + 1)
+    return pd.DataFrame({
+        'result': 'success',
+        'user_index': index,
+        'user_id': ['s{:x}'.format(i) for i in index],
+        'day_of_week': sampler.day_of_week[rows],
+        'gender': sampler.gender[rows],
+        'marital_status': sampler.marital_status[rows],
+        'age': sampler.age[rows],
+        'income': sampler.income[rows],
+        'bid': bids,
+        'win': win,
+        'profit': profit,
+    }, index = index)
+#END
+
+
+def train_model(sampler):
+    """
+    A purchase model of the same kind as purchase_model.ipynb produces.
+    """
+    X = pd.DataFrame(sampler.features, columns = utils.FEATURE_COLUMNS)
+    return LogisticRegression().fit(X, sampler.purchase)
+
+
+def percentiles(samples):
+    """
+    Summary statistics of a list of durations, in microseconds.
+    """
+    a = np.asarray(samples) * 1e6
+    return {
+        'mean': float(a.mean()),
+        'p50': float(np.percentile(a, 50)),
+        'p90': float(np.percentile(a, 90)),
+        'p99': float(np.percentile(a, 99)),
+        'max': float(a.max()),
+    }
+#END
+
+
+def time_bids(bidder, qr, n_bids):
+    """
+    Place n_bids bids one stage at a time, returning the duration of every
+    stage of every bid. The stages make the same calls as
+    AnnealingBidder.compute_bid() does on its nearest-neighbour tier.
+    """
+    timings = {stage: [] for stage in STAGES + ['total']}
+    clock = time.perf_counter
+    for i in range(n_bids):
+        t0 = clock()
+        qr.get_next_user()
+        t1 = clock()
+        feat = qr.store.features(qr.store.pending)
+        t2 = clock()
+        bound = bidder.max_bid(bidder.purchase_probability(feat), discount = bidder._discount)
+        t3 = clock()
+        stats = bidder.comps_stats(feat)
+        t4 = clock()
+        bid = bidder.decide_from_stats(bound, stats)
+        t5 = clock()
+        bidder.last_tier = 'knn'
+        bidder.place_bid(bid)
+        t6 = clock()
+        qr.journal.flush()
+        t7 = clock()
+
+        for stage, start, stop in zip(STAGES, [t0, t1, t2, t3, t4, t5, t6], [t1, t2, t3, t4, t5, t6, t7]):
+            timings[stage].append(stop - start)
+        timings['total'].append(t7 - t0)
+    return timings
+#END
+
+
+def run_size(size, n_bids, model, sampler, adversary, seed):
+    """
+    Benchmark one archive size.
+    """
+    rng = np.random.default_rng(seed)
+    archive_dir = tempfile.mkdtemp(prefix = 'b2w_bench_')
+    try:
+        synthetic_archive(sampler, adversary, size, rng).to_csv(archive_dir + '/customers.csv')
+
+        env = environments.BiddingEnvironment(sampler, adversary, seed = seed, first_index = size + 1)
+        start = time.perf_counter()
+        ## Huge group-commit limits so journal writes only happen in the
+        ## timed 'persist' stage
+        qr = LocalQuerent(archive_dir, 'bench', env, flush_every = 10**9, flush_ms = 10**9)
+        open_seconds = time.perf_counter() - start
+        bidder = bidders.AnnealingBidder(model, qr, timescale = 100, initial_increment = 0.10)
+
+        timings = time_bids(bidder, qr, n_bids)
+
+        ## Memory is measured on a separate, shorter pass since tracing
+        ## slows everything down
+        tracemalloc.start()
+        time_bids(bidder, qr, min(n_bids, 100))
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        qr.close()
+    finally:
+        shutil.rmtree(archive_dir, ignore_errors = True)
+
+    return {
+        'archive_size': size,
+        'bids': n_bids,
+        'open_seconds': open_seconds,
+        'latency_us': {stage: percentiles(samples) for stage, samples in timings.items()},
+        'bid_loop_peak_traced_bytes': traced_peak,
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+#END
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+#END
+
+
+def compare(old_fp, new_fp, stat = 'p50'):
+    """
+    Print the ratio new/old of each stage's latency for each archive size.
+    """
+    old = {r['archive_size']: r for r in json.load(open(old_fp))['results']}
+    new = {r['archive_size']: r for r in json.load(open(new_fp))['results']}
+    print('{:>10} {:>8} {:>12} {:>12} {:>7}'.format('size', 'stage', 'old ' + stat, 'new ' + stat, 'ratio'))
+    for size in sorted(set(old) & set(new)):
+        for stage in STAGES + ['total']:
+            a = old[size]['latency_us'][stage][stat]
+            b = new[size]['latency_us'][stage][stat]
+            print('{:>10} {:>8} {:>12.1f} {:>12.1f} {:>7.2f}'.format(size, stage, a, b, b / a if a else float('nan')))
+#END
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the per-bid hot path as the archive grows.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000, 1000000])
+    parser.add_argument('--bids', type = int, default = 500, help = 'timed bids per archive size')
+    parser.add_argument('--past-bids', default = None, help = 'past_bids.csv to draw users from (synthetic if omitted)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--out', default = 'bench_results', help = 'directory for the results file')
+    parser.add_argument('--label', default = None, help = 'name for the results file (defaults to the commit and time)')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'), help = 'compare two results files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sampler = environments.UserSampler(args.past_bids, seed = args.seed)
+    adversary = environments.LinearAdversary()
+    model = train_model(sampler)
+
+    results = []
+    for size in args.sizes:
+        res = run_size(size, args.bids, model, sampler, adversary, args.seed)
+        total = res['latency_us']['total']
+        print('{:>9} customers: p50 {:8.1f}us  p99 {:8.1f}us  open {:6.2f}s'.format(size, total['p50'], total['p99'], res['open_seconds']))
+        results.append(res)
+
+    commit = git_commit()
+    label = args.label or '{}_{}'.format((commit or 'nocommit')[:8], time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(args.out, exist_ok = True)
+    out_fp = os.path.join(args.out, 'bench_{}.json'.format(label))
+    with open(out_fp, 'w') as fh:
+        json.dump({
+            'commit': commit,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'stages': STAGES,
+            'results': results,
+        }, fh, indent = 2)
+    print('Wrote {}'.format(out_fp))
+#END
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
 
+import time
 import utils
 import pickle
+import numpy as np
 from random import random
-from sklearn.neighbors import NearestNeighbors, KNeighborsRegressor
 
 import querents
+import scorers
+import policies
+from instruments import timed
 import strategies
 
 
@@ -17,13 +21,41 @@ class Bidder:
 
     _qr = None # A Querent object for handling all the web communications
     _mod = None # A model that gives the probability of a user making a purchase
+    _scorer = None # Fast scoring path built from _mod (see scorers.make_scorer)
     _timestep = None # For tracking how far into the bidding process we are
+    _retrainer = None # A retraining.Retrainer publishing new versions of _mod
+    _model_version = 0 # Version of _mod taken from the retrainer (0 is the original)
+    last_decision = None # What the last compute_bid() worked from (see AnnealingBidder.compute_bid)
+    last_tier = None # Which tier decided the last bid computed ('knn', 'segment' or 'default')
+
+    @property
+    def instruments(self):
+        """
+        The Querent's instruments.Instrumentation, which bidders report to as well.
+        """
+        return self._qr.instruments
+
+    def scorer(self):
+        """
+        Get the scorer for the current model, building it the first time it is
+        needed (or again if the model has been replaced).
+        """
+        if self._scorer is None or self._scorer.model is not self._mod:
+            self._scorer = scorers.make_scorer(self._mod)
+        return self._scorer
 
     def purchase_probability(self, user_features):
         """
         Use the objects model to predict the likelihood of a user making a purchase.
         """
-        return self._mod.predict_proba(user_features)[:,1][0]
+        return self.scorer().score(user_features)
+
+    def purchase_probabilities(self, user_features):
+        """
+        Predict the likelihood of purchase for every row of a feature matrix in
+        one call.
+        """
+        return self.scorer().score_batch(user_features)
     
     def max_bid(self, prob, discount = 1.0):
         """
@@ -32,8 +64,7 @@ class Bidder:
         Values taken from analysis of the purchase model's performance conducted in
         purchase_model.ipynb.
         """
-        ave_purchase_revenue = 10.181258488003621
-        num = prob * discount * ave_purchase_revenue
+        num = prob * discount * utils.AVE_PURCHASE_REVENUE
 
         ## Note: this is the old code. The newer (and more appropriate) calculation
         ## is used above.
@@ -46,14 +77,90 @@ class Bidder:
         
         return num
 
+    @timed('bidder.place_bid')
     def place_bid(self, bid):
         """
-        Make a bid and increment the time step.
+        Make a bid and increment the time step. The bidder's state after the
+        bid is archived along with its result (see state()), as is the tier
+        that decided it.
         """
         self._timestep += 1
-        self._qr.place_bid(bid)
+        res = self._qr.place_bid(bid, state = self.state(), tier = self.last_tier)
+        if self._retrainer is not None:
+            self._swap_model()
+        return res
     #END
 
+    def follow(self, retrainer):
+        """
+        Bid with the newest model a retraining.Retrainer has published,
+        checking for a new version after every bid (pass None to stop).
+        """
+        self._retrainer = retrainer
+
+    def _swap_model(self):
+        published = self._retrainer.published
+        if published is not None and published[0] != self._model_version:
+            self._model_version, self._mod, self._scorer = published
+            self.instruments.count('bidder.model_swaps')
+    #END
+
+    def state(self):
+        """
+        Everything needed to carry on bidding exactly where this bidder left
+        off, as a JSON-able dict. The Querent journals it with every bid and
+        checkpoints it on compaction (see Querent.bidder_state).
+        """
+        return {'class': type(self).__name__, 'timestep': self._timestep}
+
+    def restore(self, state):
+        """
+        Pick up from a state() saved by a bidder of the same class. Returns
+        whether the state was applied.
+        """
+        if state is None or state.get('class') != type(self).__name__:
+            return False
+        self._timestep = state['timestep']
+        return True
+    #END
+
+    def resume(self):
+        """
+        Settle whatever was left outstanding when the last session stopped,
+        then place the next bid.
+
+        A customer the archive still has up for bid is bid on as usual; if
+        the server has already taken a bid on them (so the result was lost)
+        they are abandoned. If the server is holding a user the archive never
+        recorded, there is nothing to base a bid on, so they are given a bid
+        of zero through the emergency user_id path to free the session.
+        Returns the result of the last bid placed, or the server's failure.
+        """
+        qr = self._qr
+        if qr.store.pending is not None:
+            res = self.place_bid(self.compute_bid())
+            if res['result'] != 'failure':
+                return res
+            ## The server took our bid before we stopped and the result is
+            ## lost; this attempt doesn't count as a bid
+            self._timestep -= 1
+            qr.abandon_pending()
+
+        user = qr.get_next_user()
+        if user['result'] == 'failure' and user.get('user_id') is not None:
+            qr.place_bid(0.0, user_id = user['user_id'])
+            user = qr.get_next_user()
+        if user['result'] == 'failure':
+            return user
+        return self.place_bid(self.compute_bid())
+    #END
+
+    def compute_bid(self):
+        """
+        Work out the bid for the user currently up for bid (without placing it).
+        """
+        raise NotImplementedError
+
     def execute_bid(self):
         raise NotImplementedError
 
@@ -84,125 +191,247 @@ class AnnealingBidder(Bidder):
     'simulated annealing.'
     """
     
-    def __init__(self, purchase_model, querent, timescale = 500, initial_increment = 0.50, minimum_increment = 0.01, bids_performed = 0):
+    def __init__(self, purchase_model, querent, timescale = 500, initial_increment = 0.50, minimum_increment = 0.01, bids_performed = 0,
+                 discount = 0.9, rng = None, resume = False, segments = False, budget = None, default_fraction = 0.5):
         """
+        discount scales the max_bid() ceiling on every bid. rng is a
+        numpy.random.Generator used for all of the bidder's random choices;
+        pass a seeded one for reproducible runs.
+
+        With segments = True bids are decided from the running outcomes of
+        the user's demographic segment (see segments.SegmentStats) instead of
+        their nearest neighbours, wherever the segment has enough history.
+
+        budget is a time limit in seconds for working out each bid. The
+        bid is decided by the first tier that fits in what is left of it:
+        the nearest-neighbour comps, then the user's segment statistics
+        (when the segment has enough history), then default_fraction of
+        the max_bid() ceiling. Whether the comps fit is judged from how
+        long recent lookups took (see _affordable()). The tier that decided
+        each bid is archived with it (the 'tier' column of the customers).
+
+        With resume = True the annealing schedule (time step, increments,
+        discount and random state) is restored from the querent's archive,
+        if it holds one from an AnnealingBidder, instead of starting from
+        the arguments; call resume() to settle any bid left outstanding.
         """
         self._timescale = timescale
+        self._discount = discount
+        self._segments = segments
+        self._rng = rng if rng is not None else np.random.default_rng()
         self._increment = initial_increment
         self._min_inc = minimum_increment
         self._timestep = bids_performed
         self._qr = querent
         self._mod = purchase_model
+        self._budget = budget
+        self._default_fraction = default_fraction
+        ## Smoothed cost of a comps lookup and its mean deviation, in seconds
+        self._comps_cost = None
+        self._comps_dev = 0.0
+        if resume:
+            self.restore(querent.bidder_state)
 
         ## We need a minimum of 10 items in the customers table in order for
         ## NearestNeighbors to not throw an error, so if it is lacking that
         ## number, we just bid without really looking. The Querent class keeps
         ## track of everything for us.
-        while self._qr.customers.shape[0] < 7:
+        while len(self._qr.store) < 7:
             usr = self._qr.get_next_user()
             b = self.bid_increment()
             res = self.place_bid(b)
         
+        ## The scorer, comps index and segment statistics are built now, so
+        ## no bid has to wait for them (or have the build counted as a lookup)
+        if budget is not None:
+            self.scorer()
+            self._qr.comps_index
+            self._qr.segment_stats
     #END
     
+    def state(self):
+        state = super().state()
+        state.update(
+            timescale = self._timescale,
+            increment = self._increment,
+            minimum_increment = self._min_inc,
+            discount = self._discount,
+            rng = self._rng.bit_generator.state,
+        )
+        return state
+    #END
+
+    def restore(self, state):
+        if not super().restore(state):
+            return False
+        self._timescale = state['timescale']
+        self._increment = state['increment']
+        self._min_inc = state['minimum_increment']
+        self._discount = state['discount']
+        self._rng.bit_generator.state = state['rng']
+        return True
+    #END
+
     def temperature(self):
         """
         Get the 'temperature' of the search for the purposes of simulated annealing.
         """
-        t = (self._timescale - self._timestep)/self._timescale
-        return t if t > 0 else 0
+        return policies.temperature(self._timestep, self._timescale)
 
     def bid_increment(self):
         """
         Get the amount that the next bid should be incremented by.
         """
-        b = self._increment * self.temperature()
-        return b if b > self._min_inc else self._min_inc
+        return policies.increment(self.temperature(), self._increment, self._min_inc)
 
     
+    @timed('bidder.execute_bid')
     def execute_bid(self):
         """
         Workhorse method that fetches a new user, computes a bid based on the
         class's strategy, and submits that bid.
         """
-
-        ## First we do the overhead computations needed for all bids we make:
         user = self._qr.get_next_user()
-        user_feat = utils.frame_to_features(user)
-        #score = self._mod.predict_proba(user_feat)[:,1][0]
-        score = self.purchase_probability(user_feat)
-        bound = self.max_bid(score, discount = 0.9)
-        comps = self._qr.get_comps().sort_values(['bid'], ascending = False)
+        self.place_bid(self.compute_bid())
+    #END
 
-        wins = comps.loc[comps.win == True, :]
-        losses = comps.loc[~(comps.win == True), :]
-
-        ## Case 1: All too low
-        ## Start with the case which will probably be the majority case
-        ## early on in the bidding process: all bids for comperable users
-        ## have failed, presumably because they are too low.
-        if not any(comps.win):
-            top_bid = comps.iloc[0].bid
-            new_bid = top_bid + self.bid_increment()
-            
-            bid = new_bid if new_bid < bound else bound
-            self.place_bid(bid)
-        
-        ## Should never execute this block, but it is included in case
-        ## the Querent is initialized with odd or unexpected data
-        elif all(comps.win):
-            low_bid = comps.iloc[-1].bid
-            new_bid = low_bid - self.bid_increment()
-            bid = new_bid if new_bid < bound else bound
-            self.place_bid(bid)
-
-        ## We know for sure at this point that we have at least one win and
-        ## at least one loss. It might be the case that all the wins are
-        ## greater than all the losses, in which case we just bid in the
-        ## middle.
-        elif losses.bid.max() < wins.bid.min():
-            gap = wins.bid.min() - losses.bid.max()
-            incr = self.bid_increment()
-            if gap > incr:
-                new_bid = losses.bid.max() + incr
-            else:
-                new_bid = gap*random() + losses.bid.max()
-            
-            bid = new_bid if new_bid < bound else bound
-            self.place_bid(bid)
-
-        ## This leaves us with the final (and most complicated) situaiton:
-        ## we know for sure we have a mixed region of wins and losses that
-        ## we must sort through to decide where to place our bid.
+    def compute_bid(self):
+        """
+        Work out the bid for the user currently up for bid (without placing it).
+        """
+
+        ## First we do the overhead computations needed for all bids we make:
+        start = time.perf_counter()
+        instruments = self.instruments
+        with instruments.timer('bidder.encode'):
+            user_feat = self._qr.store.features(self._qr.store.pending)
+        with instruments.timer('bidder.score'):
+            #score = self._mod.predict_proba(user_feat)[:,1][0]
+            score = self.purchase_probability(user_feat)
+            bound = self.max_bid(score, discount = self._discount)
+        ## With segments on, a segment with enough history answers in
+        ## constant time; sparse ones fall back to the nearest neighbours.
+        stats = None
+        tier = None
+        if self._segments:
+            stats = self._segment_lookup(user_feat)
+            tier = 'segment'
+        ## A retention policy or a young archive can leave too few comps
+        ## to look up; the user's segment or the default decides instead
+        if stats is None and len(self._qr.comps_index) >= 6 and self._affordable(start):
+            comps_start = time.perf_counter()
+            with instruments.timer('bidder.comps'):
+                stats = self.comps_stats(user_feat)
+            self._observe_comps_cost(time.perf_counter() - comps_start)
+            tier = 'knn'
+        elif stats is None and not self._segments:
+            stats = self._segment_lookup(user_feat)
+            tier = 'segment'
+
+        if stats is None:
+            tier = 'default'
+            bid = self._default_fraction * bound
+            self.last_decision = None
         else:
-            smallest_win = wins.bid.min()
-            highest_loss = losses.bid.max()
-            gap = highest_loss - smallest_win
-            if gap < self.bid_increment():
-                # The difference is so small we don't really care
-                new_bid = random()*gap + smallest_win
-            else:
-                # Bigger difference... probably means that there aren't really
-                # enough comps yet and so the ones being returned are not truly
-                # that close to what we are looking at, or that there is an
-                # outlier.
-                #
-                # In either case, we should be fine to try and make a bid
-                # that is close to the two smallest winning bids (or just close
-                # to the singel win if that is all we have)
-                low_end = smallest_win
-                if wins.shape[0] > 1:
-                    high_end = min(wins.iloc[-2].bid, (low_end + self.bid_increment()))
-                else:
-                    high_end = self.bid_increment()
-                new_bid = random()*(high_end - low_end) + low_end
-            
-            bid = new_bid if new_bid < bound else bound
-            self.place_bid(bid)
-                
-        #END if
-    ## By this point one of the branches should have picked a bid and placed it
-    #END execute_bid()
+            ## Kept for anyone evaluating other strategies on the same user
+            ## (see shadow.ShadowEvaluator)
+            self.last_decision = {'features': user_feat, 'prob': score, 'bound': bound, 'stats': stats,
+                                  'increment': self.bid_increment()}
+            with instruments.timer('bidder.decide'):
+                bid = self.decide_from_stats(bound, stats)
+
+        self.last_tier = tier
+        instruments.count('bidder.tier.' + tier)
+        if self._budget is not None and time.perf_counter() - start > self._budget:
+            instruments.count('bidder.over_budget')
+        return bid
+    #END
+
+    def comps_stats(self, user_feat, n = 6):
+        """
+        The summary of the user's n nearest comps that decide_from_stats()
+        takes, straight from the comps index and the store's columns: a
+        comps data frame (as get_comps() builds for a notebook) would cost
+        more than the rest of the bid put together.
+        """
+        store = self._qr.store
+        pos = self._qr.comps_index.query(user_feat, n = n).astype(int)
+        return tuple(a[0] for a in policies.summarize(store.column('bid')[pos][None, :],
+                                                      store.column('win')[pos][None, :]))
+    #END
+
+    def _segment_lookup(self, user_feat):
+        """
+        The user's segment statistics, or None if the segment is too sparse.
+        """
+        with self.instruments.timer('bidder.segment'):
+            stats = self._qr.segment_stats.lookup(user_feat)
+        self.instruments.count('bidder.segment_hits' if stats is not None else 'bidder.segment_misses')
+        return stats
+    #END
+
+    def _affordable(self, start):
+        """
+        Whether a comps lookup is expected to finish within the budget of a
+        bid started at start. The expected cost is the smoothed lookup time
+        plus four times its mean deviation (as TCP estimates round trips),
+        so a lookup is only tried when it should fit nearly every time.
+        Each time one is skipped the estimate is relaxed a little, so the
+        comps get tried again once the archive has got quicker.
+        """
+        if self._budget is None or self._comps_cost is None:
+            return True
+        remaining = self._budget - (time.perf_counter() - start)
+        if self._comps_cost + 4 * self._comps_dev <= remaining:
+            return True
+        self._comps_cost *= 0.99
+        self._comps_dev *= 0.99
+        return False
+    #END
+
+    def _observe_comps_cost(self, seconds):
+        if self._comps_cost is None:
+            self._comps_cost = seconds
+            self._comps_dev = seconds / 2
+            return
+        self._comps_dev += 0.25 * (abs(seconds - self._comps_cost) - self._comps_dev)
+        self._comps_cost += 0.125 * (seconds - self._comps_cost)
+    #END
+
+    def decide(self, bound, comps):
+        """
+        Pick a bid no higher than bound from the outcomes of bids on comparable
+        users.
+        """
+        return self.decide_from_stats(bound, self.summarize_comps(comps))
+
+    @staticmethod
+    def summarize_comps(comps):
+        """
+        The summary of a comps data frame that decide_from_stats() takes.
+        """
+        bids = comps['bid'].to_numpy(dtype = np.float64)
+        won = comps['win'].to_numpy(dtype = bool, na_value = False)
+        return tuple(a[0] for a in policies.summarize(bids[None, :], won[None, :]))
+    #END
+
+    def decide_from_stats(self, bound, stats):
+        """
+        Pick a bid no higher than bound given a summary of the outcomes of
+        bids on comparable users: (number of wins, number of losses, highest
+        losing bid, lowest winning bid, second lowest winning bid), as
+        returned by segments.SegmentStats.lookup().
+
+        The rule itself is policies.anneal(), which covers four cases:
+        all comps lost (bid a step above the highest), all won (a step
+        below the lowest), every win above every loss (step up into the
+        gap, or pick a random point in it if it is narrower than a step),
+        and wins and losses mixed (a random bid near the lowest wins).
+        """
+        stats = [np.reshape(a, 1) for a in stats]
+        return float(policies.anneal([bound], self.bid_increment(), stats, self._rng)[0])
+    #END
+
     
 #END class
 
@@ -224,8 +453,8 @@ class DiscountingBidder(Bidder):
         """
         ## First we do the overhead computations needed for all bids we make:
         user = self._qr.get_next_user()
-        user_feat = utils.frame_to_features(user)
-        score = self._mod.predict_proba(user_feat)[:,1][0]
+        user_feat = self._qr.store.features(self._qr.store.pending)
+        score = self.purchase_probability(user_feat)
         #bound = self.max_bid(score)
         comps = self._qr.get_comps().sort_values(['bid'], ascending = False)
 
@@ -288,13 +517,14 @@ class MultiStratBidder(Bidder):
         """
         
         ## Step 0: Initialization
+        from sklearn.neighbors import NearestNeighbors
         previous_feat = utils.frame_to_features(self.qr.customers)
         nb = NearestNeighbors(n_neighbors = 10)
         
         
         
         ## Step 1: Get a user
-        user = self.qr.get_next_user()
+        user = self.qr.get_next_user(as_frame = True)
         
         ## Step 2: put the data into form for a model
         user_feat = utils.frame_to_features(user)
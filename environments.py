@@ -0,0 +1,213 @@
+import threading
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+class UserSampler:
+    """
+    Source of simulated users, drawn (with replacement) from the historic
+    past_bids.csv so they follow the same joint distribution of demographics,
+    purchases and purchase amounts. Without a csv, users are generated from
+    independent distributions matching the feature scaling in utils.
+    """
+
+    def __init__(self, past_bids_fp = None, seed = None):
+        self.rng = np.random.default_rng(seed)
+
+        if past_bids_fp is not None:
+            df = pd.read_csv(past_bids_fp)
+            df = df.fillna({'profit': 0})
+            self.day_of_week = df['day_of_week'].values.astype(object)
+            self.gender = df['gender'].values.astype(object)
+            self.marital_status = df['marital_status'].values.astype(object)
+            self.age = df['age'].values
+            self.income = df['income'].values
+            self.purchase = df['purchase'].values.astype(bool)
+            self.revenue = df['profit'].values.astype(np.float64)
+        else:
+            n = 50000
+            self.day_of_week = np.array(utils.DAYS, dtype = object)[self.rng.integers(0, 7, n)]
+            self.gender = np.array(['F', 'M'], dtype = object)[self.rng.integers(0, 2, n)]
+            self.marital_status = np.array(['S', 'M'], dtype = object)[self.rng.integers(0, 2, n)]
+            self.age = np.clip(np.round(self.rng.normal(utils.AGE_MEAN, utils.AGE_STD, n)), 18, 90).astype(np.int64)
+            self.income = np.clip(np.round(self.rng.normal(utils.INCOME_MEAN, utils.INCOME_STD, n)), 10000, None).astype(np.int64)
+            self.purchase = self.rng.random(n) < 0.27
+            self.revenue = np.where(self.purchase, self.rng.uniform(5, 15, n), 0.0)
+
+        self.features = utils.encode_arrays(
+            pd.Categorical(self.day_of_week, categories = utils.DAYS).codes,
+            self.gender == 'F',
+            self.marital_status == 'M',
+            self.age,
+            self.income
+        )
+    #END
+
+    def __len__(self):
+        return self.age.shape[0]
+
+    def sample(self, n = None):
+        """
+        Row numbers of n randomly drawn users (or a single row number).
+        """
+        return self.rng.integers(0, len(self), n)
+
+    def record(self, row):
+        """
+        The demographic fields of one user, as the server would send them.
+        """
+        return {
+            'day_of_week': self.day_of_week[row],
+            'gender': self.gender[row],
+            'marital_status': self.marital_status[row],
+            'age': self.age[row].item(),
+            'income': self.income[row].item(),
+        }
+    #END
+
+#END class
+
+
+class ConstantAdversary:
+    """
+    Adversary that bids the same amount on everybody.
+    """
+
+    def __init__(self, amount = 1.0):
+        self.amount = amount
+
+    def bids(self, features, rng):
+        """
+        The adversary's bid on each row of a feature matrix.
+        """
+        return np.full(features.shape[0], self.amount)
+
+#END class
+
+
+class LinearAdversary:
+    """
+    Adversary whose bid is a fixed linear function of the user's features plus
+    a little noise, so that (as with the real adversary) some demographics
+    are consistently cheaper to win than others.
+    """
+
+    def __init__(self, weights = None, intercept = 1.1, noise = 0.05, floor = 0.0):
+        if weights is None:
+            ## Cheap on weekends, dearer for women, married users and the
+            ## better off
+            weights = [-0.2, 0.05, 0.05, 0.05, 0.05, 0.1, -0.2, 0.15, 0.1, 0.0, 0.2]
+        self.weights = np.asarray(weights, dtype = np.float64)
+        self.intercept = intercept
+        self.noise = noise
+        self.floor = floor
+    #END
+
+    def bids(self, features, rng):
+        b = features @ self.weights + self.intercept
+        if self.noise > 0:
+            b = b + rng.normal(0, self.noise, features.shape[0])
+        return np.maximum(b, self.floor)
+    #END
+
+#END class
+
+
+class BiddingEnvironment:
+    """
+    In-process implementation of the bidding server's protocol.
+
+    Each API key gets its own session holding at most one pending user, as on
+    the real server: get_next_user() fails while a bid is outstanding, and
+    submit_bid() only accepts the pending user's id. A bid wins if it beats
+    the adversary's bid for that user; the winner pays its bid, and 'profit'
+    in the response is the user's purchase amount (as in past_bids.csv).
+    Methods take and return the same dicts as the JSON API, and are safe to
+    call from several threads. User indexes are handed out from first_index
+    upwards.
+    """
+
+    def __init__(self, sampler = None, adversary = None, seed = None, first_index = 1):
+        self.sampler = sampler if sampler is not None else UserSampler(seed = seed)
+        self.adversary = adversary if adversary is not None else LinearAdversary()
+        self.rng = np.random.default_rng(seed)
+        self._sessions = {}
+        self._next_index = first_index - 1
+        self._lock = threading.Lock()
+    #END
+
+    def _session(self, api_key):
+        session = self._sessions.get(api_key)
+        if session is None:
+            session = {'pending': None, 'bids': 0, 'wins': 0, 'purchases': 0, 'spend': 0.0, 'revenue': 0.0}
+            self._sessions[api_key] = session
+        return session
+    #END
+
+    def get_next_user(self, payload):
+        with self._lock:
+            session = self._session(payload.get('api_key'))
+            if session['pending'] is not None:
+                return {
+                    'result': 'failure',
+                    'message': 'A bid must be placed on the current user before requesting another.',
+                    'user_id': session['pending']['user_id'],
+                }
+
+            row = self.sampler.sample()
+            self._next_index += 1
+            user = self.sampler.record(row)
+            user['user_index'] = self._next_index
+            user['user_id'] = '{:x}'.format(self.rng.integers(0, 2**63))
+            user['result'] = 'success'
+
+            session['pending'] = {'user_id': user['user_id'], 'row': row}
+            return user
+    #END
+
+    def submit_bid(self, payload):
+        with self._lock:
+            session = self._session(payload.get('api_key'))
+            pending = session['pending']
+            if pending is None or payload.get('user_id') != pending['user_id']:
+                return {'result': 'failure', 'message': 'No user with that user_id is up for bid.'}
+            try:
+                bid = float(payload['bid_amount'])
+            except (KeyError, TypeError, ValueError):
+                return {'result': 'failure', 'message': 'bid_amount must be a number.'}
+
+            row = pending['row']
+            adversary_bid = self.adversary.bids(self.sampler.features[row:row + 1], self.rng)[0]
+            win = bool(bid > adversary_bid)
+            purchase = bool(win and self.sampler.purchase[row])
+            revenue = float(self.sampler.revenue[row]) if purchase else 0.0
+
+            session['pending'] = None
+            session['bids'] += 1
+            if win:
+                session['wins'] += 1
+                session['spend'] += bid
+            if purchase:
+                session['purchases'] += 1
+                session['revenue'] += revenue
+
+            return {'result': 'success', 'win': win, 'purchase': purchase, 'profit': revenue}
+    #END
+
+    def how_am_i_doing(self, payload):
+        with self._lock:
+            session = self._session(payload.get('api_key'))
+            return {
+                'result': 'success',
+                'bids': session['bids'],
+                'wins': session['wins'],
+                'purchases': session['purchases'],
+                'spend': session['spend'],
+                'revenue': session['revenue'],
+                'profit': session['revenue'] - session['spend'],
+            }
+    #END
+
+#END class
@@ -0,0 +1,129 @@
+"""
+A fleet of bidding workers pooling what they learn in one shared archive.
+
+Each worker is a separate process with its own API key (so its own server
+session and customer up for bid) and its own AnnealingBidder, and all of
+them archive to the same archives.SharedArchive. Every worker sees the
+others' bid results as comps within about max_staleness seconds (plus one
+group commit), so bidding scales across cores without splitting the
+history:
+
+    python fleet.py --model purchase_model.pkl --archive fleet.sqlite \\
+        --api-key KEY1 --api-key KEY2 --api-key KEY3 --bids 1000
+
+Restarting with the same archive and keys resumes every worker where it
+stopped.
+"""
+import pickle
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import bidders
+from archives import SharedArchive
+from querents import Querent, LocalQuerent
+
+
+def run_worker(archive_fp, api_key, model, n_bids, base_url = None, environment = None, bidder_kwargs = None,
+               querent_kwargs = None, archive_kwargs = None):
+    """
+    Place n_bids bids as the worker for api_key and return its progress as
+    the server reports it. environment, if given, is a callable returning
+    an environments.BiddingEnvironment to bid against instead of the server
+    (it is called in the worker process).
+    """
+    shared = SharedArchive(archive_fp, api_key, **(archive_kwargs or {}))
+    querent_kwargs = dict(querent_kwargs or {}, shared_archive = shared)
+    if environment is not None:
+        qr = LocalQuerent(None, api_key, environment(), **querent_kwargs)
+    else:
+        qr = Querent(None, api_key, base_url = base_url, **querent_kwargs)
+
+    bidder = bidders.AnnealingBidder(model, qr, resume = True, **(bidder_kwargs or {}))
+    if qr.store.pending is not None:
+        bidder.resume()
+        n_bids -= 1
+    bidder.execute_bids(max(n_bids, 0))
+
+    progress = qr.get_progress()
+    result = {
+        'worker': api_key,
+        'timestep': bidder._timestep,
+        'archive_customers': len(qr.store),
+        'progress': progress,
+    }
+    qr.close()
+    return result
+#END
+
+
+class Fleet:
+    """
+    Runs one worker process per API key, all archiving to the SQLite
+    database at archive_fp. bidder_kwargs, querent_kwargs and
+    archive_kwargs are passed on to every worker's AnnealingBidder,
+    Querent and SharedArchive (e.g. querent_kwargs = {'max_staleness':
+    0.5}). For offline runs, environment(i) should return the i'th worker's
+    environments.BiddingEnvironment; since each worker then has its own,
+    they should hand out disjoint user_indexes (see first_index). Indexes
+    repeated from an earlier run are fine: those customers are archived
+    under local keys (see Querent.get_next_user).
+    """
+
+    def __init__(self, archive_fp, api_keys, model, base_url = None, environment = None, bidder_kwargs = None,
+                 querent_kwargs = None, archive_kwargs = None):
+        self.archive_fp = archive_fp
+        self.api_keys = list(api_keys)
+        self.model = model
+        self.base_url = base_url
+        self.environment = environment
+        self.bidder_kwargs = bidder_kwargs
+        self.querent_kwargs = querent_kwargs
+        self.archive_kwargs = archive_kwargs
+    #END
+
+    def run(self, n_bids):
+        """
+        Have every worker place n_bids bids, and return their results (see
+        run_worker) in the order of api_keys.
+        """
+        ## The database is created up front so workers don't race to do it
+        SharedArchive(self.archive_fp, None).close()
+        with ProcessPoolExecutor(max_workers = len(self.api_keys)) as pool:
+            futures = [
+                pool.submit(
+                    run_worker, self.archive_fp, api_key, self.model, n_bids, self.base_url,
+                    functools.partial(self.environment, i) if self.environment is not None else None,
+                    self.bidder_kwargs, self.querent_kwargs, self.archive_kwargs
+                )
+                for i, api_key in enumerate(self.api_keys)
+            ]
+            return [future.result() for future in futures]
+    #END
+
+#END class
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Bid with several workers sharing one archive.')
+    parser.add_argument('--model', required = True, help = 'pickled purchase model')
+    parser.add_argument('--archive', required = True, help = 'SQLite database shared by the workers')
+    parser.add_argument('--api-key', action = 'append', required = True, dest = 'api_keys',
+                        help = 'one per worker')
+    parser.add_argument('--bids', type = int, default = 100, help = 'bids per worker')
+    parser.add_argument('--base-url', default = None)
+    parser.add_argument('--max-staleness', type = float, default = 1.0,
+                        help = 'seconds between folding in the other workers\' results')
+    args = parser.parse_args()
+
+    with open(args.model, 'rb') as fh:
+        model = pickle.load(fh)
+    fleet = Fleet(args.archive, args.api_keys, model, base_url = args.base_url,
+                  querent_kwargs = {'max_staleness': args.max_staleness})
+    for result in fleet.run(args.bids):
+        print(result['worker'], result['progress'])
+#END
+
+
+if __name__ == '__main__':
+    main()
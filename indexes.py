@@ -0,0 +1,173 @@
+import numpy as np
+
+
+class CompsIndex:
+    """
+    Exact nearest-neighbour index over archived customer features that can be
+    grown one customer at a time.
+
+    Points live in two places: a KD-tree built over the bulk of the archive,
+    and a small brute-force buffer of the customers added since that tree was
+    built. A query asks both for their k nearest and merges the results, so
+    it returns the same neighbours a freshly fit NearestNeighbors would.
+    When the buffer outgrows rebuild_fraction of the tree (bounded by
+    min_buffer and max_buffer) the tree is rebuilt over everything, which
+    keeps the amortized insert cost low and the buffer scan short.
+
+    Customers can also be removed (e.g. by a retention policy). Removal from
+    the tree only marks the label as dead, and queries skip dead labels;
+    once as many are dead as the buffer may hold, the tree is rebuilt
+    without them.
+    """
+
+    def __init__(self, n_features, min_buffer = 256, max_buffer = 8192, rebuild_fraction = 0.05):
+        self.n_features = n_features
+        self.min_buffer = min_buffer
+        self.max_buffer = max_buffer
+        self.rebuild_fraction = rebuild_fraction
+
+        self._tree = None
+        self._tree_points = np.empty((0, n_features))
+        self._tree_labels = np.empty(0, dtype = object)
+
+        self._buf_points = np.empty((max_buffer, n_features))
+        self._buf_labels = np.empty(max_buffer, dtype = object)
+        self._buf_n = 0
+        self._dead = set()
+    #END
+
+    def __len__(self):
+        return self._tree_points.shape[0] - len(self._dead) + self._buf_n
+
+    def fit(self, points, labels):
+        """
+        Replace the contents of the index with the given points (one row per
+        customer) and their labels.
+        """
+        self._tree_points = np.asarray(points, dtype = np.float64).reshape(-1, self.n_features)
+        self._tree_labels = np.asarray(labels, dtype = object)
+        self._buf_n = 0
+        self._dead = set()
+        self._build()
+        return self
+    #END
+
+    def add(self, point, label):
+        """
+        Add a single customer to the index.
+        """
+        if self._buf_n >= self._buffer_limit():
+            self._rebuild()
+        self._buf_points[self._buf_n] = point
+        self._buf_labels[self._buf_n] = label
+        self._buf_n += 1
+    #END
+
+    def remove(self, label):
+        """
+        Remove the customer with the given label, which must be in the index.
+        """
+        slot = np.flatnonzero(self._buf_labels[:self._buf_n] == label)
+        if slot.shape[0] > 0:
+            last = self._buf_n - 1
+            slot = slot[0]
+            self._buf_points[slot] = self._buf_points[last]
+            self._buf_labels[slot] = self._buf_labels[last]
+            self._buf_labels[last] = None
+            self._buf_n = last
+            return
+        self._dead.add(label)
+        if len(self._dead) > self._buffer_limit():
+            self._rebuild()
+    #END
+
+    def query(self, point, n = 6):
+        """
+        Return the labels of the n customers closest to point, nearest first.
+        """
+        point = np.asarray(point, dtype = np.float64).reshape(1, -1)
+        if len(self) < n:
+            raise ValueError('Expected n <= number of indexed customers ({}), got {}'.format(len(self), n))
+
+        dist = []
+        labels = []
+        if self._tree is not None:
+            n_tree = self._tree_points.shape[0]
+            k = min(n + min(n, len(self._dead)), n_tree)
+            while True:
+                d, ind = self._tree.query(point, k = k)
+                d, found = d[0], self._tree_labels[ind[0]]
+                if self._dead:
+                    live = np.array([label not in self._dead for label in found], dtype = bool)
+                    d, found = d[live], found[live]
+                ## Ask for more if dead labels crowded out the live ones
+                if found.shape[0] >= min(n, n_tree - len(self._dead)) or k == n_tree:
+                    break
+                k = min(4 * k, n_tree)
+            dist.append(d)
+            labels.append(found)
+        if self._buf_n > 0:
+            diff = self._buf_points[:self._buf_n] - point
+            d = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            dist.append(d)
+            labels.append(self._buf_labels[:self._buf_n])
+
+        dist = np.concatenate(dist)
+        labels = np.concatenate(labels)
+        if dist.shape[0] > n:
+            keep = np.argpartition(dist, n - 1)[:n]
+            dist = dist[keep]
+            labels = labels[keep]
+        order = np.argsort(dist, kind = 'stable')
+
+        return labels[order]
+    #END
+
+    def query_batch(self, points, n = 6):
+        """
+        query() for every row of points at once: an (n_points, n) array of
+        labels, each row nearest first. The buffer is folded into the tree
+        first, so the whole batch is answered by the tree. (Customers at
+        exactly the same distance can come back in a different order than
+        query() gave before the fold.)
+        """
+        points = np.asarray(points, dtype = np.float64).reshape(-1, self.n_features)
+        if len(self) < n:
+            raise ValueError('Expected n <= number of indexed customers ({}), got {}'.format(len(self), n))
+        if self._buf_n > 0 or self._dead:
+            self._rebuild()
+        d, ind = self._tree.query(points, k = n)
+        return self._tree_labels[ind]
+    #END
+
+    def _buffer_limit(self):
+        limit = int(self.rebuild_fraction * self._tree_points.shape[0])
+        return min(self.max_buffer, max(self.min_buffer, limit))
+
+    def _rebuild(self):
+        """
+        Fold the buffer into the tree, dropping dead labels.
+        """
+        if self._dead:
+            live = np.array([label not in self._dead for label in self._tree_labels], dtype = bool)
+            self._tree_points = self._tree_points[live]
+            self._tree_labels = self._tree_labels[live]
+            self._dead = set()
+        self._tree_points = np.concatenate([self._tree_points, self._buf_points[:self._buf_n]])
+        self._tree_labels = np.concatenate([self._tree_labels, self._buf_labels[:self._buf_n]])
+        self._buf_labels[:self._buf_n] = None
+        self._buf_n = 0
+        self._build()
+    #END
+
+    def _build(self):
+        ## sklearn is slow to import, so it is only loaded once a tree is
+        ## actually built
+        from sklearn.neighbors import KDTree
+        if self._tree_points.shape[0] > 0:
+            self._tree = KDTree(self._tree_points)
+        else:
+            self._tree = None
+    #END
+
+#END class
@@ -0,0 +1,260 @@
+import os
+import json
+import math
+import time
+import logging
+import functools
+
+
+class Histogram:
+    """
+    Streaming histogram of positive values (e.g. durations in seconds), using
+    logarithmic buckets so that percentiles are accurate to within about
+    `precision` (relative) in constant memory.
+    """
+
+    def __init__(self, precision = 0.05):
+        self._log_growth = math.log1p(precision)
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+    #END
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        b = int(math.log(value) / self._log_growth) if value > 0 else None
+        self._buckets[b] = self._buckets.get(b, 0) + 1
+    #END
+
+    def percentile(self, q):
+        """
+        Approximate q'th percentile (0-100).
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q / 100 * self.count
+        seen = 0
+        for b in sorted(self._buckets, key = lambda b: -math.inf if b is None else b):
+            seen += self._buckets[b]
+            if seen >= rank:
+                if b is None:
+                    return 0.0
+                value = math.exp((b + 0.5) * self._log_growth)
+                return min(max(value, self.min), self.max)
+        return self.max
+    #END
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else math.nan,
+            'min': self.min if self.count else math.nan,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else math.nan,
+        }
+    #END
+
+#END class
+
+
+class Stats:
+    """
+    Subscriber that keeps counters and a histogram per timer in memory.
+    """
+
+    def __init__(self, precision = 0.05):
+        self.precision = precision
+        self.counters = {}
+        self.timers = {}
+    #END
+
+    def on_count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def on_timing(self, name, seconds):
+        hist = self.timers.get(name)
+        if hist is None:
+            hist = self.timers[name] = Histogram(self.precision)
+        hist.add(seconds)
+    #END
+
+    def snapshot(self):
+        """
+        Current counters and timer summaries (seconds) as plain dicts.
+        """
+        return {
+            'counters': dict(self.counters),
+            'timers': {name: hist.summary() for name, hist in self.timers.items()},
+        }
+    #END
+
+#END class
+
+
+class LogSubscriber:
+    """
+    Subscriber that writes a log line for every timing and count.
+    """
+
+    def __init__(self, logger = None, level = logging.DEBUG):
+        self.logger = logger or logging.getLogger('bid2win')
+        self.level = level
+
+    def on_count(self, name, n):
+        self.logger.log(self.level, 'count %s +%d', name, n)
+
+    def on_timing(self, name, seconds):
+        self.logger.log(self.level, 'timer %s %.6fs', name, seconds)
+
+#END class
+
+
+class JsonDumpSubscriber(Stats):
+    """
+    Stats that also write their snapshot to a JSON file every `interval`
+    seconds (checked as events arrive, so no extra thread is needed).
+    """
+
+    def __init__(self, fp, interval = 10.0, precision = 0.05):
+        super().__init__(precision)
+        self.fp = fp
+        self.interval = interval
+        self._last_dump = time.monotonic()
+    #END
+
+    def on_count(self, name, n):
+        super().on_count(name, n)
+        self._maybe_dump()
+
+    def on_timing(self, name, seconds):
+        super().on_timing(name, seconds)
+        self._maybe_dump()
+
+    def _maybe_dump(self):
+        if time.monotonic() - self._last_dump >= self.interval:
+            self.dump()
+
+    def dump(self):
+        snap = self.snapshot()
+        snap['time'] = time.time()
+        tmp_fp = self.fp + '.tmp'
+        with open(tmp_fp, 'w') as fh:
+            json.dump(snap, fh)
+        os.replace(tmp_fp, self.fp)
+        self._last_dump = time.monotonic()
+    #END
+
+#END class
+
+
+class _Timer:
+    """
+    Context manager that reports the time spent inside it.
+    """
+
+    __slots__ = ('_instruments', '_name', '_start')
+
+    def __init__(self, instruments, name):
+        self._instruments = instruments
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._instruments.observe(self._name, time.perf_counter() - self._start)
+        return False
+
+#END class
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+#END class
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    """
+    Fan-out point for timings and counters from the Querent and Bidders.
+
+    Timers use the monotonic perf_counter clock. With no subscribers
+    attached, instrumentation is disabled: timer() hands back a shared no-op
+    context manager and count()/observe() return immediately, so the hooks
+    cost next to nothing.
+    """
+
+    def __init__(self, *subscribers):
+        self.subscribers = list(subscribers)
+        self.enabled = bool(self.subscribers)
+    #END
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        self.enabled = True
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+        self.enabled = bool(self.subscribers)
+
+    def timer(self, name):
+        """
+        Context manager timing a block of code under name.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        for sub in self.subscribers:
+            sub.on_timing(name, seconds)
+
+    def count(self, name, n = 1):
+        if not self.enabled:
+            return
+        for sub in self.subscribers:
+            sub.on_count(name, n)
+
+#END class
+
+
+def timed(name):
+    """
+    Decorator for methods of objects with an `instruments` attribute: times
+    every call under name.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            instruments = self.instruments
+            if not instruments.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                instruments.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+#END
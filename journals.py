@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import atexit
+import threading
+from pathlib import Path
+
+
+def _to_native(obj):
+    """
+    json.dumps hook for the numpy scalars that find their way into bids and
+    responses (e.g. a bid computed from a pandas column).
+    """
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+class Journal:
+    """
+    Append-only log of archive records, one JSON object per line.
+
+    Records are buffered in memory and written out as a group, either when
+    flush_every records have accumulated or when the oldest has waited
+    flush_ms milliseconds, whichever comes first (a timer commits the group
+    if no record comes along to do it). Each group is
+    fsync'ed (unless fsync = False) so a crash loses at most one group.
+    The journal is always flushed and fsync'ed on close() and at interpreter
+    exit.
+
+    After start_background() groups are committed by a background thread
+    instead, so appending a record never waits on the disk.
+    """
+
+    def __init__(self, path, flush_every = 32, flush_ms = 200, fsync = True):
+        self.path = Path(path).as_posix()
+        self.flush_every = flush_every
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._thread = None
+        self._timer = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._repair()
+        self._fh = open(self.path, 'a', encoding = 'utf-8')
+        atexit.register(self.close)
+    #END
+
+    def _repair(self):
+        """
+        Cut off a torn final line left by a crash, so that new records are not
+        glued onto the end of it.
+        """
+        if not Path(self.path).is_file():
+            return
+        with open(self.path, 'rb+') as fh:
+            ## Only look at the whole file in the (rare) case the last byte
+            ## shows it is torn.
+            if fh.seek(0, os.SEEK_END) == 0:
+                return
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) == b'\n':
+                return
+            fh.seek(0)
+            data = fh.read()
+            fh.truncate(data.rfind(b'\n') + 1)
+    #END
+
+    def append(self, record):
+        """
+        Add a record to the journal, committing the pending group if it is
+        full or old enough.
+        """
+        line = json.dumps(record, default = _to_native)
+        with self._lock:
+            self._buffer.append(line)
+            full = len(self._buffer) >= self.flush_every
+            first = len(self._buffer) == 1
+
+        if self._thread is not None:
+            if full:
+                self._wake.set()
+            return
+
+        elapsed_ms = (time.monotonic() - self._last_flush) * 1000
+        if full or elapsed_ms >= self.flush_ms:
+            self.flush()
+        elif first:
+            ## Commit this group in flush_ms even if nothing else is appended
+            timer = threading.Timer(self.flush_ms / 1000, self.flush)
+            timer.daemon = True
+            with self._lock:
+                self._cancel_timer()
+                self._timer = timer
+            timer.start()
+    #END
+
+    def _cancel_timer(self):
+        ## Call with _lock held
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+    #END
+
+    def flush(self):
+        """
+        Write all buffered records to disk as a single group.
+        """
+        with self._io_lock:
+            with self._lock:
+                lines = self._buffer
+                self._buffer = []
+                self._cancel_timer()
+            if self._fh is None:
+                return
+            if lines:
+                self._fh.write('\n'.join(lines) + '\n')
+                self._fh.flush()
+                if self.fsync:
+                    os.fsync(self._fh.fileno())
+            self._last_flush = time.monotonic()
+    #END
+
+    def start_background(self):
+        """
+        Hand group commits over to a background thread, which writes a group
+        every flush_ms milliseconds (or sooner once flush_every records are
+        waiting).
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            self._cancel_timer()
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, name = 'journal-flush', daemon = True)
+        self._thread.start()
+    #END
+
+    def stop_background(self):
+        """
+        Stop the background thread (committing whatever it has not yet written)
+        and go back to committing groups inline.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+    #END
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_ms / 1000)
+            self._wake.clear()
+            self.flush()
+    #END
+
+    def truncate(self):
+        """
+        Discard everything in the journal. Only call this once its contents
+        have been safely folded into a snapshot.
+        """
+        with self._io_lock:
+            with self._lock:
+                self._buffer = []
+                self._cancel_timer()
+            self._fh.truncate(0)
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+    #END
+
+    def close(self):
+        """
+        Flush any pending records, fsync and close the file.
+        """
+        if self._fh is None:
+            return
+        self.stop_background()
+        self.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        self._fh = None
+        atexit.unregister(self.close)
+    #END
+
+    def size(self):
+        """
+        Bytes committed to the journal so far (buffered records are not
+        counted, so flush first).
+        """
+        with self._io_lock:
+            return os.path.getsize(self.path)
+    #END
+
+    @staticmethod
+    def replay(path, offset = 0):
+        """
+        Yield the records stored in the journal at path, in the order they were
+        written, starting offset bytes in (e.g. a size() from earlier). A torn
+        final line (from a crash part way through a write) is ignored.
+        """
+        if not Path(path).is_file():
+            return
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    #END
+
+#END class
+
+
+class NullJournal:
+    """
+    Stand-in for a Journal that keeps nothing, for Querents with no archive.
+    """
+
+    def append(self, record):
+        pass
+
+    def flush(self):
+        pass
+
+    def start_background(self):
+        pass
+
+    def stop_background(self):
+        pass
+
+    def truncate(self):
+        pass
+
+    def size(self):
+        return 0
+
+    def close(self):
+        pass
+
+#END class
+
+
+def atomic_write_csv(df, fp):
+    """
+    Write a data frame to fp via a temporary file so a crash never leaves a
+    half-written snapshot behind.
+    """
+    tmp_fp = fp + '.tmp'
+    df.to_csv(tmp_fp)
+    with open(tmp_fp, 'rb+') as fh:
+        os.fsync(fh.fileno())
+    os.replace(tmp_fp, fp)
+#END
+
+
+def atomic_write_json(obj, fp):
+    """
+    Write obj as JSON to fp via a temporary file, like atomic_write_csv.
+    """
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'w') as fh:
+        json.dump(obj, fh, default = _to_native)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_fp, fp)
+#END
@@ -0,0 +1,193 @@
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from collections import deque
+
+from segments import SegmentStats
+from journals import Journal, NullJournal
+
+
+## Where each running total is found in a progress report from the server
+## (the production server's names first, then environments.BiddingEnvironment's)
+SERVER_FIELDS = {
+    'bids': ['total_bids', 'bids'],
+    'wins': ['bids_won', 'total_wins', 'wins'],
+    'purchases': ['total_purchases', 'purchases'],
+    'spend': ['total_amount_spent', 'spend'],
+    'revenue': ['total_profit', 'revenue'],
+}
+
+
+class Ledger:
+    """
+    Running profit and loss of a bidding session, kept locally as bid results
+    arrive instead of asking the server (see Querent.get_progress()).
+
+    It totals bids, wins, purchases, spend (the winning bids) and revenue,
+    and keeps each demographic segment's win rate over its last `window`
+    bids (segments as in segments.SegmentStats), all in constant time per
+    bid. After every bid a row with the new totals is appended to the
+    time series at fp (JSONL, group committed like journals.Journal), which
+    is read back to carry on where it left off when the ledger is reopened.
+    Given a checkpoint (a state() from earlier), only the rows written since
+    are read back, so reopening doesn't slow down as the series grows.
+    """
+
+    def __init__(self, fp = None, window = 100, flush_every = 32, flush_ms = 200, fsync = True, checkpoint = None):
+        self.fp = fp
+        self.window = window
+        self.segments = SegmentStats()
+        self.totals = {'bids': 0, 'wins': 0, 'purchases': 0, 'spend': 0.0, 'revenue': 0.0}
+        self._recent = {}
+        self._recent_wins = {}
+
+        if fp is None:
+            self.journal = NullJournal()
+        else:
+            offset = 0
+            ## A checkpoint past the end of the file belongs to some other
+            ## time series, so it is ignored
+            if checkpoint is not None and Path(fp).is_file() and Path(fp).stat().st_size >= checkpoint['offset']:
+                self.restore(checkpoint)
+                offset = checkpoint['offset']
+            for row in Journal.replay(fp, offset):
+                self.totals = {name: row[name] for name in self.totals}
+                self._count_segment(row['segment'], row['win'])
+            self.journal = Journal(fp, flush_every, flush_ms, fsync)
+    #END
+
+    def seed(self, X, bids, wins, revenues, purchases):
+        """
+        Start from past bid results instead of zero, e.g. for an archive
+        that predates its ledger: the feature matrix, bid, outcome and
+        revenue of every bid in the order they happened, and the number of
+        purchases. The segment windows are filled from the last `window`
+        bids of each segment.
+        """
+        bids = np.asarray(bids, dtype = np.float64)
+        wins = np.asarray(wins, dtype = bool)
+        self.totals = {
+            'bids': int(bids.shape[0]),
+            'wins': int(wins.sum()),
+            'purchases': int(purchases),
+            'spend': float(bids[wins].sum()),
+            'revenue': float(np.sum(revenues, dtype = np.float64)),
+        }
+        self._recent = {}
+        self._recent_wins = {}
+        if bids.shape[0] > 0:
+            for seg, win in zip(self.segments.segments(X).tolist(), wins.tolist()):
+                self._count_segment(seg, win)
+    #END
+
+    def state(self):
+        """
+        The totals and segment windows, JSON serializable, with how far into
+        the time series they go. Buffered rows are committed first.
+        """
+        self.journal.flush()
+        return {
+            'totals': dict(self.totals),
+            'recent': {str(seg): list(recent) for seg, recent in self._recent.items()},
+            'offset': self.journal.size(),
+        }
+    #END
+
+    def restore(self, state):
+        """
+        Pick up the totals and segment windows from a state().
+        """
+        self.totals = {name: state['totals'][name] for name in self.totals}
+        self._recent = {}
+        self._recent_wins = {}
+        for seg, wins in state['recent'].items():
+            recent = deque(bool(win) for win in wins[-self.window:])
+            self._recent[int(seg)] = recent
+            self._recent_wins[int(seg)] = sum(recent)
+    #END
+
+    def record(self, bid, response, x):
+        """
+        Count the result of a bid on the user with feature vector x.
+        """
+        win = response['win'] == True
+        purchase = win and response.get('purchase') == True
+        totals = self.totals
+        totals['bids'] += 1
+        if win:
+            totals['wins'] += 1
+            totals['spend'] += float(bid)
+        if purchase:
+            totals['purchases'] += 1
+            totals['revenue'] += float(response['profit'])
+        seg = self.segments.segment(x)
+        self._count_segment(seg, win)
+
+        row = {'time': time.time(), 'segment': seg, 'bid': float(bid), 'win': win}
+        row.update(totals)
+        self.journal.append(row)
+    #END
+
+    def _count_segment(self, seg, win):
+        recent = self._recent.get(seg)
+        if recent is None:
+            recent = self._recent[seg] = deque()
+            self._recent_wins[seg] = 0
+        recent.append(win)
+        self._recent_wins[seg] += win
+        if len(recent) > self.window:
+            self._recent_wins[seg] -= recent.popleft()
+    #END
+
+    def progress(self):
+        """
+        The totals so far, with profit (revenue less spend) and win rate.
+        """
+        progress = dict(self.totals)
+        progress['profit'] = progress['revenue'] - progress['spend']
+        progress['win_rate'] = progress['wins'] / progress['bids'] if progress['bids'] else np.nan
+        return progress
+    #END
+
+    def segment_win_rates(self):
+        """
+        Win rate of every segment over its last `window` bids, by segment
+        number.
+        """
+        return {seg: self._recent_wins[seg] / len(recent) for seg, recent in self._recent.items()}
+
+    def series(self):
+        """
+        The whole time series as a data frame, one row per bid. Buffered
+        rows are committed first.
+        """
+        if self.fp is None:
+            raise ValueError('This ledger keeps no time series')
+        self.journal.flush()
+        return pd.DataFrame(list(Journal.replay(self.fp)))
+    #END
+
+    def reconcile(self, server, rtol = 1e-6, atol = 1e-4):
+        """
+        Compare the totals with a progress report from the server. Returns a
+        dict of name -> (local, server) for each total that disagrees (empty
+        if they all match). Bids whose result never reached us, e.g. ones
+        left unconfirmed by a dropped connection, show up here. Totals the
+        server doesn't report (the production server has no purchase count)
+        can't be checked, and are returned as (local, None).
+        """
+        mismatches = {}
+        for name, keys in SERVER_FIELDS.items():
+            key = next((k for k in keys if k in server and server[k] is not None), None)
+            if key is None:
+                mismatches[name] = (self.totals[name], None)
+            elif not np.isclose(self.totals[name], server[key], rtol = rtol, atol = atol):
+                mismatches[name] = (self.totals[name], server[key])
+        return mismatches
+    #END
+
+    def close(self):
+        self.journal.close()
+
+#END class
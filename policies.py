@@ -0,0 +1,134 @@
+"""
+Array versions of the bidding rules, for computing many bids in one call.
+
+Everything here works on whole vectors of users (with comps given as
+(n_users, n_comps) matrices) using masked NumPy operations, and draws its
+randomness from a numpy Generator. AnnealingBidder's per-user decisions
+go through the same functions with one user at a time, so for the same
+inputs and random state a batch gives exactly the bids the bidder would.
+"""
+import numpy as np
+
+import utils
+
+
+def temperature(timestep, timescale):
+    """
+    Annealing temperature after timestep bids: falls linearly from 1 to 0
+    over timescale bids, then stays at 0.
+    """
+    return np.maximum((timescale - np.asarray(timestep, dtype = np.float64)) / timescale, 0)
+
+
+def increment(temperature, initial_increment, minimum_increment):
+    """
+    Amount to raise or lower a bid by at the given temperature.
+    """
+    return np.maximum(initial_increment * temperature, minimum_increment)
+
+
+def max_bids(probs, discount = 1.0):
+    """
+    Highest bid worth placing on users with the given purchase probabilities
+    (see Bidder.max_bid()).
+    """
+    return np.asarray(probs) * discount * utils.AVE_PURCHASE_REVENUE
+
+
+def summarize(comp_bids, comp_wins):
+    """
+    Reduce the bids and outcomes on each user's comps, as (n_users, n_comps)
+    matrices, to what anneal() needs: a tuple of arrays (n_wins, n_losses,
+    highest_loss, lowest_win, second_lowest_win). Missing values are -inf
+    (highest loss) or inf (wins).
+    """
+    comp_bids = np.asarray(comp_bids, dtype = np.float64)
+    comp_wins = np.asarray(comp_wins, dtype = bool)
+    n_wins = comp_wins.sum(axis = 1)
+    n_losses = comp_wins.shape[1] - n_wins
+    highest_loss = np.where(comp_wins, -np.inf, comp_bids).max(axis = 1, initial = -np.inf)
+    win_bids = np.where(comp_wins, comp_bids, np.inf)
+    if win_bids.shape[1] >= 2:
+        lowest_two = np.partition(win_bids, 1, axis = 1)
+        lowest_win, second_lowest_win = lowest_two[:, 0], lowest_two[:, 1]
+    else:
+        lowest_win = win_bids.min(axis = 1, initial = np.inf)
+        second_lowest_win = np.full(win_bids.shape[0], np.inf)
+    return n_wins, n_losses, highest_loss, lowest_win, second_lowest_win
+#END
+
+
+def anneal(bounds, increments, stats, rng):
+    """
+    AnnealingBidder's decision rule for many users at once. stats is a
+    summary of each user's comps as returned by summarize() (or a stack of
+    segments.SegmentStats.lookup() results); bounds and increments are each
+    user's ceiling and current step size. Returns the bids.
+
+    Users whose rule needs a random number take one each from rng, in order,
+    so a batch consumes the generator exactly as the same users bid on one
+    at a time would.
+    """
+    n_wins, n_losses, highest_loss, lowest_win, second_lowest_win = [np.asarray(a) for a in stats]
+    bounds = np.asarray(bounds, dtype = np.float64)
+    inc = np.broadcast_to(np.asarray(increments, dtype = np.float64), bounds.shape)
+
+    ## The four cases, in the order AnnealingBidder checks them: every comp
+    ## lost; every comp won; all wins above all losses; wins and losses mixed
+    none_won = n_wins == 0
+    all_won = ~none_won & (n_losses == 0)
+    separated = ~none_won & ~all_won & (highest_loss < lowest_win)
+    mixed = ~none_won & ~all_won & ~separated
+
+    with np.errstate(invalid = 'ignore', over = 'ignore'):
+        gap_up = lowest_win - highest_loss
+        gap_down = highest_loss - lowest_win
+        step_up = gap_up > inc
+        high_end = np.where(n_wins > 1, np.minimum(second_lowest_win, lowest_win + inc), inc)
+
+        u = np.zeros(bounds.shape)
+        draw = (separated & ~step_up) | mixed
+        u[draw] = rng.random(int(draw.sum()))
+
+        new_bid = np.select(
+            [none_won, all_won, separated & step_up, separated, mixed & (gap_down < inc)],
+            [highest_loss + inc, lowest_win - inc, highest_loss + inc, gap_up * u + highest_loss, u * gap_down + lowest_win],
+            default = u * (high_end - lowest_win) + lowest_win
+        )
+    return np.where(new_bid < bounds, new_bid, bounds)
+#END
+
+
+class AnnealingPolicy:
+    """
+    AnnealingBidder's strategy as a function of arrays: given users'
+    features, their comps' bids and outcomes and the time step each bid is
+    made at, return every bid at once. Uses the same parameters as
+    AnnealingBidder; scorer is a scorers.ModelScorer (or LinearScorer) for
+    the purchase model.
+    """
+
+    def __init__(self, scorer, timescale = 500, initial_increment = 0.50, minimum_increment = 0.01, discount = 0.9):
+        self.scorer = scorer
+        self.timescale = timescale
+        self.initial_increment = initial_increment
+        self.minimum_increment = minimum_increment
+        self.discount = discount
+    #END
+
+    def temperatures(self, timesteps):
+        return temperature(timesteps, self.timescale)
+
+    def bids(self, features, comp_bids, comp_wins, temperatures, rng, bounds = None):
+        """
+        Bids on the users in the rows of features, whose comps' bids and
+        outcomes are the rows of comp_bids and comp_wins. bounds are
+        computed from the purchase model unless given.
+        """
+        if bounds is None:
+            bounds = max_bids(self.scorer.score_batch(features), self.discount)
+        increments = increment(temperatures, self.initial_increment, self.minimum_increment)
+        return anneal(bounds, increments, summarize(comp_bids, comp_wins), rng)
+    #END
+
+#END class
@@ -1,10 +1,18 @@
+import time
+import zlib
 import pandas as pd
 import requests, json
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from pathlib import Path
 
-from sklearn.neighbors import NearestNeighbors
-
 import utils
+from indexes import CompsIndex
+from segments import SegmentStats
+from journals import Journal, NullJournal, atomic_write_csv, atomic_write_json
+from stores import CustomerStore, BidStore
+from instruments import Instrumentation, timed
+from ledgers import Ledger
 
 
 class Querent:
@@ -14,66 +22,513 @@ class Querent:
     """
     
     customers_fp = None
+    journal_fp = None
     bids_fp = None
-    customers = None
-    bids = None
+    snapshot_dir = None
+    checkpoint_fp = None
+    store = None
+    bid_store = None
     
     api_key = None
+    base_url = 'http://34.224.89.130:5000'
     url = {
         'next_user':'http://34.224.89.130:5000/get_next_user',
         'place_bid': 'http://34.224.89.130:5000/submit_bid',
         'how_am_doing': 'http://34.224.89.130:5000/how_am_i_doing'
     }
     
-    def __init__(self, archive_dir, api_key):
+    def __init__(self, archive_dir, api_key, base_url = None, flush_every = 32, flush_ms = 200, fsync = True,
+                 pool_size = 4, timeout = (3.05, 10), retries = 3, backoff = 0.1, instruments = None,
+                 retention = None, spill_rows = None, shared_archive = None, max_staleness = 1.0):
+        """
+        Open (or create) the archive in archive_dir. The archive is a binary
+        snapshot (in snapshot/, see stores.ColumnStore.save) plus an
+        append-only journal of everything received since the snapshot was
+        written; the snapshot is memory-mapped and the journal replayed, so
+        opening takes about the same time however big the archive is and no
+        data is lost between runs. An archive with customers.csv and bids.csv
+        but no binary snapshot is imported from the CSVs instead. If
+        archive_dir is None the Querent keeps everything in memory only.
+        flush_every, flush_ms and fsync control the journal's group commit
+        (see journals.Journal).
         
-        self.customers_fp = Path(archive_dir + '/customers.csv')
-        self.bids_fp = Path(archive_dir + '/bids.csv')
+        base_url selects the bidding server (e.g. a local server.py); by
+        default the production server is used. Requests go through a pooled
+        keep-alive session of pool_size connections, with a (connect, read)
+        timeout in seconds, and are retried up to `retries` times with
+        exponential backoff starting at `backoff` seconds where that is safe
+        (see _post()).
         
-        if self.customers_fp.is_file():
-            self.customers = pd.read_csv(self.customers_fp, index_col = 0)
-        else:
-            self.customers = pd.DataFrame()
+        self.ledger (a ledgers.Ledger) keeps the session's running profit
+        and loss as bid results come in, with a time series in ledger.jsonl
+        (an archive without one starts it from its bid results so far);
+        reconcile() checks it against the server now and again.
+        
+        instruments is an instruments.Instrumentation that receives timings of
+        every Querent method and HTTP call, plus bid/win/error/retry counts.
+        Bidders report to the same one. It is disabled unless given.
+        
+        For long runs, retention (a policy from retention.py) bounds the set
+        of customers get_comps() picks from, and spill_rows bounds the rows
+        held in ordinary memory: once that many have been added, the tables
+        are compacted to the archive and reopened memory-mapped (see
+        spill()). Spilling needs an archive_dir.
+        
+        To bid from several workers (processes, or sessions with different
+        API keys) on one pooled archive, pass each an archives.SharedArchive
+        for the same database and archive_dir = None. Each worker journals
+        to the shared archive and keeps its own customer up for bid, and
+        folds in the other workers' bid results (as comps) whenever they
+        are more than max_staleness seconds old, when it fetches a user.
+        """
+        
+        self.instruments = instruments if instruments is not None else Instrumentation()
+        
+        if base_url is not None:
+            self.base_url = base_url.rstrip('/')
+        self.url = {
+            'next_user': self.base_url + '/get_next_user',
+            'place_bid': self.base_url + '/submit_bid',
+            'how_am_doing': self.base_url + '/how_am_i_doing'
+        }
         
-        if self.bids_fp.is_file():
-            self.bids = pd.read_csv(self.bids_fp, index_col = 0)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = 0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.http_stats = {name: {'count': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0} for name in self.url}
+        
+        ## Everything is held in columnar stores; the customers and bids
+        ## data frames are only built when someone looks at them.
+        self.store = CustomerStore()
+        self.bid_store = BidStore()
+        self._frames = {}
+        
+        ## The state of the bidder driving this Querent as of its last bid
+        ## (see Bidder.state()), so it can pick up where it left off
+        self.bidder_state = None
+        
+        ## Running profit and loss, kept as results come in (see reconcile())
+        self.ledger = Ledger(None)
+        
+        ## With no archive_dir nothing is read or written (e.g. backtests)
+        if shared_archive is not None:
+            if archive_dir is not None:
+                raise ValueError('A Querent on a shared archive cannot also have an archive_dir')
+            self.journal = shared_archive
+        elif archive_dir is None:
+            self.journal = NullJournal()
         else:
-            self.bids = pd.DataFrame()
+            self.customers_fp = Path(archive_dir + '/customers.csv').as_posix()
+            self.bids_fp = Path(archive_dir + '/bids.csv').as_posix()
+            self.snapshot_dir = Path(archive_dir + '/snapshot').as_posix()
+            self.journal_fp = Path(archive_dir + '/journal.jsonl').as_posix()
+            self.checkpoint_fp = Path(archive_dir + '/checkpoint.json').as_posix()
+            
+            ## The binary snapshot is opened if there is one; otherwise the
+            ## CSVs (from an older archive, or put there by hand) are imported
+            self._open_snapshot(self.store, 'customers', self.customers_fp)
+            self._open_snapshot(self.bid_store, 'bids', self.bids_fp)
+            checkpoint = {}
+            if Path(self.checkpoint_fp).is_file():
+                with open(self.checkpoint_fp) as fh:
+                    checkpoint = json.load(fh)
+                self.bidder_state = checkpoint['bidder']
+            
+            self._replay(Journal.replay(self.journal_fp))
+            self.journal = Journal(self.journal_fp, flush_every, flush_ms, fsync)
+            self.ledger = Ledger(Path(archive_dir + '/ledger.jsonl').as_posix(), flush_every = flush_every,
+                                 flush_ms = flush_ms, fsync = fsync, checkpoint = checkpoint.get('ledger'))
+            ## An archive from before the ledger was kept starts it from its
+            ## bid results, so the totals agree with the server's
+            if self.ledger.totals['bids'] == 0 and len(self.bid_store) > 0:
+                resolved = self.store.resolved_positions()
+                self.ledger.seed(
+                    self.store.features(resolved), self.store.column('bid')[resolved],
+                    self.store.column('win')[resolved], self.store.column('profit')[resolved],
+                    self.bid_store.column('purchase').sum()
+                )
+        
+        ## The comps index covers every customer with a bid result. It is
+        ## built the first time it is needed (see comps_index) and kept up to
+        ## date by place_bid() from then on.
+        self._comps_index = None
+        self._segment_stats = None
         
-        self.customers_fp = Path(archive_dir + '/customers.csv').as_posix()
-        self.bids_fp = Path(archive_dir + '/bids.csv').as_posix()
+        self.retention = retention
+        self.spill_rows = spill_rows
+        self._listeners = []
+        self._next_local_key = None
+        
+        ## Other workers' customers waiting on a bid, by user_index; they
+        ## are only added to the store once their result comes in
+        self.shared_archive = shared_archive
+        self.max_staleness = max_staleness
+        self._foreign = {}
+        if shared_archive is not None:
+            self._merge(shared_archive.read(everything = True))
+            self._last_sync = time.monotonic()
         
         self.api_key = api_key
     #END
     
-    def get_next_user(self):
+    def _open_snapshot(self, store, name, csv_fp):
+        if Path(self.snapshot_dir + '/' + name + '.json').is_file():
+            store.load(self.snapshot_dir, name)
+        elif Path(csv_fp).is_file():
+            store.extend_frame(pd.read_csv(csv_fp, index_col = 0))
+    #END
+    
+    @property
+    def comps_index(self):
+        """
+        The indexes.CompsIndex over every customer with a bid result (or
+        those kept by the retention policy).
+        """
+        if self._comps_index is None:
+            self._comps_index = CompsIndex(len(utils.FEATURE_COLUMNS))
+            resolved = self.store.resolved_positions()
+            if self.retention is not None:
+                resolved = self.retention.fit(resolved, self.store.features(resolved))
+            if resolved.shape[0] > 0:
+                self._comps_index.fit(self.store.features(resolved), resolved)
+        return self._comps_index
+    
+    @property
+    def segment_stats(self):
+        """
+        The segments.SegmentStats of every bid result so far, built the first
+        time it is needed and kept up to date by place_bid() from then on.
+        """
+        if self._segment_stats is None:
+            resolved = self.store.resolved_positions()
+            self._segment_stats = SegmentStats().fit(
+                self.store.features(resolved),
+                self.store.column('bid')[resolved] if resolved.shape[0] > 0 else [],
+                self.store.column('win')[resolved] if resolved.shape[0] > 0 else []
+            )
+        return self._segment_stats
+    
+    @property
+    def customers(self):
+        """
+        Data frame view of every customer seen so far (rebuilt only when the
+        store has changed since the last look).
+        """
+        return self._frame('customers', self.store)
+    
+    @property
+    def bids(self):
+        """
+        Data frame view of every bid result received so far.
+        """
+        return self._frame('bids', self.bid_store)
+    
+    def _frame(self, name, store):
+        version, df = self._frames.get(name, (None, None))
+        if version != store.version:
+            df = store.frame()
+            self._frames[name] = (store.version, df)
+        return df
+    #END
+    
+    def _replay(self, records):
+        """
+        Fold journal records into the stores. Records are keyed by user_index
+        (or the local key they were given, see _local_key()), so replaying a
+        record the snapshot already holds (e.g. after a crash during
+        compaction) is harmless.
+        """
+        for rec in records:
+            if rec['record'] == 'customer':
+                self.store.append(rec['data'], rec.get('key', rec['data']['user_index']))
+            elif rec['record'] == 'bid':
+                pos = self.store.position(rec['index'])
+                self._record_result(pos, rec['bid'], rec['response'])
+                if 'tier' in rec:
+                    self.store.set(pos, 'tier', rec['tier'])
+                self.bid_store.append(rec['response'], rec['index'])
+                if 'state' in rec:
+                    self.bidder_state = rec['state']
+            elif rec['record'] == 'abandon':
+                self.store.abandon(self.store.position(rec['index']))
+    #END
+    
+    def _merge(self, rows):
+        """
+        Fold (worker, record) pairs from the shared archive into the stores.
+        This worker's own records are replayed as they are; other workers'
+        customers are only added with their bid result, so they are never
+        up for bid here.
+        """
+        for worker, rec in rows:
+            if worker == self.shared_archive.worker:
+                self._replay([rec])
+            elif rec['record'] == 'customer':
+                self._foreign[rec.get('key', rec['data']['user_index'])] = rec
+            elif rec['record'] == 'abandon':
+                self._foreign.pop(rec['index'], None)
+            elif rec['record'] == 'bid' and rec['index'] in self._foreign:
+                customer = self._foreign.pop(rec['index'])
+                if rec['index'] in self.store:
+                    continue
+                ## Only our own bidder's state is of interest
+                self._replay([customer, {key: rec[key] for key in rec if key != 'state'}])
+                pos = self.store.position(rec['index'])
+                if self._comps_index is not None:
+                    self._add_comp(pos)
+                if self._segment_stats is not None:
+                    seg = self._segment_stats.segment(self.store.features(pos))
+                    self._segment_stats.update(seg, self.store.get(pos, 'bid'), self.store.get(pos, 'win'))
+    #END
+    
+    @timed('querent.sync')
+    def sync(self):
+        """
+        Fold in every bid result other workers have committed to the shared
+        archive since the last sync.
+        """
+        self._merge(self.shared_archive.read())
+        self._last_sync = time.monotonic()
+    #END
+    
+    def _record_result(self, pos, bid, json_response):
+        """
+        Put the relevant info from a bid result in the customers table
+        """
+        profit = 0
+        if json_response['win'] == True and json_response['purchase'] == True:
+            profit = json_response['profit']
+        
+        self.store.set_result(pos, bid, json_response['win'], profit)
+    #END
+    
+    @timed('querent.compact')
+    def compact(self, headroom = None):
+        """
+        Fold the journal back into the snapshot: write the rows added or
+        changed since the last snapshot and checkpoint the bidder state and
+        the ledger (so reopening only reads its newer rows), then empty the
+        journal. headroom is passed on to ColumnStore.save().
+        """
+        if self.snapshot_dir is None:
+            return
+        self.journal.flush()
+        self.store.save(self.snapshot_dir, 'customers', headroom)
+        self.bid_store.save(self.snapshot_dir, 'bids', headroom)
+        atomic_write_json({'bidder': self.bidder_state, 'ledger': self.ledger.state(), 'time': time.time()},
+                          self.checkpoint_fp)
+        self.journal.truncate()
+    #END
+    
+    @timed('querent.spill')
+    def spill(self):
+        """
+        Hand the tables' memory back: compact, then reopen the snapshot
+        memory-mapped. Rows then only take up memory while they are in use
+        (e.g. as comps), and the operating system can drop them again
+        afterwards, so memory use stays flat however long the run.
+        """
+        if self.snapshot_dir is None:
+            raise ValueError('Spilling needs an archive_dir')
+        self.compact(headroom = 2 * self.spill_rows if self.spill_rows else None)
+        self.store.load(self.snapshot_dir, 'customers')
+        self.bid_store.load(self.snapshot_dir, 'bids')
+        self._frames = {}
+    #END
+    
+    def _add_comp(self, pos):
+        """
+        Offer a newly resolved customer to the comps index, via the
+        retention policy if there is one.
+        """
+        feat = self.store.features(pos)
+        if self.retention is None:
+            self._comps_index.add(feat, pos)
+            return
+        evicted = self.retention.add(pos, feat)
+        if pos not in evicted:
+            self._comps_index.add(feat, pos)
+        for old_pos in evicted:
+            if old_pos != pos:
+                self._comps_index.remove(old_pos)
+    #END
+    
+    def export_csv(self, directory = None):
+        """
+        Write the customers and bids tables out as customers.csv and bids.csv
+        (in the archive by default), for analysis elsewhere. Once an archive
+        has a binary snapshot these files are only ever written, never read.
+        """
+        if directory is None:
+            customers_fp, bids_fp = self.customers_fp, self.bids_fp
+        else:
+            customers_fp = Path(directory + '/customers.csv').as_posix()
+            bids_fp = Path(directory + '/bids.csv').as_posix()
+        if customers_fp is None:
+            raise ValueError('This Querent has no archive; give a directory to export to.')
+        atomic_write_csv(self.customers, customers_fp)
+        atomic_write_csv(self.bids, bids_fp)
+    #END
+    
+    def close(self, compact = False):
+        """
+        Commit anything still buffered in the journal (and optionally compact)
+        before shutting down.
+        """
+        if compact:
+            self.compact()
+        self.journal.close()
+        self.ledger.close()
+        self.session.close()
+    #END
+    
+    def _post(self, name, payload, idempotent = False):
+        """
+        POST a JSON payload to one of the endpoints in self.url and return the
+        decoded response.
+        
+        Idempotent calls are retried on any connection error, timeout or 5xx
+        response. Other calls are only retried when the request provably never
+        reached the server (the connection could not be made); if it may have
+        been received, the error is raised rather than risk sending it twice.
+        """
+        stats = self.http_stats[name]
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.post(self.url[name], json = payload, timeout = self.timeout)
+                if response.status_code >= 500 and idempotent:
+                    response.raise_for_status()
+                json_response = json.loads(response.content)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                stats['errors'] += 1
+                self.instruments.count('errors')
+                safe = idempotent or isinstance(e, requests.ConnectTimeout) or _not_connected(e)
+                if not safe or attempt >= self.retries:
+                    raise
+                attempt += 1
+                stats['retries'] += 1
+                self.instruments.count('retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+            
+            elapsed = time.perf_counter() - start
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            self.instruments.observe('http.' + name, elapsed)
+            return json_response
+    #END
+    
+    def latency(self):
+        """
+        Per-endpoint request counts and latencies (in seconds) so far.
+        """
+        out = {}
+        for name, stats in self.http_stats.items():
+            out[name] = dict(stats, mean = stats['total'] / stats['count'] if stats['count'] else 0.0)
+        return out
+    #END
+    
+    @timed('querent.get_next_user')
+    def get_next_user(self, as_frame = False):
+        """
+        Fetch the next user up for bid and archive them. Returns the server's
+        response (a dict whose 'result' is 'failure' if no user was handed
+        out), or with as_frame = True a one-row data frame of the new
+        customer, for looking at in a notebook.
+        """
+        if self.shared_archive is not None and time.monotonic() - self._last_sync >= self.max_staleness:
+            self.sync()
+        
         payload = {'api_key': self.api_key}
         
         ## Query the server, and unpack the JSON to a dict
-        response = requests.post(self.url['next_user'], json = payload)
-        json_response = json.loads(response.text)
+        json_response = self._post('next_user', payload)
         
         ## Handle errors:
         if json_response['result'] == 'failure':
+            self.instruments.count('errors')
             return json_response
         
-        ## Convert the dict to a data frame, using the appripriate index, and
-        ## making sure there is space to record the bid
+        ## If the server has handed out a new user while we still hold one
+        ## whose bid went unconfirmed (see place_bid), that bid must have
+        ## gone through; we just never heard the outcome.
+        self.abandon_pending()
+        
+        ## Make sure there is space to record the bid
         json_response['bid'] = -1
         ind = json_response['user_index']
-        df_response = pd.DataFrame(json_response, index = [ind])
+        record = {'record': 'customer', 'data': json_response}
         
-        ## Append the data frame to the list of users already known, and
-        ## persist the new data frame
-        self.customers = self.customers.append(df_response)
-        self.customers.to_csv(self.customers_fp)
+        ## A user_index we already have a result for means the server has
+        ## reused it (e.g. it was restarted); the new user is kept under a
+        ## local key instead, with the server's index in the user_index
+        ## column, so the old result is neither wiped nor refused.
+        if self.store.has_result(ind):
+            ind = record['key'] = self._local_key()
         
+        ## Add the user to the list of users already known, and persist
+        ## the new record
+        self.store.append(json_response, ind)
+        with self.instruments.timer('querent.persist'):
+            self.journal.append(record)
         
-        return df_response
+        if as_frame:
+            return pd.DataFrame(json_response, index = [ind])
+        return json_response
+    #END
+    
+    
+    def _local_key(self):
+        """
+        A store key for a customer whose user_index is already taken. Local
+        keys are negative, so they never meet a server's user_index, and on
+        a shared archive each worker draws them from its own range, so no
+        two workers hand out the same one.
+        """
+        if self._next_local_key is None:
+            base = 0
+            if self.shared_archive is not None:
+                base = (zlib.crc32(self.shared_archive.worker.encode()) & 0x7fffffff) << 32
+            ## Carry on after the local keys this archive already holds
+            keys = self.store.keys()
+            counts = -keys[keys < 0] - base
+            counts = counts[(counts > 0) & (counts < 2**32)]
+            self._next_local_key = (base, int(counts.max()) + 1 if counts.shape[0] > 0 else 1)
+        base, count = self._next_local_key
+        self._next_local_key = (base, count + 1)
+        return -(base + count)
     #END
     
+    def abandon_pending(self):
+        """
+        Give up on any customer still waiting for a bid, e.g. one the server
+        has already taken a bid on that we never heard the result of.
+        """
+        for pos in self.store.pending_positions():
+            self.store.abandon(pos)
+            self.journal.append({'record': 'abandon', 'index': self.store.key(pos)})
+    #END
     
-    def place_bid(self, bid, user_id = None):
+    @timed('querent.place_bid')
+    def place_bid(self, bid, user_id = None, state = None, tier = None, as_frame = False):
+        """
+        Bid on the customer up for bid, or (emergency use) on the user with
+        the given user_id. state is the bidder's state after this bid (see
+        Bidder.state()); it is journaled in the same record as the result,
+        so the archive and the bidder can never disagree about which bids
+        were made. tier records how the bidder decided the bid (e.g.
+        AnnealingBidder's latency tiers) in the customers' 'tier' column.
+        
+        Returns the server's response, whose 'result' is 'success' once the
+        bid is recorded (as a one-row data frame with as_frame = True).
+        """
         
         ## First handle the case where we have lost data and need to bid
         ## on someone listed in an error
@@ -83,116 +538,233 @@ class Querent:
                 'user_id':user_id,
                 'bid_amount':bid
             }
-            response = requests.post(self.url['place_bid'], json = payload)
-            json_response = json.loads(response.text)
+            json_response = self._post('place_bid', payload)
             return json_response
         #END emergency handling
         
         ## Start by grabbing the user we need to place a bit on...
-        #for_bid_ix = self.customers.bid < 0
-        #for_bid = self.customers.loc[for_bid_ix, :]
-        for_bid = self.up_for_bid()
-        if for_bid.shape[0] > 1:
+        n_pending = len(self.store.pending_positions())
+        if n_pending > 1:
             raise ValueError('The number of customers needing a bid is greater than 1. Please repair table.')
-        elif for_bid.shape[0] < 1:
+        elif n_pending < 1:
             raise ValueError('No customers currently need a bid. Please use get_nextuser().')
         
-            
-        
         ## Construct the payload
-        ind = for_bid.index[0]
+        pos = self.store.pending
+        ind = self.store.key(pos)
         payload = {
             'api_key':self.api_key,
-            'user_id':for_bid.loc[ind, 'user_id'],
-            'bid_amount':bid
+            'user_id':self.store.get(pos, 'user_id'),
+            'bid_amount':float(bid)
         }
         
-        ## Send the bid and record the results
-        response = requests.post(self.url['place_bid'], json = payload)
-        json_response = json.loads(response.text)
+        ## Send the bid and record the results. A bid is never resent once it
+        ## may have reached the server: if we can't tell whether it did, the
+        ## user stays pending and we report the bid as unconfirmed. Bidding
+        ## on them again is harmless (the server rejects a user it has already
+        ## taken a bid on), and get_next_user() clears them once the server
+        ## moves on.
+        try:
+            json_response = self._post('place_bid', payload)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            return {'result': 'unconfirmed', 'user_id': payload['user_id'], 'message': str(e)}
         
         ## Handle errors:
         if json_response['result'] != 'success':
+            self.instruments.count('errors')
             return json_response
-        
-        ## Package the results, add to the data frame
-        df_response = pd.DataFrame(json_response, index = [ind])
+        self.instruments.count('bids')
+        if json_response['win'] == True:
+            self.instruments.count('wins')
         
         ## Put the relevant info in the customers table
-        self.customers.loc[ind, 'bid'] = bid
-        self.customers.loc[ind, 'win'] = json_response['win']
-        self.customers.loc[ind, 'profit'] = 0
+        self._record_result(pos, bid, json_response)
+        if tier is not None:
+            self.store.set(pos, 'tier', tier)
+        if self._comps_index is not None:
+            self._add_comp(pos)
+        if self._segment_stats is not None:
+            seg = self._segment_stats.segment(self.store.features(pos))
+            self._segment_stats.update(seg, self.store.get(pos, 'bid'), self.store.get(pos, 'win'))
+        for listener in self._listeners:
+            listener(pos, json_response)
         
-        if json_response['win'] == True and json_response['purchase'] == True:
-            self.customers.loc[ind, 'profit'] = json_response['profit']
+        self.ledger.record(bid, json_response, self.store.features(pos))
+        self.bid_store.append(json_response, ind)
+        record = {'record': 'bid', 'index': ind, 'bid': bid, 'response': json_response}
+        if tier is not None:
+            record['tier'] = tier
+        if state is not None:
+            record['state'] = state
+            self.bidder_state = state
+        with self.instruments.timer('querent.persist'):
+            self.journal.append(record)
         
+        if self.spill_rows is not None and len(self.store) - self.store.saved_rows >= self.spill_rows:
+            self.spill()
         
-        self.bids = self.bids.append(df_response)
-        
-        self.customers.to_csv(self.customers_fp)
-        self.bids.to_csv(self.bids_fp)
-        
-        return df_response
+        if as_frame:
+            return pd.DataFrame(json_response, index = [ind])
+        return json_response
     #END
     
     
+    def add_listener(self, listener):
+        """
+        Call listener(pos, response) with the customer's store position and
+        the server's response after every successful bid (e.g.
+        retraining.Retrainer.observe). Listeners run inside place_bid(), so
+        they must be quick.
+        """
+        self._listeners.append(listener)
+    #END
+    
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+    
+    @timed('querent.get_progress')
     def get_progress(self):
         
-        response = requests.post(self.url['how_am_doing'], json = {'api_key':self.api_key})
-        json_response = json.loads(response.text)
+        json_response = self._post('how_am_doing', {'api_key':self.api_key}, idempotent = True)
         return json_response
     
+    def reconcile(self):
+        """
+        Check the ledger's totals against the server's (one get_progress()
+        call, so do it now and again rather than after every bid). Returns
+        the totals that disagree or that the server doesn't report, as
+        ledgers.Ledger.reconcile() does; these are counted as
+        ledger.mismatches and ledger.unchecked respectively.
+        """
+        server = self.get_progress()
+        if server.get('result') == 'failure':
+            self.instruments.count('errors')
+            return server
+        mismatches = self.ledger.reconcile(server)
+        if any(theirs is not None for ours, theirs in mismatches.values()):
+            self.instruments.count('ledger.mismatches')
+        if any(theirs is None for ours, theirs in mismatches.values()):
+            self.instruments.count('ledger.unchecked')
+        return mismatches
+    #END
+    
+    @timed('querent.get_comps')
     def get_comps(self, user_id = None, n = 6):
         """
         Get a data frame of the n most similar users to the one currently up
-        for bid (or another if specified)
+        for bid (or another if specified), looked up in self.comps_index.
         """
 
-        ## Look up the customer who is up for bid and calculate their features.
+        ## Look up the customer who is up for bid and grab their features.
         if user_id is None:
-            user = self.up_for_bid()
+            pos = self.store.pending
+            if pos is None:
+                raise ValueError('No customers currently need a bid. Please use get_nextuser().')
         else:
-            match_ind = self.customers.user_id == user_id
-            user = self.customers.loc[match_ind, :]
-            if user.shape[0] == 0:
+            pos = self.store.user_position(user_id)
+            if pos is None:
                 raise ValueError('No users matching the specified user_id')
         
-        user_feat = utils.frame_to_features(user)
-
-        ## Make a NearestNeighbors finder to do the lookup for us
-        no_bid = self.not_up_for_bid()
-        no_bid_feat = utils.frame_to_features(no_bid)
-        nbf = NearestNeighbors(n_neighbors = n)
-        nbf.fit(no_bid_feat)
-
-        ## Now use the neighbor finder to get indices (positional, not from df.index)
-        ind = nbf.kneighbors(user_feat, return_distance=False).flatten()
+        user_feat = self.store.features(pos)
 
-        ## The indices we have are NOT from the actual existing indices of the df, but
-        ## a relative index of position
-        df = self.customers.iloc[ind]
+        ## The comps index hands back positions in the customer store,
+        ## nearest first.
+        comps_pos = self.comps_index.query(user_feat, n = n)
+        df = self.store.frame(comps_pos.astype(int))
 
         return df
     
+    def get_user(self, user_id):
+        """
+        The record of the customer with the given user_id, as a dict, or
+        None if we have never seen them.
+        """
+        pos = self.store.user_position(user_id)
+        return self.store.record(pos) if pos is not None else None
+    #END
+    
+    def wins(self, positions = False):
+        """
+        Data frame of every customer we won, or with positions = True their
+        positions in self.store (a view into its index, without copying).
+        """
+        pos = self.store.wins()
+        return pos if positions else self.store.frame(pos)
+    
+    def losses(self, positions = False):
+        """
+        Like wins(), for every customer whose bid we lost.
+        """
+        pos = self.store.losses()
+        return pos if positions else self.store.frame(pos)
+    
+    def segment(self, seg, positions = False):
+        """
+        Like wins(), for every customer in a demographic segment, given as a
+        segment number or as a feature vector of a customer in it (see
+        segments.SegmentStats).
+        """
+        pos = self.store.segment(seg)
+        return pos if positions else self.store.frame(pos)
+    #END
+    
+    @timed('querent.up_for_bid')
     def up_for_bid(self):
         """
         Return the record of the user record currently up for bid.
 
         Return None if there is no user up for bid.
         """
-        for_bid_ind = self.customers.bid < 0
-        for_bid_df = self.customers.loc[for_bid_ind, :]
-        
-        return for_bid_df
+        return self.store.frame(self.store.pending_positions())
 
+    @timed('querent.not_up_for_bid')
     def not_up_for_bid(self):
         """
         Return the customers data frame, minus any customer(s) currently
         up for bid.
         """
-        for_bid_ind = self.customers.bid < 0
-        for_bid_df = self.customers.loc[~for_bid_ind, :]
-        
-        return for_bid_df
+        return self.store.frame(self.store.resolved_positions())
 
 #END class
+
+
+class LocalQuerent(Querent):
+    """
+    Querent that talks to an in-process environments.BiddingEnvironment
+    instead of a server, so bidders can be run and measured without any
+    HTTP in the way. Archiving works exactly as for a Querent.
+    """
+    
+    routes = {
+        'next_user': 'get_next_user',
+        'place_bid': 'submit_bid',
+        'how_am_doing': 'how_am_i_doing'
+    }
+    
+    def __init__(self, archive_dir, api_key, environment, **kwargs):
+        self.environment = environment
+        super().__init__(archive_dir, api_key, base_url = 'local:', **kwargs)
+    #END
+    
+    def _post(self, name, payload, idempotent = False):
+        stats = self.http_stats[name]
+        start = time.perf_counter()
+        json_response = getattr(self.environment, self.routes[name])(payload)
+        elapsed = time.perf_counter() - start
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        self.instruments.observe('http.' + name, elapsed)
+        return json_response
+    #END
+
+#END class
+
+
+def _not_connected(exc):
+    """
+    Whether a requests ConnectionError happened before the connection was
+    established (so the request cannot have reached the server).
+    """
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
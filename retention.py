@@ -0,0 +1,170 @@
+"""
+Retention policies for the comps candidate set.
+
+A policy decides which resolved customers stay in the Querent's comps index
+(and so can be returned by get_comps()), keeping it to a bounded size over
+arbitrarily long runs. Customers dropped from the candidate set are still
+in the archive; they just stop being used as comps.
+
+Every policy has the same two methods, both working with store positions:
+fit(positions, features) picks the initial candidates from an existing
+archive (given oldest first) and returns them, and add(pos, x) offers one
+new customer and returns the positions that are no longer candidates
+(which includes pos itself if it was turned away). However much a policy
+thins the set out, it never leaves fewer than min_keep candidates (the
+number of comps a bid is based on), as long as that many have been offered.
+"""
+import time
+import heapq
+import numpy as np
+from collections import deque
+
+from segments import SegmentStats
+
+
+## Comps per bid (see AnnealingBidder.compute_bid), so the least a policy keeps
+MIN_KEEP = 6
+
+
+class SlidingWindow:
+    """
+    Keep the most recent customers: at most max_count of them, and/or only
+    those added within the last max_age seconds (but always the newest
+    min_keep, however old).
+    """
+
+    def __init__(self, max_count = None, max_age = None, clock = time.time, min_keep = MIN_KEEP):
+        if max_count is None and max_age is None:
+            raise ValueError('SlidingWindow needs a max_count or a max_age')
+        if max_count is not None and max_count < min_keep:
+            raise ValueError('Expected max_count >= min_keep ({}), got {}'.format(min_keep, max_count))
+        self.min_keep = min_keep
+        self.max_count = max_count
+        self.max_age = max_age
+        self.clock = clock
+        self._window = deque()
+    #END
+
+    def __len__(self):
+        return len(self._window)
+
+    def fit(self, positions, features):
+        ## Past customers have no arrival time, so they all count as now
+        positions = np.asarray(positions)
+        if self.max_count is not None:
+            positions = positions[-self.max_count:]
+        now = self.clock()
+        self._window = deque((int(pos), now) for pos in positions)
+        return positions
+    #END
+
+    def add(self, pos, x):
+        now = self.clock()
+        self._window.append((int(pos), now))
+        evicted = []
+        while len(self._window) > self.min_keep and (
+                (self.max_count is not None and len(self._window) > self.max_count)
+                or (self.max_age is not None and now - self._window[0][1] > self.max_age)):
+            evicted.append(self._window.popleft()[0])
+        return evicted
+    #END
+
+#END class
+
+
+class SegmentReservoir:
+    """
+    Keep a uniform random sample of up to per_segment customers from each
+    demographic segment (see segments.SegmentStats), by reservoir sampling.
+    Rare segments keep all of their history while common ones are thinned
+    out, so every kind of user keeps some comps. Until min_keep customers
+    are kept in all, none are turned away.
+    """
+
+    def __init__(self, per_segment = 64, segments = None, seed = None, min_keep = MIN_KEEP):
+        self.per_segment = per_segment
+        self.min_keep = min_keep
+        self.segments = segments if segments is not None else SegmentStats()
+        self.rng = np.random.default_rng(seed)
+        self._reservoirs = {}
+        self._seen = {}
+        self._n = 0
+    #END
+
+    def __len__(self):
+        return self._n
+
+    def fit(self, positions, features):
+        self._reservoirs = {}
+        self._seen = {}
+        self._n = 0
+        for pos, seg in zip(positions, self.segments.segments(features)):
+            self._offer(int(pos), int(seg))
+        return np.array(sorted(pos for r in self._reservoirs.values() for pos in r), dtype = np.int64)
+    #END
+
+    def add(self, pos, x):
+        return self._offer(int(pos), self.segments.segment(x))
+
+    def _offer(self, pos, seg):
+        reservoir = self._reservoirs.setdefault(seg, [])
+        seen = self._seen.get(seg, 0) + 1
+        self._seen[seg] = seen
+        if len(reservoir) < self.per_segment or self._n < self.min_keep:
+            reservoir.append(pos)
+            self._n += 1
+            return []
+        j = self.rng.integers(0, seen)
+        if j < len(reservoir):
+            evicted = reservoir[j]
+            reservoir[j] = pos
+            return [evicted]
+        return [pos]
+    #END
+
+#END class
+
+
+class RecencyWeighted:
+    """
+    Keep a random sample of up to capacity customers in which newer ones are
+    more likely to be kept: a customer's weight doubles every half_life
+    customers added after it. Samples with these weights are drawn with the
+    Gumbel-top-k trick, keeping the capacity customers with the highest
+    (log weight + Gumbel noise), so each addition costs O(log capacity).
+    """
+
+    def __init__(self, capacity = 20000, half_life = 5000, seed = None, min_keep = MIN_KEEP):
+        if capacity < min_keep:
+            raise ValueError('Expected capacity >= min_keep ({}), got {}'.format(min_keep, capacity))
+        self.capacity = capacity
+        self.half_life = half_life
+        self.rng = np.random.default_rng(seed)
+        self._heap = []
+        self._t = 0
+    #END
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _key(self):
+        self._t += 1
+        return self._t * np.log(2) / self.half_life + self.rng.gumbel()
+
+    def fit(self, positions, features):
+        self._heap = []
+        self._t = 0
+        for pos in positions:
+            self.add(pos, None)
+        return np.array(sorted(pos for key, pos in self._heap), dtype = np.int64)
+    #END
+
+    def add(self, pos, x):
+        item = (self._key(), int(pos))
+        if len(self._heap) < self.capacity:
+            heapq.heappush(self._heap, item)
+            return []
+        return [heapq.heappushpop(self._heap, item)[1]]
+    #END
+
+#END class
@@ -0,0 +1,176 @@
+"""
+Background retraining of the purchase model from live bid results.
+
+Every won bid tells us whether the user purchased. A Retrainer collects
+those labels from a Querent and, on a background thread, periodically
+trains a new version of the purchase model on them. Each version is
+published together with its scorer, and a bidder following the Retrainer
+(see bidders.Bidder.follow) swaps it in between two bids, so the bid loop
+never waits on training.
+
+Note that only won users are labelled, so the new data is biased towards
+the users we bid highest on.
+"""
+import copy
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+import scorers
+
+
+def train(model, X, y, mode):
+    """
+    A new version of model trained on the samples X, y, leaving model itself
+    untouched. With mode 'partial_fit' the samples are one more batch for
+    model.partial_fit(); with 'refit' the copy is fit on them from scratch
+    (or from its current coefficients, for models with warm_start).
+    """
+    model = copy.deepcopy(model)
+    classes = getattr(model, 'classes_', np.array([False, True]))
+    y = np.asarray(y).astype(np.asarray(classes).dtype)
+    if getattr(model, 'feature_names_in_', None) is not None:
+        X = pd.DataFrame(X, columns = model.feature_names_in_)
+    if mode == 'partial_fit':
+        model.partial_fit(X, y, classes = classes)
+    else:
+        model.fit(X, y)
+    return model
+#END
+
+
+class Retrainer:
+    """
+    Keeps a purchase model up to date with the purchases seen while bidding.
+
+    Once `every` new labelled users have come in, a new version is trained:
+    models with partial_fit (e.g. scorers.LinearModel, or sklearn's
+    SGDClassifier) are updated with just the new batch, anything else is
+    refit on every sample kept, i.e. `history` (an (X, y) pair such as the
+    data the model was first trained on) plus the labels collected so far,
+    trimmed to the last `window` samples if window is given. Refits wait
+    until both outcomes have been seen.
+
+    Training runs on a daemon thread, or in a separate process if processes
+    is True (which keeps large refits from competing with the bid loop for
+    the interpreter). The latest version is `published`, a tuple of
+    (version number, model, scorer); a failed training round is counted in
+    `errors` (the exception is kept in last_error) and the previous version
+    stays in use.
+    """
+
+    def __init__(self, model, querent, every = 200, mode = None, history = None, window = None, processes = False):
+        if mode is None:
+            mode = 'partial_fit' if hasattr(model, 'partial_fit') else 'refit'
+        if mode not in ('partial_fit', 'refit'):
+            raise ValueError("Expected mode 'partial_fit' or 'refit', got {!r}".format(mode))
+        self.model = model
+        self.querent = querent
+        self.every = every
+        self.mode = mode
+        self.window = window
+        self.processes = processes
+
+        self.published = None
+        self.errors = 0
+        self.last_error = None
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pool = None
+        if history is not None:
+            X, y = history
+            self._X = [np.asarray(X, dtype = np.float64).reshape(-1, len(utils.FEATURE_COLUMNS))]
+            self._y = [np.asarray(y, dtype = bool).reshape(-1)]
+        else:
+            self._X = []
+            self._y = []
+    #END
+
+    def observe(self, pos, response):
+        """
+        Querent listener: queue the outcome of a bid for training. Only won
+        bids carry a purchase label.
+        """
+        if response.get('win') == True:
+            x = self.querent.store.features(pos).copy()
+            self._queue.put((x, bool(response.get('purchase'))))
+    #END
+
+    def start(self):
+        """
+        Start listening to the querent and training in the background.
+        """
+        if self._thread is not None:
+            return self
+        if self.processes:
+            self._pool = ProcessPoolExecutor(max_workers = 1)
+        self.querent.add_listener(self.observe)
+        self._thread = threading.Thread(target = self._run, name = 'retrainer', daemon = True)
+        self._thread.start()
+        return self
+    #END
+
+    def stop(self, timeout = None):
+        """
+        Stop listening and shut the worker down once it has finished the
+        version it is training (if any).
+        """
+        if self._thread is None:
+            return
+        self.querent.remove_listener(self.observe)
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+    #END
+
+    def _run(self):
+        X_new, y_new = [], []
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            X_new.append(item[0])
+            y_new.append(item[1])
+            if len(y_new) < self.every:
+                continue
+            self._X.append(np.array(X_new))
+            self._y.append(np.array(y_new))
+            X_new, y_new = [], []
+            try:
+                self._train()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+    #END
+
+    def _train(self):
+        if self.mode == 'partial_fit':
+            X, y = self._X[-1], self._y[-1]
+            self._X, self._y = [], []
+        else:
+            X, y = np.concatenate(self._X), np.concatenate(self._y)
+            if self.window is not None:
+                X, y = X[-self.window:], y[-self.window:]
+            self._X, self._y = [X], [y]
+            if y.all() or not y.any():
+                return
+
+        base = self.published[1] if self.published is not None else self.model
+        if self._pool is not None:
+            model = self._pool.submit(train, base, X, y, self.mode).result()
+        else:
+            model = train(base, X, y, self.mode)
+        version = self.published[0] + 1 if self.published is not None else 1
+        ## Scorer and model go out together in one assignment, so a bidder
+        ## never sees one without the other
+        self.published = (version, model, scorers.make_scorer(model))
+    #END
+
+#END class
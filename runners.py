@@ -0,0 +1,201 @@
+import time
+import asyncio
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncBidRunner:
+    """
+    Drives several bidders at once from a single asyncio event loop.
+
+    This only pays off when bids are bound by the round trip to the server,
+    as with the remote production server: while one session waits on the
+    network the others get on with their bids. Against a server on the same
+    machine the client's own work (which holds the GIL) is the bottleneck,
+    and the threads only add overhead; use fleet.py's worker processes
+    there instead. benchmark() (or python runners.py) measures both ways.
+
+    Each bidder should have its own Querent (one API key / session each); the
+    purchase model can be shared between them. Within a session the server's
+    one-pending-user rule still makes bids sequential, but the HTTP calls run
+    on a thread pool, so while one session waits on the network the others
+    fetch, decide and submit. Journal writes are handed to each Querent's
+    background flusher. Each session's ledger is reconciled with the server
+    every progress_interval seconds (if given), between two of its bids, so
+    the server is never asked while one of the session's bids is still in
+    flight.
+
+    In a notebook (where an event loop is already running) use
+    `await runner.run(n)`; elsewhere `runner.run_bids(n)`.
+    """
+
+    def __init__(self, bidders, max_workers = None, progress_interval = None, max_failures = 10):
+        self.bidders = list(bidders)
+        self.max_workers = max_workers or 2 * len(self.bidders) + 1
+        self.progress_interval = progress_interval
+        self.max_failures = max_failures
+
+        self.mismatches = [None] * len(self.bidders)
+        self.bids_placed = [0] * len(self.bidders)
+        self.failures = [0] * len(self.bidders)
+    #END
+
+    async def _session(self, i, n_bids, pool):
+        """
+        Place n_bids bids with the i'th bidder.
+        """
+        bidder = self.bidders[i]
+        qr = bidder._qr
+        loop = asyncio.get_running_loop()
+
+        placed = 0
+        consecutive = 0
+        last_check = time.monotonic()
+        while placed < n_bids:
+            user = await loop.run_in_executor(pool, qr.get_next_user)
+
+            ## A failure here usually means the server still has a user
+            ## waiting on us; if it is the one we hold, just bid on it.
+            if user['result'] == 'failure' and qr.store.pending is None:
+                self.failures[i] += 1
+                consecutive += 1
+                if consecutive >= self.max_failures:
+                    raise RuntimeError('Session {} failed {} times in a row: {}'.format(i, consecutive, user))
+                continue
+
+            bid = bidder.compute_bid()
+            res = await loop.run_in_executor(pool, bidder.place_bid, bid)
+            if res['result'] != 'success':
+                self.failures[i] += 1
+                consecutive += 1
+                if consecutive >= self.max_failures:
+                    raise RuntimeError('Session {} failed {} times in a row: {}'.format(i, consecutive, res))
+            else:
+                consecutive = 0
+            placed += 1
+            self.bids_placed[i] += 1
+
+            if self.progress_interval and time.monotonic() - last_check >= self.progress_interval:
+                await self._reconcile(i, pool)
+                last_check = time.monotonic()
+    #END
+
+    @property
+    def progress(self):
+        """
+        Every session's running totals, from its Querent's ledger.
+        """
+        return [bidder._qr.ledger.progress() for bidder in self.bidders]
+
+    async def _reconcile(self, i, pool):
+        """
+        Check the i'th session's ledger against the server's view of its
+        progress, keeping any disagreement in mismatches.
+        """
+        qr = self.bidders[i]._qr
+        loop = asyncio.get_running_loop()
+        try:
+            self.mismatches[i] = await loop.run_in_executor(pool, qr.reconcile)
+        except Exception as e:
+            self.mismatches[i] = {'result': 'failure', 'message': str(e)}
+    #END
+
+    async def run(self, n_bids):
+        """
+        Place n_bids bids with every bidder, concurrently. Returns a summary
+        of the run.
+        """
+        start = time.perf_counter()
+        for bidder in self.bidders:
+            bidder._qr.journal.start_background()
+            bidder._qr.ledger.journal.start_background()
+
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            try:
+                await asyncio.gather(*[self._session(i, n_bids, pool) for i in range(len(self.bidders))])
+            finally:
+                for bidder in self.bidders:
+                    bidder._qr.journal.stop_background()
+                    bidder._qr.ledger.journal.stop_background()
+
+        elapsed = time.perf_counter() - start
+        total = sum(self.bids_placed)
+        return {
+            'bids': total,
+            'seconds': elapsed,
+            'bids_per_second': total / elapsed if elapsed > 0 else 0.0,
+            'failures': list(self.failures),
+        }
+    #END
+
+    def run_bids(self, n_bids):
+        """
+        Blocking version of run(), for use outside a running event loop.
+        """
+        return asyncio.run(self.run(n_bids))
+
+#END class
+
+
+def benchmark(model, sessions = (1, 2, 4, 8), n_bids = 200, latency = 0.0):
+    """
+    Bids per second of a bidder placing its bids one after another, and of
+    an AsyncBidRunner with each number of sessions, against a local
+    server.py whose replies are held back latency seconds (the round trip
+    to the real server).
+    """
+    import bidders
+    import environments
+    from querents import Querent
+    from server import BiddingServer
+
+    env = environments.BiddingEnvironment(environments.UserSampler(seed = 0), seed = 0)
+    server = BiddingServer(env, port = 0, latency = latency)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    def make_bidder(key):
+        qr = Querent(None, key, base_url = server.base_url)
+        return bidders.AnnealingBidder(model, qr, rng = np.random.default_rng(0))
+
+    try:
+        results = {}
+        bidder = make_bidder('sequential')
+        start = time.perf_counter()
+        bidder.execute_bids(n_bids)
+        results['sequential'] = n_bids / (time.perf_counter() - start)
+        bidder._qr.close()
+
+        for n in sessions:
+            runner = AsyncBidRunner([make_bidder('async-{}-{}'.format(n, i)) for i in range(n)])
+            results['async x{}'.format(n)] = runner.run_bids(n_bids)['bids_per_second']
+            for bidder in runner.bidders:
+                bidder._qr.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+#END
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compare sequential and asynchronous bidding throughput.')
+    parser.add_argument('--sessions', type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument('--bids', type = int, default = 200, help = 'bids per session')
+    parser.add_argument('--latency', type = float, nargs = '+', default = [0.0, 0.02],
+                        help = 'server round trips to try, in seconds')
+    args = parser.parse_args()
+
+    import benchmarks
+    import environments
+    model = benchmarks.train_model(environments.UserSampler(seed = 0))
+    for latency in args.latency:
+        for name, rate in benchmark(model, args.sessions, args.bids, latency).items():
+            print('{:>8.3f}s  {:<12} {:>8.1f} bids/s'.format(latency, name, rate))
+#END
+
+
+if __name__ == '__main__':
+    main()
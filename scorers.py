@@ -0,0 +1,193 @@
+import math
+import warnings
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+class ModelScorer:
+    """
+    Scores users with the model's own predict_proba. This is the fallback for
+    any model we don't know how to score more cheaply.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._columns = getattr(model, 'feature_names_in_', None)
+    #END
+
+    def _frame(self, X):
+        X = np.asarray(X, dtype = np.float64).reshape(-1, len(utils.FEATURE_COLUMNS))
+        if self._columns is not None:
+            return pd.DataFrame(X, columns = self._columns)
+        return X
+    #END
+
+    def score(self, x):
+        """
+        Probability of purchase for a single user's feature vector.
+        """
+        return float(self.model.predict_proba(self._frame(x))[:, 1][0])
+
+    def score_batch(self, X):
+        """
+        Probability of purchase for each row of a feature matrix.
+        """
+        return self.model.predict_proba(self._frame(X))[:, 1]
+
+#END class
+
+
+class LinearScorer(ModelScorer):
+    """
+    Scores users with a binary linear classifier's coefficients directly
+    (a dot product and a sigmoid), skipping sklearn's input validation.
+    """
+
+    def __init__(self, model):
+        super().__init__(model)
+        self._coef = np.asarray(model.coef_, dtype = np.float64).reshape(-1)
+        self._intercept = float(np.asarray(model.intercept_).reshape(-1)[0])
+    #END
+
+    def score(self, x):
+        if isinstance(x, pd.DataFrame):
+            x = x.values
+        x = np.asarray(x, dtype = np.float64).reshape(-1)
+        z = float(np.dot(self._coef, x)) + self._intercept
+        return 1.0 / (1.0 + math.exp(-z)) if z >= 0 else math.exp(z) / (1.0 + math.exp(z))
+    #END
+
+    def score_batch(self, X):
+        if isinstance(X, pd.DataFrame):
+            X = X.values
+        X = np.asarray(X, dtype = np.float64).reshape(-1, self._coef.shape[0])
+        z = X @ self._coef + self._intercept
+        ## Numerically stable sigmoid
+        out = np.empty_like(z)
+        pos = z >= 0
+        out[pos] = 1.0 / (1.0 + np.exp(-z[pos]))
+        ez = np.exp(z[~pos])
+        out[~pos] = ez / (1.0 + ez)
+        return out
+    #END
+
+#END class
+
+
+class LinearModel:
+    """
+    A binary linear classifier reduced to its coefficients, usable anywhere a
+    purchase model is (it has predict_proba, coef_ and intercept_). It saves
+    to a small .npz file and loads without importing sklearn, which makes it
+    much quicker to open than the pickled model.
+    """
+
+    def __init__(self, coef, intercept, classes = (0, 1)):
+        self.coef_ = np.asarray(coef, dtype = np.float64).reshape(1, -1)
+        self.intercept_ = np.asarray(intercept, dtype = np.float64).reshape(1)
+        self.classes_ = np.asarray(classes)
+    #END
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Copy the coefficients out of a fitted linear model (see _is_linear).
+        """
+        if not _is_linear(model):
+            raise ValueError('{} is not a binary linear classifier'.format(type(model).__name__))
+        return cls(model.coef_, model.intercept_, model.classes_)
+
+    def predict_proba(self, X):
+        p = LinearScorer(self).score_batch(X)
+        return np.column_stack([1.0 - p, p])
+
+    def partial_fit(self, X, y, classes = None, learning_rate = 0.01, alpha = 1e-4):
+        """
+        One pass of stochastic gradient descent on the log loss (with L2
+        penalty alpha) over the samples X, y, in order, starting from the
+        current coefficients. y is compared with classes_[1].
+        """
+        if isinstance(X, pd.DataFrame):
+            X = X.values
+        X = np.asarray(X, dtype = np.float64).reshape(-1, self.coef_.shape[1])
+        y = (np.asarray(y) == self.classes_[1]).astype(np.float64)
+        coef = self.coef_[0].copy()
+        intercept = float(self.intercept_[0])
+        for x, target in zip(X, y):
+            z = float(np.dot(coef, x)) + intercept
+            p = 1.0 / (1.0 + math.exp(-z)) if z >= 0 else math.exp(z) / (1.0 + math.exp(z))
+            coef -= learning_rate * ((p - target) * x + alpha * coef)
+            intercept -= learning_rate * (p - target)
+        self.coef_ = coef.reshape(1, -1)
+        self.intercept_ = np.array([intercept])
+        return self
+    #END
+
+    def save(self, fp):
+        np.savez(fp, coef = self.coef_, intercept = self.intercept_, classes = self.classes_)
+
+    @classmethod
+    def load(cls, fp):
+        with np.load(fp) as data:
+            return cls(data['coef'], data['intercept'], data['classes'])
+
+#END class
+
+
+def _is_linear(model):
+    """
+    Whether the model looks like a binary linear classifier whose
+    predict_proba is sigmoid(X . coef + intercept).
+    """
+    coef = getattr(model, 'coef_', None)
+    classes = getattr(model, 'classes_', None)
+    return (
+        coef is not None and classes is not None and len(classes) == 2
+        and np.asarray(coef).shape == (1, len(utils.FEATURE_COLUMNS))
+        and hasattr(model, 'predict_proba')
+    )
+#END
+
+
+def probe_features(n = 64, seed = 0):
+    """
+    A small matrix of plausible user features, used to check that a fast
+    scorer agrees with the model it was built from.
+    """
+    rng = np.random.default_rng(seed)
+    return utils.encode_arrays(
+        rng.integers(0, 7, n),
+        rng.random(n) < 0.5,
+        rng.random(n) < 0.5,
+        rng.normal(utils.AGE_MEAN, utils.AGE_STD, n),
+        rng.normal(utils.INCOME_MEAN, utils.INCOME_STD, n)
+    )
+#END
+
+
+def make_scorer(model, validate = True, atol = 1e-9):
+    """
+    Build the fastest scorer we can for a purchase model.
+
+    Linear models get a LinearScorer; anything else falls back to its own
+    predict_proba. When validate is True the fast path is checked against
+    predict_proba on a set of probe users, and if they disagree by more than
+    atol we warn and fall back.
+    """
+    if not _is_linear(model):
+        return ModelScorer(model)
+
+    scorer = LinearScorer(model)
+    if validate:
+        X = probe_features()
+        expected = ModelScorer(model).score_batch(X)
+        got = scorer.score_batch(X)
+        single = np.array([scorer.score(x) for x in X])
+        if not (np.allclose(got, expected, rtol = 0, atol = atol) and np.allclose(single, expected, rtol = 0, atol = atol)):
+            warnings.warn('Linear scoring of {} disagrees with predict_proba; falling back to predict_proba'.format(type(model).__name__))
+            return ModelScorer(model)
+
+    return scorer
+#END
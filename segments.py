@@ -0,0 +1,133 @@
+import bisect
+import numpy as np
+
+import utils
+
+
+class SegmentStats:
+    """
+    Running bid outcomes per demographic segment.
+
+    A segment is a day of the week, gender and marital status plus a band of
+    age and of income (the band edges are in the raw units). For every
+    segment it keeps the number of wins and losses, the highest losing bid,
+    the two lowest winning bids and the last bid, all updated in constant
+    time as results come in. These are exactly the figures
+    AnnealingBidder.decide() needs from a set of comps, so a well populated
+    segment can stand in for a nearest-neighbour lookup.
+    """
+
+    def __init__(self, age_edges = (25, 35, 45, 55, 65), income_edges = (40000, 70000, 100000, 130000), min_count = 6):
+        ## Edges are kept in the same scaled units as the features
+        self.age_edges = [(a - utils.AGE_MEAN) / utils.AGE_STD for a in age_edges]
+        self.income_edges = [(i - utils.INCOME_MEAN) / utils.INCOME_STD for i in income_edges]
+        self.min_count = min_count
+
+        self._n_age = len(self.age_edges) + 1
+        self._n_income = len(self.income_edges) + 1
+        ## 8 days: the seven in utils.DAYS plus unknown
+        n = 8 * 2 * 2 * self._n_age * self._n_income
+        self.n_wins = np.zeros(n, dtype = np.int64)
+        self.n_losses = np.zeros(n, dtype = np.int64)
+        self.highest_loss = np.full(n, -np.inf)
+        self.lowest_win = np.full(n, np.inf)
+        self.second_lowest_win = np.full(n, np.inf)
+        self.last_bid = np.full(n, np.nan)
+    #END
+
+    def __len__(self):
+        return self.n_wins.shape[0]
+
+    def segment(self, x):
+        """
+        Segment number of a single feature vector.
+        """
+        day = 0
+        for i in range(7):
+            if x[i]:
+                day = i + 1
+                break
+        seg = (day * 2 + int(x[7])) * 2 + int(x[8])
+        seg = seg * self._n_age + bisect.bisect_right(self.age_edges, x[9])
+        return seg * self._n_income + bisect.bisect_right(self.income_edges, x[10])
+    #END
+
+    def segments(self, X):
+        """
+        Segment numbers of every row of a feature matrix.
+        """
+        X = np.asarray(X).reshape(-1, len(utils.FEATURE_COLUMNS))
+        day = (X[:, :7] @ np.arange(1, 8)).astype(np.int64)
+        seg = (day * 2 + X[:, 7].astype(np.int64)) * 2 + X[:, 8].astype(np.int64)
+        seg = seg * self._n_age + np.searchsorted(self.age_edges, X[:, 9], side = 'right')
+        return seg * self._n_income + np.searchsorted(self.income_edges, X[:, 10], side = 'right')
+    #END
+
+    def update(self, seg, bid, win):
+        """
+        Count one bid result in segment seg.
+        """
+        if win:
+            self.n_wins[seg] += 1
+            if bid < self.lowest_win[seg]:
+                self.second_lowest_win[seg] = self.lowest_win[seg]
+                self.lowest_win[seg] = bid
+            elif bid < self.second_lowest_win[seg]:
+                self.second_lowest_win[seg] = bid
+        else:
+            self.n_losses[seg] += 1
+            if bid > self.highest_loss[seg]:
+                self.highest_loss[seg] = bid
+        self.last_bid[seg] = bid
+    #END
+
+    def fit(self, X, bids, wins):
+        """
+        Rebuild the statistics from past results, given in the order they
+        happened: a feature matrix and the bid and outcome on each row.
+        """
+        n = len(self)
+        segs = self.segments(X)
+        bids = np.asarray(bids, dtype = np.float64)
+        wins = np.asarray(wins, dtype = bool)
+
+        self.n_wins = np.bincount(segs[wins], minlength = n)
+        self.n_losses = np.bincount(segs[~wins], minlength = n)
+
+        self.highest_loss = np.full(n, -np.inf)
+        np.maximum.at(self.highest_loss, segs[~wins], bids[~wins])
+
+        ## The two lowest wins are the first two of each segment once the
+        ## wins are sorted by segment and then bid
+        self.lowest_win = np.full(n, np.inf)
+        self.second_lowest_win = np.full(n, np.inf)
+        order = np.lexsort((bids[wins], segs[wins]))
+        win_segs, win_bids = segs[wins][order], bids[wins][order]
+        seg, first = np.unique(win_segs, return_index = True)
+        self.lowest_win[seg] = win_bids[first]
+        second = first + 1
+        has_second = (second < win_segs.shape[0])
+        has_second[has_second] = win_segs[second[has_second]] == seg[has_second]
+        self.second_lowest_win[seg[has_second]] = win_bids[second[has_second]]
+
+        self.last_bid = np.full(n, np.nan)
+        seg, last = np.unique(segs[::-1], return_index = True)
+        self.last_bid[seg] = bids[::-1][last]
+        return self
+    #END
+
+    def lookup(self, x):
+        """
+        The figures decide() needs for the segment of feature vector x, as
+        (n_wins, n_losses, highest_loss, lowest_win, second_lowest_win), or
+        None if the segment has fewer than min_count results.
+        """
+        seg = self.segment(x)
+        n_wins = self.n_wins[seg]
+        n_losses = self.n_losses[seg]
+        if n_wins + n_losses < self.min_count:
+            return None
+        return (n_wins, n_losses, self.highest_loss[seg], self.lowest_win[seg], self.second_lowest_win[seg])
+    #END
+
+#END class
@@ -0,0 +1,128 @@
+"""
+Local stand-in for the bidding server, for exercising bidders offline.
+
+Speaks the same JSON protocol as the real service (get_next_user,
+submit_bid and how_am_i_doing), backed by environments.BiddingEnvironment.
+Run it with e.g.
+
+    python server.py --past-bids /mnt/c/data/b2w/past_bids.csv --port 5000
+
+and point a Querent at it with base_url = 'http://127.0.0.1:5000'. With
+--latency every reply is held back that many seconds, to stand in for the
+round trip to the real (remote) server.
+"""
+import json
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import environments
+
+
+class BiddingRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes POSTed JSON payloads to the environment attached to the server.
+    Connections are kept alive between requests (HTTP/1.1).
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    ## Headers and body go out as separate writes; without these, Nagle's
+    ## algorithm plus delayed ACKs stall every keep-alive response by ~40ms.
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    routes = {
+        '/get_next_user': 'get_next_user',
+        '/submit_bid': 'submit_bid',
+        '/how_am_i_doing': 'how_am_i_doing',
+    }
+
+    def do_POST(self):
+        route = self.routes.get(self.path)
+        if route is None:
+            self._reply(404, {'result': 'failure', 'message': 'Unknown endpoint {}'.format(self.path)})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._reply(400, {'result': 'failure', 'message': 'Request body is not valid JSON.'})
+            return
+
+        body = getattr(self.server.environment, route)(payload)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self._reply(200, body)
+    #END
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    #END
+
+    def log_message(self, format, *args):
+        ## Per-request logging would dominate the cost of a load test
+        pass
+
+#END class
+
+
+class BiddingServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server (one thread per connection) around a BiddingEnvironment.
+    Each reply is delayed by latency seconds.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, environment, host = '127.0.0.1', port = 5000, latency = 0.0):
+        self.environment = environment
+        self.latency = latency
+        super().__init__((host, port), BiddingRequestHandler)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+#END class
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run a local stand-in for the bidding server.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 5000)
+    parser.add_argument('--past-bids', default = None, help = 'past_bids.csv to draw users from (synthetic users if omitted)')
+    parser.add_argument('--adversary', choices = ['linear', 'constant'], default = 'linear')
+    parser.add_argument('--adversary-bid', type = float, default = 1.0, help = 'bid for the constant adversary')
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds to hold back every reply')
+    args = parser.parse_args()
+
+    if args.adversary == 'constant':
+        adversary = environments.ConstantAdversary(args.adversary_bid)
+    else:
+        adversary = environments.LinearAdversary()
+    sampler = environments.UserSampler(args.past_bids, seed = args.seed)
+    env = environments.BiddingEnvironment(sampler, adversary, seed = args.seed)
+
+    server = BiddingServer(env, args.host, args.port, args.latency)
+    print('Serving on {}'.format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+#END
+
+
+if __name__ == '__main__':
+    main()
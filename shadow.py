@@ -0,0 +1,232 @@
+"""
+Shadow evaluation: what other bidding strategies would have done.
+
+A ShadowEvaluator follows a live AnnealingBidder and, for every user it
+bids on, works out the bid each registered strategy would have placed from
+the same features, purchase score and comps the live bidder used, so the
+expensive part of a bid is done once however many strategies are watched.
+Strategies are array functions (like those in policies.py), so the same
+ones can also be replayed over a whole archive in one batch (see replay()).
+
+No strategy's bid is ever sent. Its outcome is estimated from what is
+known about the adversary's bid: below the live bid if that won, at or
+above it if it lost, and narrowed down to between the comps' highest
+losing and lowest winning bids where those agree (see win_probabilities()).
+"""
+import numpy as np
+import pandas as pd
+
+import policies
+from indexes import CompsIndex
+from journals import Journal, NullJournal
+
+
+## Strategies. Each takes a context of arrays describing n users, a dict
+## with 'features', 'probs' (purchase probabilities), 'bounds' (the
+## bidder's max_bid ceilings), 'increments' (its current annealing step)
+## and 'stats' (the comps summary from policies.summarize()), plus a numpy
+## Generator, and returns the n bids.
+
+def annealing(increment_scale = 1.0):
+    """
+    AnnealingBidder's own rule, with its step size scaled by increment_scale.
+    """
+    def f(ctx, rng):
+        return policies.anneal(ctx['bounds'], ctx['increments'] * increment_scale, ctx['stats'], rng)
+    return f
+
+
+def fraction_of_bound(fraction = 0.5):
+    """
+    A fixed fraction of the max_bid() ceiling.
+    """
+    def f(ctx, rng):
+        return ctx['bounds'] * fraction
+    return f
+
+
+def undercut(margin = 0.01):
+    """
+    Just under the lowest winning comp (or just over the highest losing one
+    if no comp won), capped at the ceiling.
+    """
+    def f(ctx, rng):
+        n_wins, n_losses, highest_loss, lowest_win, second_lowest_win = ctx['stats']
+        bids = np.where(n_wins > 0, lowest_win - margin, highest_loss + margin)
+        return np.clip(bids, 0, ctx['bounds'])
+    return f
+
+
+def constant(amount = 1.0):
+    def f(ctx, rng):
+        return np.full(ctx['bounds'].shape, float(amount))
+    return f
+
+
+def uniform(low = 0.0, high = 10.0):
+    """
+    Uniformly random bids, like strategies.random_bid().
+    """
+    def f(ctx, rng):
+        return rng.uniform(low, high, ctx['bounds'].shape)
+    return f
+
+
+def win_probabilities(bids, live_bids, live_wins, highest_loss, lowest_win):
+    """
+    Estimated chance each bid would have won against the adversary bid that
+    the live bid was placed against. The adversary's bid is taken to be
+    uniformly distributed over everything consistent with the live outcome
+    and, where they agree with it, the comps' highest loss and lowest win.
+    A bid above that range wins; if the range has no top (the live bid lost
+    and no comp has won), bids above the live bid are assumed to lose.
+    """
+    live_bids = np.asarray(live_bids, dtype = np.float64)
+    live_wins = np.asarray(live_wins, dtype = bool)
+    lo = np.where(live_wins, 0.0, live_bids)
+    hi = np.where(live_wins, live_bids, np.inf)
+    comp_lo = np.maximum(lo, np.where(np.isfinite(highest_loss), highest_loss, lo))
+    comp_hi = np.minimum(hi, np.where(np.isfinite(lowest_win), lowest_win, hi))
+    agree = comp_lo < comp_hi
+    lo = np.where(agree, comp_lo, lo)
+    hi = np.where(agree, comp_hi, hi)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        p = (np.asarray(bids, dtype = np.float64) - lo) / (hi - lo)
+    p = np.where(np.isnan(p), 0.0, p)
+    return np.clip(p, 0.0, 1.0)
+#END
+
+
+class ShadowEvaluator:
+    """
+    Evaluates named strategies (a dict of name -> strategy function, see the
+    top of this module) alongside a live bidder. Every user's bids and
+    estimated outcomes are appended to the JSONL file log_fp, if given, and
+    running totals are kept for summary(). Strategies draw their random
+    numbers from their own generator (seeded with seed), never the
+    bidder's, so shadowing doesn't change the live bids.
+    """
+
+    def __init__(self, strategies, bidder = None, log_fp = None, seed = None):
+        self.strategies = dict(strategies)
+        self.rng = np.random.default_rng(seed)
+        self.journal = Journal(log_fp) if log_fp is not None else NullJournal()
+        self.bidder = None
+        self.totals = {name: {'users': 0, 'bid': 0.0, 'wins': 0.0, 'profit': 0.0}
+                       for name in ['live'] + list(self.strategies)}
+        if bidder is not None:
+            self.attach(bidder)
+    #END
+
+    def attach(self, bidder):
+        """
+        Shadow every bid the bidder places from now on.
+        """
+        self.bidder = bidder
+        bidder._qr.add_listener(self.observe)
+
+    def detach(self):
+        self.bidder._qr.remove_listener(self.observe)
+        self.bidder = None
+        self.journal.close()
+    #END
+
+    def observe(self, pos, response):
+        """
+        Querent listener: shadow the bid on the customer at pos, using what
+        the bidder based it on.
+        """
+        decision = self.bidder.last_decision
+        if decision is None:
+            return
+        qr = self.bidder._qr
+        ctx = {
+            'features': np.reshape(decision['features'], (1, -1)),
+            'probs': np.array([decision['prob']], dtype = np.float64),
+            'bounds': np.array([decision['bound']], dtype = np.float64),
+            'increments': np.array([decision['increment']], dtype = np.float64),
+            'stats': tuple(np.reshape(a, 1) for a in decision['stats']),
+        }
+        revenue = response['profit'] if response.get('purchase') == True else 0.0
+        results = self.evaluate(ctx, [qr.store.get(pos, 'bid')], [response['win'] == True], [revenue])
+        self.bidder.last_decision = None
+
+        record = {'record': 'shadow', 'index': qr.store.key(pos)}
+        for name, (bids, p_win, profit) in results.items():
+            record[name] = {'bid': bids[0], 'p_win': p_win[0], 'profit': profit[0]}
+        self.journal.append(record)
+    #END
+
+    def evaluate(self, ctx, live_bids, live_wins, revenues):
+        """
+        Bids and estimated outcomes of the live bidder and every strategy on
+        the users described by ctx, given the live bids, whether they won
+        and the revenue from those that did. Returns a dict of name ->
+        (bids, win probabilities, expected profits) and adds them to the
+        running totals.
+        """
+        live_bids = np.asarray(live_bids, dtype = np.float64)
+        live_wins = np.asarray(live_wins, dtype = bool)
+        ## What a user we won spent is known; for the rest, the model's guess
+        expected_revenue = np.where(live_wins, np.asarray(revenues, dtype = np.float64),
+                                    policies.max_bids(ctx['probs']))
+        n_wins, n_losses, highest_loss, lowest_win, second_lowest_win = ctx['stats']
+
+        results = {'live': (live_bids, live_wins.astype(np.float64),
+                            np.where(live_wins, expected_revenue - live_bids, 0.0))}
+        for name, strategy in self.strategies.items():
+            bids = np.asarray(strategy(ctx, self.rng), dtype = np.float64)
+            p_win = win_probabilities(bids, live_bids, live_wins, highest_loss, lowest_win)
+            results[name] = (bids, p_win, p_win * (expected_revenue - bids))
+
+        for name, (bids, p_win, profit) in results.items():
+            totals = self.totals[name]
+            totals['users'] += bids.shape[0]
+            totals['bid'] += float(bids.sum())
+            totals['wins'] += float(p_win.sum())
+            totals['profit'] += float(profit.sum())
+        return results
+    #END
+
+    def replay(self, store, scorer, discount = 0.9, increment = 0.01, n_comps = 6):
+        """
+        Evaluate the strategies on every resolved customer of store (e.g.
+        querent.store) at once, as if they had been shadowed live: each
+        customer's comps are their nearest other resolved customers, scored
+        with scorer (see scorers.make_scorer) in one batch. increment is the
+        annealing step to assume.
+        """
+        resolved = store.resolved_positions()
+        features = store.features(resolved)
+        index = CompsIndex(features.shape[1]).fit(features, resolved)
+        ## Ask for one extra neighbour and drop the customer themselves
+        comps = index.query_batch(features, n = n_comps + 1).astype(int)
+        is_self = comps == resolved[:, None]
+        is_self[~is_self.any(axis = 1), -1] = True
+        comps = comps[~is_self].reshape(-1, n_comps)
+
+        probs = scorer.score_batch(features)
+        ctx = {
+            'features': features,
+            'probs': probs,
+            'bounds': policies.max_bids(probs, discount),
+            'increments': np.full(resolved.shape[0], float(increment)),
+            'stats': policies.summarize(store.column('bid')[comps], store.column('win')[comps]),
+        }
+        return self.evaluate(ctx, store.column('bid')[resolved], store.column('win')[resolved],
+                             store.column('profit')[resolved])
+    #END
+
+    def summary(self):
+        """
+        Data frame of every strategy's totals so far, best expected profit
+        first.
+        """
+        df = pd.DataFrame.from_dict(self.totals, orient = 'index')
+        users = df['users'].where(df['users'] > 0)
+        df['mean_bid'] = df['bid'] / users
+        df['win_rate'] = df['wins'] / users
+        return df[['users', 'mean_bid', 'wins', 'win_rate', 'profit']].sort_values('profit', ascending = False)
+    #END
+
+#END class
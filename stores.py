@@ -0,0 +1,767 @@
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+
+import utils
+from utils import DAYS
+from segments import SegmentStats
+
+
+def _grow(arr, capacity):
+    """
+    Return a copy of arr with room for capacity rows.
+    """
+    new = np.empty((capacity,) + arr.shape[1:], dtype = arr.dtype)
+    new[:arr.shape[0]] = arr
+    return new
+
+
+def _as_text(arr):
+    """
+    An object array holding only strings (or None) as a fixed-width string
+    array, or the array unchanged if it holds anything else.
+    """
+    if all(isinstance(v, str) or v is None for v in arr):
+        return np.array(['' if v is None else v for v in arr], dtype = str).reshape(arr.shape)
+    return arr
+#END
+
+
+def _fits(arr, spec):
+    """
+    Whether arr can be written into an existing snapshot file of the given
+    spec (text may be narrower than the file's width, but not wider).
+    """
+    dtype = np.dtype(spec['dtype'])
+    if list(arr.shape[1:]) != spec['shape']:
+        return False
+    if arr.dtype.kind == 'U' and dtype.kind == 'U':
+        return arr.dtype.itemsize <= dtype.itemsize
+    return arr.dtype == dtype
+#END
+
+
+def _write_rows(fp, arr, start, rows, dirty = ()):
+    """
+    Write rows start onwards of arr, and the rows listed in dirty, into the
+    raw column file fp (creating it if need be) and size the file for
+    `rows` rows. The file is fsync'ed before returning.
+    """
+    row_bytes = arr.dtype.itemsize * int(np.prod(arr.shape[1:], dtype = np.int64))
+    with open(fp, 'r+b' if os.path.exists(fp) else 'wb') as fh:
+        for pos in dirty:
+            fh.seek(pos * row_bytes)
+            fh.write(np.ascontiguousarray(arr[pos]).tobytes())
+        fh.seek(start * row_bytes)
+        fh.write(np.ascontiguousarray(arr[start:]).tobytes())
+        fh.truncate(rows * row_bytes)
+        fh.flush()
+        os.fsync(fh.fileno())
+#END
+
+
+def _save_array(arr, fp):
+    """
+    np.save via a temporary file, fsync'ed before it is moved into place.
+    """
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'wb') as fh:
+        np.save(fh, arr, allow_pickle = arr.dtype.kind == 'O')
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_fp, fp)
+#END
+
+
+class _PositionList:
+    """
+    Growable array of row positions, e.g. one secondary index bucket.
+    """
+
+    __slots__ = ('_arr', '_n')
+
+    def __init__(self, positions = ()):
+        positions = np.asarray(positions, dtype = np.int64)
+        self._arr = _grow(positions, max(16, 2 * positions.shape[0]))
+        self._n = positions.shape[0]
+    #END
+
+    def append(self, pos):
+        if self._n == self._arr.shape[0]:
+            self._arr = _grow(self._arr, 2 * self._n)
+        self._arr[self._n] = pos
+        self._n += 1
+    #END
+
+    def view(self):
+        return self._arr[:self._n]
+
+#END class
+
+
+class ColumnStore:
+    """
+    Append-only table held as NumPy columns that grow by doubling, keyed by an
+    integer label (e.g. user_index).
+
+    Columns named in `schema` get a compact dtype; a list of strings in the
+    schema means a categorical column stored as int8 codes into that list
+    (new categories are added as they are seen). Any other field that shows
+    up in a record is kept in an object column. DataFrame views of the table
+    are only built when asked for.
+    """
+
+    schema = {}
+
+    def __init__(self, capacity = 1024):
+        self._capacity = capacity
+        self._n = 0
+        self._keys = np.empty(capacity, dtype = np.int64)
+        self._pos = {}
+        ## Rows loaded from a snapshot are found by binary search over their
+        ## keys (which are in order, or else sorted by _base_order) instead
+        ## of through _pos
+        self._base_n = 0
+        self._base_order = None
+        ## Where the store was last saved to or loaded from, how many rows
+        ## that snapshot holds and which of those have changed since
+        self._saved = None
+        self._saved_n = 0
+        self._dirty = set()
+        self._cols = {}
+        self._order = []
+        self._categories = {}
+        self._codes = {}
+        self.version = 0
+    #END
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, key):
+        return self.position(key) is not None
+
+    def position(self, key):
+        """
+        Row position of the record with the given key (or None).
+        """
+        pos = self._pos.get(key)
+        if pos is None and self._base_n > 0:
+            i = np.searchsorted(self._keys[:self._base_n], key, sorter = self._base_order)
+            if i < self._base_n:
+                i = i if self._base_order is None else self._base_order[i]
+                if self._keys[i] == key:
+                    pos = int(i)
+        return pos
+    #END
+
+    def key(self, pos):
+        return self._keys[pos]
+
+    def keys(self):
+        return self._keys[:self._n]
+
+    @property
+    def saved_rows(self):
+        """
+        Number of rows in the snapshot this store was last saved to or
+        loaded from.
+        """
+        return self._saved_n
+
+    def column(self, name):
+        """
+        The raw (encoded) values of a column, as a view into the store.
+        """
+        return self._cols[name][:self._n]
+    #END
+
+    def _add_column(self, name):
+        spec = self.schema.get(name, object)
+        if isinstance(spec, (list, tuple)):
+            self._categories[name] = list(spec)
+            self._codes[name] = {c: i for i, c in enumerate(spec)}
+            col = np.full(self._capacity, -1, dtype = np.int8)
+        else:
+            col = np.empty(self._capacity, dtype = spec)
+            col[:self._n] = self._missing(name)
+        self._cols[name] = col
+        if name not in self._order:
+            self._order.append(name)
+    #END
+
+    def _missing(self, name):
+        """
+        The value a column holds for rows that never set it.
+        """
+        if name in self._categories:
+            return -1
+        if name in self._cols and self._cols[name].dtype.kind == 'U':
+            return ''
+        kind = np.dtype(self.schema.get(name, object)).kind
+        if kind == 'f':
+            return np.nan
+        elif kind == 'b':
+            return False
+        elif kind in 'iu':
+            return -1
+        return None
+    #END
+
+    def _encode(self, name, value):
+        if name in self._categories:
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                return -1
+            code = self._codes[name].get(value)
+            if code is None:
+                code = len(self._categories[name])
+                self._categories[name].append(value)
+                self._codes[name][value] = code
+            return code
+        if self._cols[name].dtype.kind == 'U':
+            return self._encode_text(name, value)
+        return value
+    #END
+
+    def _encode_text(self, name, value):
+        """
+        Text columns loaded from a snapshot are fixed-width strings. They are
+        widened to fit longer values, and turned back into object columns if
+        anything other than a string turns up.
+        """
+        col = self._cols[name]
+        if value is None:
+            return ''
+        if not isinstance(value, str):
+            self._cols[name] = col.astype(object)
+            return value
+        width = col.dtype.itemsize // 4
+        if len(value) > width:
+            self._cols[name] = col.astype('U{}'.format(max(len(value), 2 * width)))
+        return value
+    #END
+
+    def _reserve(self, n):
+        """
+        Make sure there is room for n more rows.
+        """
+        needed = self._n + n
+        if needed <= self._capacity:
+            return
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        self._keys = _grow(self._keys[:self._n], capacity)
+        for name in self._cols:
+            self._cols[name] = _grow(self._cols[name][:self._n], capacity)
+        self._capacity = capacity
+    #END
+
+    def append(self, record, key):
+        """
+        Add a record (a dict of field values) under key and return its position.
+        Appending a key that is already stored overwrites that row instead, so
+        replaying the same record twice is harmless.
+        """
+        pos = self.position(key)
+        if pos is None:
+            self._reserve(1)
+            pos = self._n
+            self._n += 1
+            self._keys[pos] = key
+            self._pos[key] = pos
+            for name, col in self._cols.items():
+                col[pos] = self._missing(name)
+        for name, value in record.items():
+            self.set(pos, name, value)
+        self.version += 1
+        return pos
+    #END
+
+    def set(self, pos, name, value):
+        if name not in self._cols:
+            self._add_column(name)
+        value = self._encode(name, value)
+        self._cols[name][pos] = value
+        if pos < self._saved_n:
+            self._dirty.add(pos)
+        self.version += 1
+    #END
+
+    def get(self, pos, name):
+        """
+        The decoded value of one field.
+        """
+        value = self._cols[name][pos]
+        if name in self._categories:
+            return self._categories[name][value] if value >= 0 else np.nan
+        return value
+    #END
+
+    def record(self, pos):
+        """
+        One row as a dict of decoded values.
+        """
+        return {name: self.get(pos, name) for name in self._order}
+
+    def extend_frame(self, df):
+        """
+        Bulk load the rows of a data frame (indexed by key), e.g. a snapshot
+        read from CSV.
+        """
+        if df.shape[0] == 0:
+            return
+        n = df.shape[0]
+        self._reserve(n)
+        start = self._n
+        stop = start + n
+
+        self._keys[start:stop] = df.index.values
+        for i, key in enumerate(df.index.values):
+            self._pos[key] = start + i
+
+        for name in self._cols:
+            if name not in df.columns:
+                self._cols[name][start:stop] = self._missing(name)
+        for name in df.columns:
+            if name not in self._cols:
+                self._add_column(name)
+            values = df[name].values
+            if self._cols[name].dtype.kind == 'U':
+                self._cols[name] = self._cols[name].astype(object)
+            if name in self._categories:
+                values = np.array([self._encode(name, v) for v in values], dtype = np.int8)
+            elif self._cols[name].dtype.kind in 'fiub':
+                fill = self._missing(name)
+                values = pd.Series(values).fillna(fill).values if fill is not None else values
+            self._cols[name][start:stop] = values
+
+        self._n = stop
+        self.version += 1
+    #END
+
+    def frame(self, positions = None):
+        """
+        Build a data frame of the given rows (all rows by default), with the
+        original column order and decoded categories.
+        """
+        if positions is None:
+            positions = slice(0, self._n)
+        data = {}
+        for name in self._order:
+            values = self._cols[name][:self._n][positions]
+            if name in self._categories:
+                cats = np.array(self._categories[name] + [np.nan], dtype = object)
+                values = cats[values]
+            data[name] = values
+        return pd.DataFrame(data, index = self._keys[:self._n][positions], columns = self._order)
+    #END
+
+    def _snapshot_fields(self):
+        """
+        The arrays making up a snapshot, by field name.
+        """
+        fields = {'keys': self._keys}
+        for name, col in self._cols.items():
+            fields['col.' + name] = col
+        return fields
+    #END
+
+    def _snapshot_meta(self):
+        return {}
+
+    def save(self, directory, name, headroom = None):
+        """
+        Write a binary snapshot of the store to directory: one raw file per
+        column, plus a manifest (name.json) giving each file's dtype and the
+        number of rows. Text columns are written as fixed-width strings so
+        that they, like the rest, can be memory-mapped by load().
+
+        If the store was loaded from (or last saved to) the same snapshot,
+        only the rows added or changed since then are written; the column
+        files are extended in place. A column that can't be extended (e.g.
+        text that has outgrown its width) is written to a new file instead.
+        The manifest is replaced last, and only ever describes rows that are
+        already on disk, so a crash part way through leaves the previous
+        snapshot intact.
+
+        Each file has `headroom` free rows at the end (by default an eighth
+        of the table, at least 1024), so a loaded store can take new rows
+        for a while before its columns have to be copied into memory.
+        """
+        os.makedirs(directory, exist_ok = True)
+        manifest_fp = os.path.join(directory, name + '.json')
+        old = None
+        if os.path.exists(manifest_fp):
+            with open(manifest_fp) as fh:
+                old = json.load(fh)
+
+        n = self._n
+        saved_n = 0
+        if old is not None and self._saved == (os.path.abspath(directory), name, old['generation']):
+            saved_n = old['n']
+        generation = old['generation'] + 1 if old is not None else 0
+        if headroom is None:
+            headroom = max(1024, n // 8)
+        ## Files being extended are never shortened, since the store may
+        ## still have them mapped
+        rows = max(n + headroom, old['rows'] if saved_n > 0 else 1)
+        dirty = sorted(pos for pos in self._dirty if pos < saved_n)
+
+        fields = {name_: arr[:n] for name_, arr in self._snapshot_fields().items()}
+        keys = fields['keys']
+        is_sorted = bool(np.all(keys[1:] > keys[:-1]))
+        if not is_sorted:
+            fields['order'] = np.argsort(keys, kind = 'stable')
+
+        columns = {}
+        for field, arr in fields.items():
+            spec = old['columns'].get(field) if saved_n > 0 else None
+            if arr.dtype.kind == 'O':
+                arr = _as_text(arr)
+            if arr.dtype.kind == 'O':
+                ## Anything else is pickled, and rewritten every time
+                fn = '{}.{}.{}.npy'.format(name, field, generation)
+                _save_array(_grow(arr, rows), os.path.join(directory, fn))
+                columns[field] = {'file': fn, 'pickled': True}
+                continue
+
+            if spec is not None and field != 'order' and not spec.get('pickled') and _fits(arr, spec):
+                arr = arr.astype(spec['dtype'], copy = False)
+                _write_rows(os.path.join(directory, spec['file']), arr, saved_n, rows, dirty)
+                columns[field] = spec
+            else:
+                fn = '{}.{}.{}.bin'.format(name, field, generation)
+                _write_rows(os.path.join(directory, fn), arr, 0, rows)
+                columns[field] = {'file': fn, 'dtype': arr.dtype.str, 'shape': list(arr.shape[1:])}
+
+        manifest = {
+            'generation': generation,
+            'n': n,
+            'rows': rows,
+            'sorted': is_sorted,
+            'order': self._order,
+            'categories': self._categories,
+            'columns': columns,
+        }
+        manifest.update(self._snapshot_meta())
+        tmp_fp = manifest_fp + '.tmp'
+        with open(tmp_fp, 'w') as fh:
+            json.dump(manifest, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_fp, manifest_fp)
+
+        ## Files the manifest no longer names are left over from columns
+        ## that were rewritten
+        current = set(spec['file'] for spec in columns.values())
+        for fp in glob.glob(os.path.join(directory, glob.escape(name) + '.*')):
+            if os.path.basename(fp) not in current and not fp.endswith('.json'):
+                try:
+                    os.remove(fp)
+                except OSError:
+                    pass
+
+        self._saved = (os.path.abspath(directory), name, generation)
+        self._saved_n = n
+        self._dirty = set()
+    #END
+
+    def load(self, directory, name, mmap = True):
+        """
+        Replace the contents of the store with the snapshot written by
+        save(directory, name). With mmap the columns are memory-mapped
+        copy-on-write, so this takes about the same time however large the
+        snapshot is, and rows are only read from disk when they are used.
+        Changes are never written back to the files (only save() writes).
+        """
+        with open(os.path.join(directory, name + '.json')) as fh:
+            manifest = json.load(fh)
+        ## Reopening the snapshot this store has just saved doesn't change
+        ## what it holds
+        unchanged = (
+            self._saved == (os.path.abspath(directory), name, manifest['generation'])
+            and self._n == manifest['n'] and not self._dirty
+        )
+
+        rows = manifest['rows']
+        arrays = {}
+        for field, spec in manifest['columns'].items():
+            fp = os.path.join(directory, spec['file'])
+            if spec.get('pickled'):
+                arrays[field] = np.load(fp, allow_pickle = True)
+                continue
+            shape = (rows,) + tuple(spec['shape'])
+            if mmap:
+                arrays[field] = np.memmap(fp, dtype = spec['dtype'], mode = 'c', shape = shape)
+            else:
+                arrays[field] = np.fromfile(fp, dtype = spec['dtype']).reshape(shape)
+
+        self._n = manifest['n']
+        self._capacity = rows
+        self._keys = arrays['keys']
+        self._pos = {}
+        self._base_n = self._n
+        self._base_order = arrays.get('order')
+        self._order = list(manifest['order'])
+        self._categories = {col: list(cats) for col, cats in manifest['categories'].items()}
+        self._codes = {col: {c: i for i, c in enumerate(cats)} for col, cats in self._categories.items()}
+        self._cols = {col: arrays['col.' + col] for col in self._order}
+        self._restore(arrays, manifest, unchanged)
+        self._saved = (os.path.abspath(directory), name, manifest['generation'])
+        self._saved_n = self._n
+        self._dirty = set()
+        self.version += 1
+        return self
+    #END
+
+    def _restore(self, arrays, manifest, unchanged):
+        pass
+
+#END class
+
+
+class CustomerStore(ColumnStore):
+    """
+    Column store for the customers table. Keeps track of which customers are
+    still waiting for a bid (bid < 0) so the one up for bid is found in O(1),
+    and stores each customer's model features (see utils.FEATURE_COLUMNS) as
+    they arrive so the archive never has to be re-encoded.
+
+    It also keeps secondary indexes: customers by user_id, resolved
+    customers split into wins and losses, and customers by demographic
+    segment (as numbered by segments.SegmentStats). Each is built the first
+    time it is used and kept up to date from then on, so lookups cost O(1)
+    or O(rows returned).
+    """
+
+    schema = {
+        'user_index': np.int64,
+        'day_of_week': DAYS,
+        'gender': ['F', 'M'],
+        'marital_status': ['S', 'M'],
+        'age': np.float32,
+        'income': np.float32,
+        'bid': np.float32,
+        'win': np.bool_,
+        'profit': np.float32,
+        'tier': ['knn', 'segment', 'default'],
+    }
+
+    def __init__(self, capacity = 1024):
+        super().__init__(capacity)
+        self._pending = {}
+        self._features = np.zeros((capacity, len(utils.FEATURE_COLUMNS)), dtype = np.float64)
+        self._segmenter = SegmentStats()
+        self._reset_indexes()
+    #END
+
+    def _reset_indexes(self):
+        self._by_user_id = None
+        self._outcomes = None
+        self._by_segment = None
+    #END
+
+    def _reserve(self, n):
+        super()._reserve(n)
+        if self._features.shape[0] < self._capacity:
+            self._features = _grow(self._features[:self._n], self._capacity)
+    #END
+
+    def features(self, positions = None):
+        """
+        The (n, 11) feature matrix of the given rows (all rows by default).
+        """
+        if positions is None:
+            return self._features[:self._n]
+        return self._features[:self._n][positions]
+    #END
+
+    @property
+    def pending(self):
+        """
+        Position of the customer currently up for bid, or None.
+        """
+        if len(self._pending) == 0:
+            return None
+        return next(reversed(self._pending))
+
+    def pending_positions(self):
+        return list(self._pending)
+
+    def resolved_positions(self):
+        """
+        Positions of every customer that has had a bid placed.
+        """
+        if 'bid' not in self._cols:
+            return np.empty(0, dtype = np.int64)
+        return np.flatnonzero(self.column('bid') >= 0)
+
+    def append(self, record, key):
+        n = self._n
+        resolved = self._is_resolved(self.position(key))
+        pos = super().append(record, key)
+        utils.record_to_features(record, out = self._features[pos])
+        if record.get('bid', 0) < 0:
+            self._pending[pos] = True
+        if self._by_user_id is not None and 'user_id' in record:
+            self._by_user_id[record['user_id']] = pos
+        if self._by_segment is not None:
+            if pos == n:
+                self._segment_list(self._segmenter.segment(self._features[pos])).append(pos)
+            else:
+                self._by_segment = None
+        if resolved or self._is_resolved(pos):
+            self._outcomes = None
+        return pos
+    #END
+
+    def has_result(self, key):
+        """
+        Whether the customer stored under key has had a bid result.
+        """
+        return self._is_resolved(self.position(key))
+
+    def _is_resolved(self, pos):
+        return pos is not None and 'bid' in self._cols and self._cols['bid'][pos] >= 0
+
+    def set_result(self, pos, bid, win, profit):
+        """
+        Record the outcome of a bid on the customer at pos.
+        """
+        resolved = self._is_resolved(pos)
+        self.set(pos, 'bid', bid)
+        self.set(pos, 'win', win)
+        self.set(pos, 'profit', profit)
+        self._pending.pop(pos, None)
+        if self._outcomes is not None:
+            if resolved:
+                self._outcomes = None
+            elif self._is_resolved(pos):
+                self._outcomes[bool(win)].append(pos)
+    #END
+
+    def abandon(self, pos):
+        """
+        Give up on the customer at pos without a recorded outcome (e.g. a bid
+        was sent but its result was lost). Their bid is set to NaN, so they
+        count as neither pending nor resolved.
+        """
+        if self._is_resolved(pos):
+            self._outcomes = None
+        self.set(pos, 'bid', np.nan)
+        self._pending.pop(pos, None)
+    #END
+
+    def user_position(self, user_id):
+        """
+        Position of the customer with the given user_id, or None.
+        """
+        if self._by_user_id is None:
+            if 'user_id' not in self._cols:
+                return None
+            self._by_user_id = {uid: pos for pos, uid in enumerate(self.column('user_id').tolist())}
+        return self._by_user_id.get(user_id)
+    #END
+
+    def wins(self):
+        """
+        Positions of every customer whose bid won (a view, not a copy).
+        """
+        return self._outcome_lists()[True].view()
+
+    def losses(self):
+        """
+        Positions of every customer whose bid lost (a view, not a copy).
+        """
+        return self._outcome_lists()[False].view()
+
+    def _outcome_lists(self):
+        if self._outcomes is None:
+            resolved = self.column('bid') >= 0 if 'bid' in self._cols else np.zeros(self._n, dtype = bool)
+            won = self.column('win').astype(bool) if 'win' in self._cols else np.zeros(self._n, dtype = bool)
+            self._outcomes = {
+                True: _PositionList(np.flatnonzero(resolved & won)),
+                False: _PositionList(np.flatnonzero(resolved & ~won)),
+            }
+        return self._outcomes
+    #END
+
+    def segment(self, seg):
+        """
+        Positions of every customer in segment number seg (see
+        segments.SegmentStats.segment) or in the segment of feature vector
+        seg, in the order they arrived (a view, not a copy).
+        """
+        if np.ndim(seg) > 0:
+            seg = self._segmenter.segment(seg)
+        if self._by_segment is None:
+            segs = self._segmenter.segments(self.features())
+            order = np.argsort(segs, kind = 'stable')
+            found, starts = np.unique(segs[order], return_index = True)
+            self._by_segment = {
+                int(s): _PositionList(group)
+                for s, group in zip(found, np.split(order, starts[1:]))
+            }
+        lst = self._by_segment.get(int(seg))
+        return lst.view() if lst is not None else np.empty(0, dtype = np.int64)
+    #END
+
+    def _segment_list(self, seg):
+        lst = self._by_segment.get(seg)
+        if lst is None:
+            lst = self._by_segment[seg] = _PositionList()
+        return lst
+    #END
+
+    def extend_frame(self, df):
+        start = self._n
+        self._reset_indexes()
+        super().extend_frame(df)
+        if df.shape[0] > 0:
+            self._features[start:self._n] = utils.frame_to_features(df).values
+        if 'bid' in self._cols:
+            for pos in np.flatnonzero(self._cols['bid'][start:self._n] < 0):
+                self._pending[start + pos] = True
+    #END
+
+    def _snapshot_fields(self):
+        fields = super()._snapshot_fields()
+        fields['features'] = self._features
+        return fields
+
+    def _snapshot_meta(self):
+        return {'pending': [int(pos) for pos in self._pending]}
+
+    def _restore(self, arrays, manifest, unchanged):
+        self._features = arrays['features']
+        self._pending = {pos: True for pos in manifest['pending']}
+        if not unchanged:
+            self._reset_indexes()
+
+    def frame(self, positions = None):
+        df = super().frame(positions)
+        ## Customers still up for bid have no outcome yet
+        if 'win' in df.columns:
+            df['win'] = pd.array(df['win'].values, dtype = 'boolean')
+            df.loc[~(df['bid'] >= 0), 'win'] = pd.NA
+        return df
+    #END
+
+#END class
+
+
+class BidStore(ColumnStore):
+    """
+    Column store for the raw bid results, keyed by the customer's user_index.
+    """
+
+    schema = {
+        'win': np.bool_,
+        'purchase': np.bool_,
+        'profit': np.float32,
+    }
+
+#END class
@@ -0,0 +1,247 @@
+"""
+Hyperparameter sweeps for AnnealingBidder.
+
+Every configuration is replayed through a Backtester on a process pool, a
+few times each with different bidder seeds, and the runs are ranked by mean
+profit:
+
+    python sweeps.py --model purchase_model.pkl --past-bids past_bids.csv \\
+        --results sweep.jsonl --users 2000 --replicates 3
+
+Results are appended to the results file as runs finish, so an interrupted
+sweep picks up where it left off when started again with the same file.
+"""
+import os
+import json
+import pickle
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import bidders
+import environments
+from backtests import Backtester
+from journals import Journal
+
+
+PARAMETERS = ['timescale', 'initial_increment', 'minimum_increment', 'discount']
+
+DEFAULT_GRID = {
+    'timescale': [100, 500, 2000],
+    'initial_increment': [0.05, 0.10, 0.50],
+    'minimum_increment': [0.01],
+    'discount': [0.8, 0.9, 1.0],
+}
+
+
+def grid(space):
+    """
+    Every combination of the values in space, a dict of parameter -> list.
+    """
+    names = sorted(space)
+    for values in itertools.product(*[space[name] for name in names]):
+        yield dict(zip(names, values))
+#END
+
+
+def random_search(space, n, seed = 0):
+    """
+    n configurations drawn from space, a dict of parameter -> either a list
+    of values (picked uniformly) or a (low, high) tuple (drawn log-uniformly
+    for positive bounds, uniformly otherwise).
+    """
+    rng = np.random.default_rng(seed)
+    names = sorted(space)
+    for i in range(n):
+        config = {}
+        for name in names:
+            dim = space[name]
+            if isinstance(dim, tuple):
+                low, high = dim
+                if low > 0:
+                    value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    value = float(rng.uniform(low, high))
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+            else:
+                value = dim[rng.integers(0, len(dim))]
+                value = value.item() if isinstance(value, np.generic) else value
+            config[name] = value
+        yield config
+#END
+
+
+def config_key(config):
+    """
+    Canonical string identifying a configuration, for matching results.
+    """
+    return json.dumps(config, sort_keys = True)
+
+
+## Read-only state shared with the workers. It is set in the parent before
+## the pool starts, so forked workers inherit it copy-on-write; on platforms
+## that spawn workers, the pool initializer sends a pickled copy instead.
+_shared = {}
+
+
+def _init_worker(model, backtester):
+    _shared['model'] = model
+    _shared['backtester'] = backtester
+
+
+def _run_task(config, seed, n_users):
+    """
+    One replay of the shared user stream with one configuration. Runs in a
+    worker process.
+    """
+    model = _shared['model']
+    backtester = _shared['backtester']
+    rng = np.random.default_rng(seed)
+    result = backtester.run(lambda qr: bidders.AnnealingBidder(model, qr, rng = rng, **config), n_users)
+    summary = result.summary()
+    summary['final_bid'] = float(result.bids[-1]) if len(result) else 0.0
+    return summary
+#END
+
+
+class Sweep:
+    """
+    Runs configurations of AnnealingBidder against a Backtester in parallel.
+
+    Each (configuration, replicate) pair is one task with its own seed,
+    derived from the sweep's seed, the configuration's position in the
+    sweep and the replicate number, so results do not depend on which worker
+    runs a task or in what order. The model and Backtester are shared with
+    the workers rather than rebuilt per task.
+
+    With a results file, finished tasks are appended to it (one JSON line
+    each, flushed and synced as they arrive), and tasks already in it are
+    skipped, so an interrupted sweep can be resumed by running it again.
+    """
+
+    def __init__(self, model, backtester, configs, replicates = 3, n_users = None, seed = 0,
+                 results_fp = None, max_workers = None):
+        self.model = model
+        self.backtester = backtester
+        self.configs = [dict(c) for c in configs]
+        self.replicates = replicates
+        self.n_users = n_users
+        self.seed = seed
+        self.results_fp = results_fp
+        self.max_workers = max_workers or os.cpu_count()
+        self.results = []
+    #END
+
+    def task_seed(self, config_id, replicate):
+        return np.random.SeedSequence([self.seed, config_id, replicate]).generate_state(1)[0].item()
+
+    def _load(self):
+        """
+        Results already in the results file, keyed by (config, replicate).
+        """
+        done = {}
+        if self.results_fp is not None and os.path.exists(self.results_fp):
+            for rec in Journal.replay(self.results_fp):
+                done[(rec['key'], rec['replicate'])] = rec
+        return done
+    #END
+
+    def run(self, progress = None):
+        """
+        Run every task not already in the results file, and return the ranked
+        table. progress, if given, is called with each new result.
+        """
+        done = self._load()
+        tasks = []
+        for config_id, config in enumerate(self.configs):
+            key = config_key(config)
+            for rep in range(self.replicates):
+                if (key, rep) not in done:
+                    tasks.append((config_id, config, key, rep))
+
+        journal = Journal(self.results_fp, flush_every = 1) if self.results_fp is not None else None
+        _init_worker(self.model, self.backtester)
+        try:
+            if tasks:
+                with ProcessPoolExecutor(max_workers = self.max_workers, initializer = _init_worker,
+                                         initargs = (self.model, self.backtester)) as pool:
+                    futures = {pool.submit(_run_task, config, self.task_seed(config_id, rep), self.n_users):
+                               (config, key, rep) for config_id, config, key, rep in tasks}
+                    for future in as_completed(futures):
+                        config, key, rep = futures[future]
+                        rec = dict(future.result(), key = key, replicate = rep, config = config)
+                        done[(key, rep)] = rec
+                        if journal is not None:
+                            journal.append(rec)
+                        if progress is not None:
+                            progress(rec)
+        finally:
+            _shared.clear()
+            if journal is not None:
+                journal.close()
+
+        keys = set(config_key(c) for c in self.configs)
+        self.results = [rec for (key, rep), rec in done.items() if key in keys]
+        return self.table()
+    #END
+
+    def table(self):
+        """
+        One row per configuration, ranked by mean profit over its replicates.
+        """
+        if not self.results:
+            return pd.DataFrame(columns = PARAMETERS + ['runs', 'profit_mean', 'profit_std', 'win_rate'])
+        rows = [dict(rec['config'], key = rec['key'], profit = rec['profit'], win_rate = rec['win_rate'])
+                for rec in self.results]
+        df = pd.DataFrame(rows)
+        table = df.groupby('key').agg(
+            runs = ('profit', 'size'),
+            profit_mean = ('profit', 'mean'),
+            profit_std = ('profit', 'std'),
+            win_rate = ('win_rate', 'mean'),
+        )
+        configs = df.drop_duplicates('key').set_index('key').drop(columns = ['profit', 'win_rate'])
+        table = configs.join(table).sort_values('profit_mean', ascending = False)
+        return table.reset_index(drop = True)
+    #END
+
+#END class
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Sweep AnnealingBidder parameters over a replayed user stream.')
+    parser.add_argument('--model', required = True, help = 'pickled purchase model')
+    parser.add_argument('--past-bids', default = None, help = 'past_bids.csv to replay (synthetic users if omitted)')
+    parser.add_argument('--users', type = int, default = 2000, help = 'users per run')
+    parser.add_argument('--replicates', type = int, default = 3)
+    parser.add_argument('--random', type = int, default = None, metavar = 'N',
+                        help = 'random search with N configurations instead of the default grid')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--results', default = None, help = 'JSONL results file (makes the sweep resumable)')
+    parser.add_argument('--workers', type = int, default = None)
+    args = parser.parse_args()
+
+    with open(args.model, 'rb') as fh:
+        model = pickle.load(fh)
+    users = environments.UserSampler(args.past_bids, seed = args.seed)
+    backtester = Backtester(users, n_users = args.users, shuffle = True, seed = args.seed)
+
+    if args.random:
+        space = {'timescale': (50, 5000), 'initial_increment': (0.01, 1.0),
+                 'minimum_increment': (0.001, 0.05), 'discount': (0.6, 1.0)}
+        configs = random_search(space, args.random, seed = args.seed)
+    else:
+        configs = grid(DEFAULT_GRID)
+
+    sweep = Sweep(model, backtester, configs, replicates = args.replicates, n_users = args.users, seed = args.seed,
+                  results_fp = args.results, max_workers = args.workers)
+    table = sweep.run(progress = lambda rec: print('{:>10.2f}  {}'.format(rec['profit'], rec['key'])))
+    print(table.to_string())
+#END
+
+
+if __name__ == '__main__':
+    main()
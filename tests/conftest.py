@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+## The modules import each other by bare name (import utils), as they do
+## when run from the repository itself
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import benchmarks
+import environments
+
+
+@pytest.fixture(scope = 'session')
+def model():
+    """
+    A purchase model trained on synthetic users.
+    """
+    return benchmarks.train_model(environments.UserSampler(seed = 0))
+
+
+@pytest.fixture
+def environment():
+    return environments.BiddingEnvironment(environments.UserSampler(seed = 9), seed = 3)
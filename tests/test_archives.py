@@ -0,0 +1,60 @@
+import threading
+
+import numpy as np
+
+import environments
+from archives import SharedArchive
+from querents import LocalQuerent
+
+
+def test_concurrent_writers_lose_no_records(tmp_path):
+    path = str(tmp_path / 'fleet.sqlite')
+    writers = [SharedArchive(path, name, flush_every = 7, fsync = False) for name in ('a', 'b', 'c')]
+
+    def write(archive):
+        for i in range(300):
+            archive.append({'record': 'test', 'i': i})
+        archive.flush()
+
+    threads = [threading.Thread(target = write, args = (archive,)) for archive in writers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    rows = SharedArchive(path, 'reader').read(everything = True)
+    assert len(rows) == 900
+    for archive in writers:
+        assert [rec['i'] for worker, rec in rows if worker == archive.worker] == list(range(300))
+        archive.close()
+
+
+def test_workers_see_each_others_results(tmp_path):
+    path = str(tmp_path / 'fleet.sqlite')
+
+    def worker(name, first_index):
+        env = environments.BiddingEnvironment(environments.UserSampler(seed = first_index), seed = first_index,
+                                              first_index = first_index)
+        archive = SharedArchive(path, name, flush_every = 1, fsync = False)
+        return LocalQuerent(None, name, env, shared_archive = archive, max_staleness = 0.0)
+
+    workers = [worker('a', 1), worker('b', 10001)]
+    for i in range(20):
+        for qr in workers:
+            qr.get_next_user()
+            qr.place_bid(1.0)
+    for qr in workers:
+        qr.sync()
+
+    keys = sorted(list(range(1, 21)) + list(range(10001, 10021)))
+    for qr in workers:
+        assert len(qr.store) == 40
+        assert len(qr.store.resolved_positions()) == 40
+        np.testing.assert_array_equal(np.sort(qr.store.keys()), keys)
+        qr.close()
+
+    reopened = LocalQuerent(None, 'a', environments.BiddingEnvironment(first_index = 21),
+                            shared_archive = SharedArchive(path, 'a', fsync = False))
+    np.testing.assert_array_equal(np.sort(reopened.store.keys()), keys)
+    assert len(reopened.comps_index) == 40
+    reopened.close()
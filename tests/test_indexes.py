@@ -0,0 +1,35 @@
+import numpy as np
+
+from indexes import CompsIndex
+
+
+def brute_force(points, labels, point, n):
+    d = np.sqrt(((points - point) ** 2).sum(axis = 1))
+    return labels[np.argsort(d, kind = 'stable')[:n]]
+
+
+def test_matches_brute_force_after_adds_and_removes():
+    rng = np.random.default_rng(0)
+    points = rng.random((900, 11))
+    labels = np.arange(900)
+    ## A small buffer, so adds and removes go through several rebuilds
+    index = CompsIndex(11, min_buffer = 16, max_buffer = 64).fit(points[:500], labels[:500])
+    live = set(range(500))
+    for i in range(500, 900):
+        index.add(points[i], i)
+        live.add(i)
+        if i % 3 == 0:
+            ## Some from the tree, some still in the buffer
+            gone = int(rng.choice(sorted(live)))
+            index.remove(gone)
+            live.discard(gone)
+
+    live = np.array(sorted(live))
+    assert len(index) == live.shape[0]
+    for point in rng.random((50, 11)):
+        expected = brute_force(points[live], labels[live], point, 6)
+        np.testing.assert_array_equal(index.query(point, n = 6).astype(int), expected)
+
+    queries = rng.random((50, 11))
+    expected = [brute_force(points[live], labels[live], point, 6) for point in queries]
+    np.testing.assert_array_equal(index.query_batch(queries, n = 6).astype(int), expected)
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import environments
+from instruments import Instrumentation, Stats
+from querents import LocalQuerent
+
+
+def bid_on_next_users(qr, n):
+    for i in range(n):
+        qr.get_next_user()
+        qr.place_bid(1.0)
+
+
+@pytest.fixture
+def env():
+    return environments.BiddingEnvironment(environments.UserSampler(seed = 5), seed = 2)
+
+
+def test_reconcile_reports_a_dropped_bid(env):
+    metrics = Stats()
+    qr = LocalQuerent(None, 'key', env, instruments = Instrumentation(metrics))
+    bid_on_next_users(qr, 10)
+    assert qr.reconcile() == {}
+
+    ## The bid reaches the server, but its result never makes it back
+    user = qr.get_next_user()
+    env.submit_bid({'api_key': 'key', 'user_id': user['user_id'], 'bid_amount': 1e6})
+    mismatches = qr.reconcile()
+    assert mismatches['bids'] == (10, 11)
+    assert mismatches['wins'][1] == mismatches['wins'][0] + 1
+    assert metrics.counters['ledger.mismatches'] == 1
+
+
+def test_totals_survive_reopening(tmp_path, env):
+    archive_dir = str(tmp_path)
+    qr = LocalQuerent(archive_dir, 'key', env, fsync = False)
+    bid_on_next_users(qr, 30)
+    qr.compact()
+    bid_on_next_users(qr, 10)
+    totals = dict(qr.ledger.totals)
+    qr.close()
+
+    ## From the checkpoint and the rows written since
+    reopened = LocalQuerent(archive_dir, 'key', env, fsync = False)
+    assert reopened.ledger.totals == pytest.approx(totals)
+    assert reopened.reconcile() == {}
+    reopened.close()
+
+    ## An archive from before the ledger was kept is seeded from its bids
+    os.remove(os.path.join(archive_dir, 'ledger.jsonl'))
+    seeded = LocalQuerent(archive_dir, 'key', env, fsync = False)
+    assert seeded.ledger.totals == pytest.approx(totals)
+    seeded.close()
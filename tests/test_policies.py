@@ -0,0 +1,34 @@
+import numpy as np
+
+import policies
+
+
+def random_comps(n, rng):
+    """
+    Bids and outcomes on n users' six comps, covering every case of
+    anneal(): all lost, all won, wins all above losses, and mixed.
+    """
+    bids = rng.uniform(0, 10, (n, 6))
+    case = rng.integers(0, 4, n)
+    wins = rng.random((n, 6)) < 0.5
+    wins[case == 0] = False
+    wins[case == 1] = True
+    wins[case == 2] = bids[case == 2] > rng.uniform(2, 8, (int((case == 2).sum()), 1))
+    return bids, wins
+
+
+def test_anneal_batch_matches_one_user_at_a_time():
+    rng = np.random.default_rng(0)
+    bids, wins = random_comps(500, rng)
+    stats = policies.summarize(bids, wins)
+    bounds = rng.uniform(0, 15, 500)
+    increments = rng.choice([0.01, 0.5, 3.0], 500)
+
+    batch = policies.anneal(bounds, increments, stats, np.random.default_rng(1))
+
+    one_rng = np.random.default_rng(1)
+    one = [
+        policies.anneal(bounds[i:i + 1], increments[i:i + 1], [a[i:i + 1] for a in stats], one_rng)[0]
+        for i in range(500)
+    ]
+    np.testing.assert_array_equal(batch, one)
@@ -0,0 +1,112 @@
+from json import dumps
+
+import numpy as np
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import environments
+from querents import LocalQuerent, Querent
+
+
+def fresh_environment():
+    return environments.BiddingEnvironment(environments.UserSampler(seed = 9), seed = 3)
+
+
+def bid_on_next_users(qr, n):
+    for i in range(n):
+        qr.get_next_user()
+        qr.place_bid(1.0)
+
+
+def test_a_reused_user_index_gets_a_local_key(tmp_path):
+    qr = LocalQuerent(str(tmp_path), 'key', fresh_environment(), fsync = False)
+    bid_on_next_users(qr, 5)
+    bids = qr.store.column('bid').copy()
+    qr.close()
+
+    ## A restarted server hands out user indexes from 1 again
+    qr = LocalQuerent(str(tmp_path), 'key', fresh_environment(), fsync = False)
+    bid_on_next_users(qr, 5)
+    assert len(qr.store) == 10
+    np.testing.assert_array_equal(qr.store.column('bid')[:5], bids)
+    np.testing.assert_array_equal(qr.store.keys()[5:], [-1, -2, -3, -4, -5])
+    np.testing.assert_array_equal(qr.store.column('user_index'), [1, 2, 3, 4, 5] * 2)
+    qr.close()
+
+    reopened = LocalQuerent(str(tmp_path), 'key', fresh_environment(), fsync = False)
+    np.testing.assert_array_equal(reopened.store.keys(), qr.store.keys())
+    bid_on_next_users(reopened, 1)
+    assert reopened.store.keys()[-1] == -6
+    reopened.close()
+
+
+class FlakySession:
+    """
+    Stands in for a Querent's requests session: answers from an environment,
+    but first raises the errors queued for an endpoint, one per call.
+    """
+    def __init__(self, environment):
+        self.environment = environment
+        self.errors = {}
+        self.calls = []
+
+    def post(self, url, json = None, timeout = None):
+        route = url.rsplit('/', 1)[-1]
+        self.calls.append(route)
+        if self.errors.get(route):
+            raise self.errors[route].pop(0)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = dumps(getattr(self.environment, route)(json)).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+def flaky_querent():
+    qr = Querent(None, 'key', base_url = 'http://bidding.test', backoff = 0)
+    qr.session = FlakySession(fresh_environment())
+    return qr
+
+
+def refused():
+    ## What requests raises when the connection could not be made at all
+    reason = NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, 'http://bidding.test', reason))
+
+
+def test_a_bid_that_may_have_reached_the_server_is_not_resent():
+    qr = flaky_querent()
+    qr.get_next_user()
+    qr.session.errors['submit_bid'] = [requests.ReadTimeout('read timed out')]
+    res = qr.place_bid(1.0)
+    assert res['result'] == 'unconfirmed'
+    assert qr.session.calls.count('submit_bid') == 1
+    assert len(qr.store.pending_positions()) == 1
+
+    ## The server never saw it, so bidding again goes through
+    assert qr.place_bid(1.0)['result'] == 'success'
+
+
+def test_a_bid_that_never_connected_is_retried():
+    qr = flaky_querent()
+    qr.get_next_user()
+    qr.session.errors['submit_bid'] = [refused(), refused()]
+    assert qr.place_bid(1.0)['result'] == 'success'
+    assert qr.session.calls.count('submit_bid') == 3
+    assert qr.http_stats['place_bid']['retries'] == 2
+
+
+def test_idempotent_calls_are_retried_after_a_timeout():
+    qr = flaky_querent()
+    qr.session.errors['how_am_i_doing'] = [requests.ReadTimeout('read timed out')]
+    assert qr.get_progress()['result'] == 'success'
+    assert qr.session.calls.count('how_am_i_doing') == 2
+
+    ## ...but only so many times
+    qr.session.errors['how_am_i_doing'] = [requests.ReadTimeout('read timed out')] * (qr.retries + 1)
+    with pytest.raises(requests.ReadTimeout):
+        qr.get_progress()
+    assert qr.session.calls.count('how_am_i_doing') == 2 + qr.retries + 1
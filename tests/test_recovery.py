@@ -0,0 +1,121 @@
+"""
+Picking an archive back up after a restart or a crash: journal replay,
+compaction and Bidder.resume().
+"""
+import numpy as np
+import pandas as pd
+
+import bidders
+from journals import Journal
+from querents import LocalQuerent
+
+
+def make_bidder(model, archive_dir, environment, resume = False):
+    qr = LocalQuerent(str(archive_dir), 'key', environment, fsync = False)
+    bidder = bidders.AnnealingBidder(model, qr, timescale = 50, rng = np.random.default_rng(5), resume = resume)
+    return qr, bidder
+
+
+def assert_same_archive(qr, customers, bids):
+    pd.testing.assert_frame_equal(qr.customers, customers)
+    pd.testing.assert_frame_equal(qr.bids, bids)
+
+
+def test_replaying_the_journal_again_changes_nothing(model, environment, tmp_path):
+    qr, bidder = make_bidder(model, tmp_path, environment)
+    bidder.execute_bids(40)
+    qr.get_next_user()
+    qr.journal.flush()
+    customers, bids = qr.customers.copy(), qr.bids.copy()
+    wins = qr.wins(positions = True).copy()
+
+    qr._replay(Journal.replay(qr.journal_fp))
+    assert_same_archive(qr, customers, bids)
+    np.testing.assert_array_equal(qr.wins(positions = True), wins)
+    assert qr.store.pending_positions() == [len(qr.store) - 1]
+    qr.close()
+
+
+def test_crash_during_compaction_loses_nothing(model, environment, tmp_path):
+    qr, bidder = make_bidder(model, tmp_path, environment)
+    bidder.execute_bids(30)
+    qr.compact()
+    bidder.execute_bids(20)
+    qr.journal.flush()
+    with open(qr.journal_fp) as fh:
+        records = fh.read()
+    qr.compact()
+    customers, bids = qr.customers.copy(), qr.bids.copy()
+    qr.close()
+
+    ## As if the process died after writing the snapshot but before the
+    ## journal was emptied
+    with open(qr.journal_fp, 'w') as fh:
+        fh.write(records)
+    reopened, _ = make_bidder(model, tmp_path, environment)
+    assert_same_archive(reopened, customers, bids)
+    reopened.close()
+
+
+def test_resume_bids_on_the_customer_left_up_for_bid(model, environment, tmp_path):
+    qr, bidder = make_bidder(model, tmp_path, environment)
+    bidder.execute_bids(20)
+    qr.get_next_user()
+    user_id = qr.store.get(qr.store.pending, 'user_id')
+    timestep = bidder._timestep
+    bids = environment._sessions['key']['bids']
+    qr.close()
+
+    qr, bidder = make_bidder(model, tmp_path, environment, resume = True)
+    assert bidder._timestep == timestep
+    res = bidder.resume()
+    assert res['result'] == 'success'
+    assert qr.store.pending is None
+    assert qr.store.get(qr.store.user_position(user_id), 'bid') >= 0
+    assert environment._sessions['key']['bids'] == bids + 1
+    assert bidder._timestep == timestep + 1
+    qr.close()
+
+
+def test_resume_abandons_a_customer_whose_result_was_lost(model, environment, tmp_path):
+    qr, bidder = make_bidder(model, tmp_path, environment)
+    bidder.execute_bids(20)
+    qr.get_next_user()
+    user_id = qr.store.get(qr.store.pending, 'user_id')
+    timestep = bidder._timestep
+    bids = environment._sessions['key']['bids']
+    qr.close()
+    ## The bid reached the server, but the session died before the result
+    ## was archived
+    environment.submit_bid({'api_key': 'key', 'user_id': user_id, 'bid_amount': 0.1})
+
+    qr, bidder = make_bidder(model, tmp_path, environment, resume = True)
+    res = bidder.resume()
+    assert res['result'] == 'success'
+    assert np.isnan(qr.store.get(qr.store.user_position(user_id), 'bid'))
+    assert qr.store.pending is None
+    ## The lost bid and the new one; only the new one is a step for the bidder
+    assert environment._sessions['key']['bids'] == bids + 2
+    assert bidder._timestep == timestep + 1
+    qr.close()
+
+
+def test_resume_frees_a_user_the_archive_never_saw(model, environment, tmp_path):
+    qr, bidder = make_bidder(model, tmp_path, environment)
+    bidder.execute_bids(20)
+    customers = len(qr.store)
+    bids = environment._sessions['key']['bids']
+    qr.close()
+    ## The server handed out a user, but the session died before it was
+    ## archived
+    user_id = environment.get_next_user({'api_key': 'key'})['user_id']
+
+    qr, bidder = make_bidder(model, tmp_path, environment, resume = True)
+    res = bidder.resume()
+    assert res['result'] == 'success'
+    assert qr.store.user_position(user_id) is None
+    assert qr.store.pending is None
+    assert len(qr.store) == customers + 1
+    ## The emergency bid and the one on the next user
+    assert environment._sessions['key']['bids'] == bids + 2
+    qr.close()
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import bidders
+import environments
+import retention
+import utils
+from indexes import CompsIndex
+from querents import LocalQuerent
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def offer(policy, n):
+    ## All in the same segment
+    kept = set()
+    for pos in range(n):
+        kept.add(pos)
+        kept -= set(policy.add(pos, np.zeros(len(utils.FEATURE_COLUMNS))))
+    return kept
+
+
+def test_sliding_window_keeps_the_newest_comps_however_old():
+    clock = Clock()
+    policy = retention.SlidingWindow(max_age = 60, clock = clock)
+    offer(policy, 20)
+    clock.now += 600
+    assert policy.add(20, np.zeros(len(utils.FEATURE_COLUMNS))) != []
+    assert len(policy) == retention.MIN_KEEP
+
+
+@pytest.mark.parametrize('policy', [
+    retention.SlidingWindow(max_count = 6),
+    retention.SegmentReservoir(per_segment = 1, seed = 0),
+    retention.RecencyWeighted(capacity = 6, half_life = 2, seed = 0),
+])
+def test_policies_never_keep_fewer_than_min_keep(policy):
+    kept = offer(policy, 200)
+    assert len(kept) == len(policy) >= retention.MIN_KEEP
+
+
+def test_policies_refuse_a_limit_below_min_keep():
+    with pytest.raises(ValueError):
+        retention.SlidingWindow(max_count = 5)
+    with pytest.raises(ValueError):
+        retention.RecencyWeighted(capacity = 5)
+
+
+def test_bidder_falls_back_when_there_are_too_few_comps(model):
+    env = environments.BiddingEnvironment(environments.UserSampler(seed = 9), seed = 3)
+    qr = LocalQuerent(None, 'key', env)
+    bidder = bidders.AnnealingBidder(model, qr, rng = np.random.default_rng(5))
+    qr._comps_index = CompsIndex(len(utils.FEATURE_COLUMNS))
+    bidder.execute_bid()
+    assert bidder.last_tier in ('segment', 'default')
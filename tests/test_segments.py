@@ -0,0 +1,21 @@
+import numpy as np
+
+import environments
+from segments import SegmentStats
+
+
+def test_updates_match_fit():
+    rng = np.random.default_rng(0)
+    sampler = environments.UserSampler(seed = 1)
+    X = sampler.features[sampler.sample(3000)]
+    bids = rng.uniform(0, 10, 3000)
+    wins = rng.random(3000) < 0.4
+
+    running = SegmentStats()
+    for x, bid, win in zip(X, bids, wins):
+        running.update(running.segment(x), bid, win)
+    fitted = SegmentStats().fit(X, bids, wins)
+
+    np.testing.assert_array_equal(fitted.segments(X), [running.segment(x) for x in X])
+    for name in ['n_wins', 'n_losses', 'highest_loss', 'lowest_win', 'second_lowest_win', 'last_bid']:
+        np.testing.assert_array_equal(getattr(fitted, name), getattr(running, name), err_msg = name)
@@ -2,6 +2,72 @@ import pandas as pd
 import numpy as np
 
 
+## Column order of the features produced by frame_to_features()
+FEATURE_COLUMNS = [
+    'sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+    'female', 'marital_status', 'age', 'income'
+]
+
+DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+## Centering and scaling for the continuous features
+AGE_MEAN, AGE_STD = 42.62266, 13.340682
+INCOME_MEAN, INCOME_STD = 85068.38652, 37527.481327
+
+## Mean revenue of a purchase, from the analysis in purchase_model.ipynb
+AVE_PURCHASE_REVENUE = 10.181258488003621
+
+## One-hot rows for each day code. The last row (code -1) is for a missing
+## or unrecognised day, which gets all zeros.
+_DAY_TABLE = np.vstack([np.eye(7), np.zeros((1, 7))])
+_DAY_CODES = {day: i for i, day in enumerate(DAYS)}
+
+
+def encode_arrays(day_codes, female, married, age, income, out = None):
+    """
+    Write features for many customers into a (n, 11) float64 matrix.
+
+    day_codes are indexes into DAYS (-1 for unknown), female and married are
+    booleans, age and income are the raw values. If out is given the
+    features are written into it (e.g. a slice of a preallocated archive
+    matrix) instead of a new array.
+    """
+    day_codes = np.asarray(day_codes)
+    if out is None:
+        out = np.empty((day_codes.shape[0], len(FEATURE_COLUMNS)), dtype = np.float64)
+
+    out[:, 0:7] = _DAY_TABLE[day_codes]
+    out[:, 7] = female
+    out[:, 8] = married
+    out[:, 9] = (np.asarray(age, dtype = np.float64) - AGE_MEAN) / AGE_STD
+    out[:, 10] = (np.asarray(income, dtype = np.float64) - INCOME_MEAN) / INCOME_STD
+
+    return out
+#END
+
+
+def record_to_features(record, out = None):
+    """
+    Construct the feature vector for a single customer straight from the dict
+    returned by the server (no data frame needed).
+    """
+    if out is None:
+        out = np.zeros(len(FEATURE_COLUMNS), dtype = np.float64)
+    else:
+        out[:] = 0
+
+    day = _DAY_CODES.get(record['day_of_week'])
+    if day is not None:
+        out[day] = 1.0
+    out[7] = record['gender'] == 'F'
+    out[8] = record['marital_status'] == 'M'
+    out[9] = (record['age'] - AGE_MEAN) / AGE_STD
+    out[10] = (record['income'] - INCOME_MEAN) / INCOME_STD
+
+    return out
+#END
+
+
 def frame_to_features(df):
     """
     Take a 'customers' data frame of one or more rows and
@@ -9,19 +75,14 @@ def frame_to_features(df):
     will be ignored, bit there will of course be an error if
     the required columns are missing.
     """
-    features = pd.DataFrame(index = df.index)
-    
-    features['sunday'] = (df['day_of_week'] == 'Sunday').astype(np.float64)
-    features['monday'] = (df['day_of_week'] == 'Monday').astype(np.float64)
-    features['tuesday'] = (df['day_of_week'] == 'Tuesday').astype(np.float64)
-    features['wednesday'] = (df['day_of_week'] == 'Wednesday').astype(np.float64)
-    features['thursday'] = (df['day_of_week'] == 'Thursday').astype(np.float64)
-    features['friday'] = (df['day_of_week'] == 'Friday').astype(np.float64)
-    features['saturday'] = (df['day_of_week'] == 'Saturday').astype(np.float64)
-    features['female'] = (df['gender'] == 'F').astype(np.float64)
-    features['marital_status'] = (df['marital_status'] == 'M').astype(np.float64)
-    features['age'] = (df['age'] - 42.62266) / 13.340682
-    features['income'] = (df['income'] - 85068.38652) / 37527.481327
-    
-    return features
+    day_codes = pd.Categorical(df['day_of_week'], categories = DAYS).codes
+    feat = encode_arrays(
+        day_codes,
+        (df['gender'] == 'F').values,
+        (df['marital_status'] == 'M').values,
+        df['age'].values,
+        df['income'].values
+    )
+
+    return pd.DataFrame(feat, index = df.index, columns = FEATURE_COLUMNS)
 #END